@@ -0,0 +1,108 @@
+# admission.py - per-client connection limits and token-bucket rate limits for server.py
+import time
+
+RATE_BURST = 5.0  # a client may save up this many seconds' worth of its rate limits
+SHED_RATIO = 0.75  # new messages get a 451 once the storage queue is this full
+PRUNE_INTERVAL = 60.0  # seconds between sweeps that forget idle clients
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `burst`; may go into debt for a large charge."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def available(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, amount=1):
+        self.tokens = self.available() - amount
+
+    def is_full(self):
+        return self.available() >= self.burst
+
+
+class AdmissionControl:
+    """Connection counts and message/byte rates per client IP; 0 disables a limit.
+
+    Only used from the event loop thread. With --workers every process
+    keeps its own counts, so the limits apply per worker.
+    """
+
+    def __init__(self, max_connections=0, per_ip=0, messages_per_sec=0, bytes_per_sec=0, burst=RATE_BURST,
+                 max_message=0):
+        self.max_connections = max_connections
+        self.per_ip = per_ip
+        self.messages_per_sec = messages_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.burst = burst
+        self.max_message = max_message  # largest message the server accepts, in bytes
+        self.connections = {}  # ip -> open sessions
+        self.total = 0
+        self.buckets = {}  # ip -> (message bucket or None, byte bucket or None)
+        self.pruned = time.monotonic()
+
+    def open(self, ip):
+        """Count a new connection; returns None, or 'connections' / 'client_connections' if over a limit."""
+        if self.max_connections and self.total >= self.max_connections:
+            return 'connections'
+        if self.per_ip and self.connections.get(ip, 0) >= self.per_ip:
+            return 'client_connections'
+        self.connections[ip] = self.connections.get(ip, 0) + 1
+        self.total += 1
+        return None
+
+    def close(self, ip):
+        count = self.connections.get(ip, 0) - 1
+        if count > 0:
+            self.connections[ip] = count
+        else:
+            self.connections.pop(ip, None)
+        self.total = max(self.total - 1, 0)
+
+    def check_message(self, ip):
+        """Return None if ip may send another message now, else 'messages' or 'bytes'."""
+        messages, size = self._buckets(ip)
+        if messages and messages.available() < 1:
+            return 'messages'
+        if size and size.available() <= 0:
+            return 'bytes'  # still paying off an earlier large message
+        return None
+
+    def charge(self, ip, num_bytes):
+        """Account one accepted message of num_bytes to ip."""
+        messages, size = self._buckets(ip)
+        if messages:
+            messages.take(1)
+        if size:
+            size.take(num_bytes)
+
+    def _buckets(self, ip):
+        buckets = self.buckets.get(ip)
+        if buckets is None:
+            self._prune()
+            # A bucket must hold at least one message (of any allowed size), or
+            # low rates would refuse every message forever
+            message_burst = max(1, self.messages_per_sec * self.burst)
+            byte_burst = max(1, self.max_message, self.bytes_per_sec * self.burst)
+            buckets = self.buckets[ip] = (
+                TokenBucket(self.messages_per_sec, message_burst) if self.messages_per_sec else None,
+                TokenBucket(self.bytes_per_sec, byte_burst) if self.bytes_per_sec else None,
+            )
+        return buckets
+
+    def _prune(self):
+        # A full bucket is the same as a fresh one, so idle clients can be forgotten
+        now = time.monotonic()
+        if now - self.pruned < PRUNE_INTERVAL:
+            return
+        self.pruned = now
+        for ip, buckets in list(self.buckets.items()):
+            if ip not in self.connections and all(b is None or b.is_full() for b in buckets):
+                del self.buckets[ip]
@@ -0,0 +1,437 @@
+# benchmark.py - reproducible load tests for server.py (SMTP ingestion) and web_server.py (WebSocket gateway)
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from email import policy
+from email.message import EmailMessage
+
+import websockets
+
+from mail_index import MailIndex
+from mailstore import STORE_FORMATS, Item, message_stamp, open_store, safe_recipient, write_format
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SMTP_PORT = 2525  # server.py
+WEB_PORT = 8787  # web_server.py
+RESULTS_DIR = "bench_results"  # JSON reports go here unless --out is given
+SAMPLE_INTERVAL = 0.1  # seconds between RSS samples and loop-lag probes
+STARTUP_TIMEOUT = 20  # seconds to wait for a server to accept connections
+WORDS = ("invoice report meeting budget travel lunch project deadline server network "
+         "schedule review update release customer order payment quarter team notes").split()
+
+
+def percentiles(values):
+    """Summarise a list of seconds as milliseconds."""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * 1000, 2),
+    }
+
+
+def tree_rss(pid):
+    """Resident memory in bytes of pid and its direct children (Linux /proc), or None."""
+    def rss(p):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except OSError:
+        return None
+    return rss(pid) + sum(rss(c) for c in children)
+
+
+class ServerProcess:
+    """Runs one of the project's scripts in a scratch directory for the length of a benchmark."""
+
+    def __init__(self, script, args, workdir, port):
+        self.port = port
+        self.log_path = os.path.join(workdir, script.replace(".py", ".log"))
+        env = dict(os.environ, PYTHONIOENCODING="utf-8", PYTHONUNBUFFERED="1")
+        self.log = open(self.log_path, "wb")
+        self.proc = subprocess.Popen([sys.executable, os.path.join(HERE, script), *args],
+                                     cwd=workdir, stdout=self.log, stderr=subprocess.STDOUT, env=env)
+        self.peak_rss = 0
+        self.sampling = True
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def wait_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.log_path} exited early, see the log")
+            try:
+                socket.create_connection(("localhost", self.port), 0.5).close()
+                self.sampler.start()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"nothing listening on port {self.port} after {STARTUP_TIMEOUT}s")
+
+    def _sample(self):
+        while self.sampling:
+            rss = tree_rss(self.proc.pid)
+            if rss:
+                self.peak_rss = max(self.peak_rss, rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.sampling = False
+        if self.proc.poll() is None:
+            # Ctrl+C path where there is one, so the servers shut down the way they normally do
+            if os.name == "posix":
+                self.proc.send_signal(signal.SIGINT)
+            else:
+                self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.log.close()
+
+
+# ---- SMTP ingestion -------------------------------------------------------
+
+def build_message(n, args, rng):
+    """One unique message (unique attachment bytes too, so blob dedup doesn't flatter the result)."""
+    msg = EmailMessage()
+    recipients = [f"user{rng.randrange(args.mailboxes)}@bench.local" for _ in range(args.recipients)]
+    msg["From"] = f"sender{n % 50}@bench.local"
+    msg["To"] = ", ".join(recipients)
+    msg["Subject"] = f"bench {n}: " + " ".join(rng.sample(WORDS, 3))
+    lines, line, size = [], [], 0
+    while size < args.size:
+        word = rng.choice(WORDS)
+        line.append(word)
+        size += len(word) + 1
+        if len(line) == 10:
+            lines.append(" ".join(line))
+            line = []
+    msg.set_content("\n".join(lines + [" ".join(line)]))
+    if rng.random() < args.attachment_ratio:
+        msg.add_attachment(rng.randbytes(args.attachment_size), maintype="application",
+                           subtype="octet-stream", filename=f"bench_{n}.bin")
+    return msg["From"], recipients, msg.as_bytes(policy=policy.SMTP)
+
+
+def lag_probe_smtp(stop, samples):
+    """NOOP round trips on an idle session; they wait behind whatever is blocking the server's loop."""
+    with smtplib.SMTP("localhost", SMTP_PORT, timeout=60) as probe:
+        while not stop.is_set():
+            start = time.perf_counter()
+            probe.noop()
+            samples.append(time.perf_counter() - start)
+            stop.wait(SAMPLE_INTERVAL)
+
+
+def run_smtp(args, workdir):
+    rng = random.Random(args.seed)
+    print(f"✉️  Building {args.messages} messages...")
+    messages = [build_message(n, args, rng) for n in range(args.messages)]
+    server = ServerProcess("server.py", ["--workers", str(args.workers), "--storage", args.storage],
+                           workdir, SMTP_PORT)
+    latencies, lag, errors = [], [], []
+    delivered = [0]  # bytes of accepted messages
+    lock = threading.Lock()
+    next_message = iter(range(len(messages)))
+    stop = threading.Event()
+
+    def sender():
+        session = None
+        while True:
+            with lock:
+                n = next(next_message, None)
+            if n is None:
+                break
+            mail_from, rcpts, raw = messages[n]
+            start = time.perf_counter()
+            try:
+                if session is None:
+                    session = smtplib.SMTP("localhost", SMTP_PORT, timeout=60)
+                session.sendmail(mail_from, rcpts, raw)
+                latencies.append(time.perf_counter() - start)
+                with lock:
+                    delivered[0] += len(raw)
+            except (smtplib.SMTPException, OSError) as e:
+                errors.append(str(e))
+                if session is not None:
+                    session.close()
+                session = None
+        if session is not None:
+            session.quit()
+
+    try:
+        server.wait_ready()
+        probe = threading.Thread(target=lag_probe_smtp, args=(stop, lag), daemon=True)
+        probe.start()
+        print(f"🚀 Sending with {args.concurrency} connections...")
+        started = time.perf_counter()
+        threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        probe.join()
+    finally:
+        server.stop()
+
+    return {
+        'messages': len(latencies),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(len(latencies) / elapsed, 1),
+        'bytes_per_s': round(delivered[0] / elapsed),
+        'latency_ms': percentiles(latencies),
+        'loop_lag_ms': percentiles(lag),
+        'peak_rss_mb': round(server.peak_rss / 2**20, 1) if server.peak_rss else None,
+    }
+
+
+# ---- WebSocket gateway ----------------------------------------------------
+
+def generate_inbox(root, args):
+    """Write a large inbox straight through MailStore/MailIndex (much faster than going over SMTP)."""
+    rng = random.Random(args.seed)
+    write_format(root, args.storage)
+    store = open_store(root)
+    index = MailIndex(root)
+    entries = []
+    for n in range(args.inbox_messages):
+        ts = message_stamp()
+        rcpt = f"user{rng.randrange(args.mailboxes)}@bench.local"
+        subject = f"bench {n}: " + " ".join(rng.sample(WORDS, 3))
+        text = " ".join(rng.choices(WORDS, k=60))
+        raw = f"From: sender@bench.local\r\nTo: {rcpt}\r\nSubject: {subject}\r\n\r\n{text}\r\n".encode("utf-8")
+        body = f"From: sender@bench.local\nTo: {rcpt}\nSubject: {subject}\n\n{text}".encode("utf-8")
+        recipient = safe_recipient(rcpt)
+        store.write_items([recipient], [Item(f"mail_{ts}.eml", data=raw), Item(f"body_{ts}.txt", data=body)])
+        entries.append({"recipient": recipient, "ts": ts, "sender": "sender@bench.local",
+                        "subject": subject, "size": len(raw), "eml": f"mail_{ts}.eml",
+                        "body": f"body_{ts}.txt", "attachments": [], "text": text})
+        if len(entries) >= 1000:
+            index.add(entries)
+            entries = []
+    index.add(entries)
+    recipients = [rec['name'] for rec in index.recipients()]
+    index.close()
+    return recipients
+
+
+async def web_client(url, args, recipients, rng, latencies, errors):
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.recv()  # 'connected'
+
+        async def request(payload, reply_type):
+            start = time.perf_counter()
+            await ws.send(json.dumps(payload))
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply['type'] == reply_type:
+                    latencies.setdefault(payload['type'], []).append(time.perf_counter() - start)
+                    return reply
+                if reply['type'] == 'error':
+                    errors.append(reply.get('message'))
+                    return None
+
+        for _ in range(args.requests):
+            await request({'type': 'get_recipients'}, 'recipients')
+            cursor = None
+            recipient = rng.choice(recipients)
+            for _ in range(args.pages):
+                page = await request({'type': 'get_emails', 'recipient': recipient, 'cursor': cursor}, 'emails')
+                cursor = page and page.get('next_cursor')
+                if not cursor:
+                    break
+
+
+async def lag_probe_ws(url, stop, samples):
+    """WebSocket ping round trips; pongs are answered by the gateway's event loop."""
+    async with websockets.connect(url) as ws:
+        while not stop.is_set():
+            start = time.perf_counter()
+            await (await ws.ping())
+            samples.append(time.perf_counter() - start)
+            try:
+                await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def drive_web(args, recipients):
+    url = f"ws://localhost:{WEB_PORT}"
+    rng = random.Random(args.seed)
+    latencies, lag, errors = {}, [], []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(lag_probe_ws(url, stop, lag))
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[web_client(url, args, recipients, random.Random(rng.random()), latencies, errors)
+          for _ in range(args.clients)],
+        return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    errors += [repr(r) for r in results if isinstance(r, Exception)]
+    total = sum(len(v) for v in latencies.values())
+    return {
+        'requests': total,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(total / elapsed, 1),
+        'latency_ms': {kind: percentiles(values) for kind, values in latencies.items()},
+        'loop_lag_ms': percentiles(lag),
+    }
+
+
+def run_web(args, workdir):
+    print(f"📂 Generating an inbox with {args.inbox_messages} messages for {args.mailboxes} mailboxes...")
+    started = time.perf_counter()
+    recipients = generate_inbox(os.path.join(workdir, "inbox"), args)
+    print(f"   done in {time.perf_counter() - started:.1f}s")
+    server = ServerProcess("web_server.py", [], workdir, WEB_PORT)
+    try:
+        server.wait_ready()
+        print(f"🚀 {args.clients} clients x {args.requests} rounds...")
+        result = asyncio.run(drive_web(args, recipients))
+    finally:
+        server.stop()
+    result['peak_rss_mb'] = round(server.peak_rss / 2**20, 1) if server.peak_rss else None
+    return result
+
+
+# ---- reporting ------------------------------------------------------------
+
+def flatten(data, prefix=""):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only."""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(paths):
+    """Print the numeric results of two or more saved runs side by side."""
+    runs = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            runs.append(json.load(f))
+    flats = [flatten(run['results']) for run in runs]
+    keys = sorted(set().union(*flats))
+    print(f"{'metric':40}" + "".join(f"{os.path.basename(p)[:18]:>20}" for p in paths) + f"{'change':>10}")
+    for key in keys:
+        values = [flat.get(key) for flat in flats]
+        change = ""
+        if values[0] and values[-1] is not None:
+            change = f"{(values[-1] - values[0]) / values[0] * 100:+.1f}%"
+        print(f"{key:40}" + "".join(f"{'' if v is None else v:>20}" for v in values) + f"{change:>10}")
+
+
+def save(scenario, args, results):
+    report = {
+        'scenario': scenario,
+        'started': datetime.now().isoformat(timespec="seconds"),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'config': {k: v for k, v in vars(args).items() if k not in ("func", "out")},
+        'results': results,
+    }
+    path = args.out
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{scenario}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"💾 Saved {path}")
+
+
+def run_scenario(scenario, runner, args):
+    # Ports are fixed by the servers, so make sure nothing else already holds them
+    port = SMTP_PORT if scenario == "smtp" else WEB_PORT
+    try:
+        socket.create_connection(("localhost", port), 0.5).close()
+        sys.exit(f"❌ Port {port} is already in use; stop the running server first")
+    except OSError:
+        pass
+    with tempfile.TemporaryDirectory(prefix=f"bench_{scenario}_") as workdir:
+        results = runner(args, workdir)
+    save(scenario, args, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load tests for the SMTP server and the WebSocket gateway")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    def common(p):
+        p.add_argument("--mailboxes", type=int, default=50, help="distinct recipient addresses")
+        p.add_argument("--seed", type=int, default=1, help="random seed, so runs are repeatable")
+        p.add_argument("--storage", choices=STORE_FORMATS, default="files", help="mailbox format to test")
+        p.add_argument("--out", help="result file (default: bench_results/<scenario>_<time>.json)")
+
+    smtp = sub.add_parser("smtp", help="drive server.py over SMTP")
+    common(smtp)
+    smtp.add_argument("--messages", type=int, default=500, help="messages to send")
+    smtp.add_argument("--concurrency", type=int, default=16, help="SMTP connections sending at once")
+    smtp.add_argument("--size", type=int, default=4096, help="bytes of body text per message")
+    smtp.add_argument("--recipients", type=int, default=1, help="RCPT TO addresses per message")
+    smtp.add_argument("--attachment-ratio", type=float, default=0.3, help="share of messages with an attachment")
+    smtp.add_argument("--attachment-size", type=int, default=100 * 1024, help="bytes per attachment")
+    smtp.add_argument("--workers", type=int, default=1, help="passed to server.py --workers")
+    smtp.set_defaults(func=run_smtp)
+
+    web = sub.add_parser("web", help="drive web_server.py with many WebSocket clients")
+    common(web)
+    web.add_argument("--inbox-messages", type=int, default=20000, help="messages in the generated inbox")
+    web.add_argument("--clients", type=int, default=50, help="concurrent WebSocket clients")
+    web.add_argument("--requests", type=int, default=20, help="get_recipients + get_emails rounds per client")
+    web.add_argument("--pages", type=int, default=1, help="get_emails pages fetched per round")
+    web.set_defaults(func=run_web)
+
+    cmp = sub.add_parser("compare", help="compare saved result files")
+    cmp.add_argument("files", nargs="+")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.scenario == "compare":
+        compare(args.files)
+    else:
+        run_scenario(args.scenario, args.func, args)
@@ -1,11 +1,85 @@
 # client_gui.py
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import codecs
+import queue
 import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 import os
 
+from mail_index import MailIndex
+from mailstore import open_store
+
 INBOX_DIR = "inbox"  # same as server
+PREVIEW_BYTES = 64 * 1024  # the content pane never shows more than this
+MAIL_PAGE_SIZE = 100  # messages fetched per page while the mail list is scrolled
+POLL_MS = 50  # how often the Tk thread picks up results from the workers
+mail_store = open_store(INBOX_DIR)
+
+class Cancelled(Exception):
+    pass
+
+class BackgroundTasks:
+    """Runs blocking work on threads and hands results back to the Tk thread.
+
+    Workers never touch widgets: run() and post() put callbacks on a queue
+    that the Tk event loop drains every POLL_MS.
+    """
+
+    def __init__(self, root, workers=2):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="client-io")
+        self.results = queue.Queue()
+        self.root.after(POLL_MS, self._drain)
+
+    def run(self, func, *args, on_done=None, on_error=None):
+        """Call func(*args) on a worker; on_done(result) or on_error(exc) then run on the Tk thread."""
+        def work():
+            try:
+                result = func(*args)
+            except Exception as e:
+                if on_error:
+                    self.post(on_error, e)
+                return
+            if on_done:
+                self.post(on_done, result)
+        return self.executor.submit(work)
+
+    def post(self, callback, *args):
+        """Schedule callback(*args) on the Tk thread (safe to call from any thread)."""
+        self.results.put((callback, args))
+
+    def _drain(self):
+        try:
+            while True:
+                callback, args = self.results.get_nowait()
+                try:
+                    callback(*args)
+                except tk.TclError:
+                    pass  # the window it was meant for has been closed
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self._drain)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def read_preview(rec, fname):
+    """Return (item size, text to show) for the first PREVIEW_BYTES of an item."""
+    with mail_store.open_item(rec, fname) as f:
+        size = f.size
+        data = f.read(PREVIEW_BYTES)
+    truncated = size > len(data)
+    try:
+        # a cut-off multi-byte character at the end of a truncated preview is fine
+        text = codecs.getincrementaldecoder("utf-8")().decode(data, final=not truncated)
+    except UnicodeDecodeError:
+        return size, f"[Binary file: {fname}] ({size} bytes)\n\nFile path:\n{os.path.join(INBOX_DIR, rec, fname)}"
+    if truncated:
+        text += f"\n\n[... showing the first {len(data)} of {size} bytes]"
+    return size, text
 
 class SMTPApp(tk.Tk):
     def __init__(self):
@@ -13,6 +87,9 @@ class SMTPApp(tk.Tk):
         self.title("SMTP Lab - GUI Client")
         self.geometry("800x600")
         self.attachments = []
+        self.tasks = BackgroundTasks(self)
+        self.sending = None  # threading.Event that cancels the send in progress
+        self.smtp = None  # the send's SMTP connection, closed to cancel mid-transfer
 
         # Top frame: inputs
         frm = ttk.Frame(self, padding=10)
@@ -42,14 +119,25 @@ class SMTPApp(tk.Tk):
         # action buttons
         btn_frame = ttk.Frame(self, padding=10)
         btn_frame.pack(fill=tk.X)
-        ttk.Button(btn_frame, text="Send", command=self.send_email).pack(side=tk.LEFT, padx=5)
+        self.send_btn = ttk.Button(btn_frame, text="Send", command=self.send_email)
+        self.send_btn.pack(side=tk.LEFT, padx=5)
+        self.cancel_btn = ttk.Button(btn_frame, text="Cancel", command=self.cancel_send, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="View Inbox", command=self.open_inbox_viewer).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="Clear", command=self.clear_form).pack(side=tk.LEFT, padx=5)
+        self.progress = ttk.Progressbar(btn_frame, length=200, mode="determinate")
+        self.progress.pack(side=tk.RIGHT, padx=5)
 
         # status area
         self.status_var = tk.StringVar(value="Ready")
         status_bar = ttk.Label(self, textvariable=self.status_var, relief=tk.SUNKEN, anchor=tk.W)
         status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        self.cancel_send()
+        self.tasks.shutdown()
+        self.destroy()
 
     def add_attachment(self):
         files = filedialog.askopenfilenames(title="Select attachments")
@@ -76,6 +164,16 @@ class SMTPApp(tk.Tk):
             messagebox.showwarning("Missing", "Sender and at least one recipient are required.")
             return
 
+        # reading attachments and talking SMTP happen on a worker; the window stays responsive
+        self.sending = threading.Event()
+        self.send_btn.config(state=tk.DISABLED)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.progress.config(mode="determinate", maximum=len(self.attachments) + 1, value=0)
+        self.tasks.run(self._send_worker, sender, recs, subject, body, list(self.attachments), self.sending,
+                       on_done=self._send_done, on_error=self._send_failed)
+
+    def _send_worker(self, sender, recs, subject, body, attachments, cancelled):
+        """Build and send the message (worker thread); progress goes through self.tasks.post."""
         msg = EmailMessage()
         msg["From"] = sender
         msg["To"] = ", ".join(recs)
@@ -83,7 +181,11 @@ class SMTPApp(tk.Tk):
         msg.set_content(body if body else "")
 
         # Attach files
-        for path in self.attachments:
+        for n, path in enumerate(attachments, 1):
+            if cancelled.is_set():
+                raise Cancelled()
+            fname = os.path.basename(path)
+            self.tasks.post(self._send_progress, n - 1, f"Reading {fname} ({n}/{len(attachments)})...")
             try:
                 with open(path, "rb") as f:
                     data = f.read()
@@ -91,36 +193,87 @@ class SMTPApp(tk.Tk):
                 # try to guess a subtype from extension (simple)
                 ext = os.path.splitext(path)[1].lower().replace(".", "")
                 subtype = ext if ext else "octet-stream"
-                fname = os.path.basename(path)
                 msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=fname)
             except Exception as e:
                 print("Attachment error:", e)
 
-        self.status_var.set("Connecting to server...")
-        try:
-            # connect to local test SMTP server (port 2525)
-            with smtplib.SMTP("localhost", 2525, timeout=10) as smtp:
+        if cancelled.is_set():
+            raise Cancelled()
+        self.tasks.post(self._send_progress, len(attachments), "Connecting to server...")
+        # connect to local test SMTP server (port 2525)
+        with smtplib.SMTP("localhost", 2525, timeout=10) as smtp:
+            self.smtp = smtp
+            try:
+                if cancelled.is_set():
+                    raise Cancelled()
+                self.tasks.post(self._send_progress, len(attachments), "Sending...")
                 smtp.send_message(msg)
-            self.status_var.set("✅ Email has been sent!")
-            messagebox.showinfo("Success", "Email sent successfully!")
-        except Exception as e:
-            self.status_var.set("❌ Problem occurs: " + str(e))
-            messagebox.showerror("Error", f"Failed to send email:\n{e}")
+            except (OSError, smtplib.SMTPException):
+                if cancelled.is_set():
+                    raise Cancelled()  # cancel_send closed the connection under us
+                raise
+            finally:
+                self.smtp = None
+
+    def _send_progress(self, value, text):
+        self.progress.config(value=value)
+        self.status_var.set(text)
+
+    def _send_finished(self):
+        self.sending = None
+        self.send_btn.config(state=tk.NORMAL)
+        self.cancel_btn.config(state=tk.DISABLED)
+        self.progress.config(value=0)
+
+    def _send_done(self, _):
+        self._send_finished()
+        self.status_var.set("✅ Email has been sent!")
+        messagebox.showinfo("Success", "Email sent successfully!")
+
+    def _send_failed(self, e):
+        self._send_finished()
+        if isinstance(e, Cancelled):
+            self.status_var.set("Sending cancelled")
+            return
+        self.status_var.set("❌ Problem occurs: " + str(e))
+        messagebox.showerror("Error", f"Failed to send email:\n{e}")
+
+    def cancel_send(self):
+        if self.sending is None:
+            return
+        self.sending.set()
+        self.status_var.set("Cancelling...")
+        smtp = self.smtp
+        if smtp is not None and smtp.sock is not None:
+            try:
+                # unblocks the worker if it is in the middle of the SMTP exchange
+                smtp.sock.shutdown(2)
+            except OSError:
+                pass
 
     def open_inbox_viewer(self):
-        InboxViewer(self)
+        InboxViewer(self, self.tasks)
 
 class InboxViewer(tk.Toplevel):
-    def __init__(self, parent):
+    def __init__(self, parent, tasks):
         super().__init__(parent)
         self.title("Inbox Viewer")
         self.geometry("900x600")
+        self.tasks = tasks
+        self.index = None  # opened on a worker; a new index is built by scanning the inbox
+        self.recipient = None
+        self.cursor = None  # next page of the selected recipient's messages, None when all are shown
+        self.loading_page = False
+        # bumped on every selection, so late results for an earlier one are dropped
+        self.list_generation = 0
+        self.preview_generation = 0
 
         left = ttk.Frame(self, padding=8)
         left.pack(side=tk.LEFT, fill=tk.Y)
 
         ttk.Label(left, text="Recipients (folders):").pack(anchor=tk.W)
-        self.listbox = tk.Listbox(left, width=40, height=30)
+        # exportselection=False: clicking a mail must not clear the recipient selection
+        self.listbox = tk.Listbox(left, width=40, height=30, exportselection=False)
         self.listbox.pack(fill=tk.Y)
         self.listbox.bind("<<ListboxSelect>>", self.on_select_recipient)
 
@@ -128,8 +281,13 @@ class InboxViewer(tk.Toplevel):
         middle.pack(side=tk.LEFT, fill=tk.Y)
 
         ttk.Label(middle, text="Mails:").pack(anchor=tk.W)
-        self.mail_list = tk.Listbox(middle, width=50, height=30)
-        self.mail_list.pack()
+        mail_frame = ttk.Frame(middle)
+        mail_frame.pack(fill=tk.Y, expand=True)
+        self.mail_list = tk.Listbox(mail_frame, width=50, height=30, exportselection=False)
+        self.mail_scroll = ttk.Scrollbar(mail_frame, orient=tk.VERTICAL, command=self.mail_list.yview)
+        self.mail_list.config(yscrollcommand=self.on_mail_scroll)
+        self.mail_list.pack(side=tk.LEFT, fill=tk.Y)
+        self.mail_scroll.pack(side=tk.LEFT, fill=tk.Y)
         self.mail_list.bind("<<ListboxSelect>>", self.on_select_mail)
 
         right = ttk.Frame(self, padding=8)
@@ -139,51 +297,95 @@ class InboxViewer(tk.Toplevel):
         self.content_text = tk.Text(right, wrap=tk.WORD)
         self.content_text.pack(fill=tk.BOTH, expand=True)
 
+        self.status_var = tk.StringVar(value="Loading recipients...")
+        ttk.Label(right, textvariable=self.status_var, anchor=tk.W).pack(fill=tk.X)
+
         self.load_recipients()
 
+    def _open_index(self):
+        self.index = self.index or MailIndex(INBOX_DIR)
+        return self.index.recipients()
+
+    def show_error(self, e):
+        self.status_var.set(f"❌ {e}")
+
     def load_recipients(self):
+        self.tasks.run(self._open_index, on_done=self.show_recipients, on_error=self.show_error)
+
+    def show_recipients(self, recipients):
         self.listbox.delete(0, tk.END)
-        if not os.path.isdir(INBOX_DIR):
-            return
-        for name in sorted(os.listdir(INBOX_DIR)):
-            path = os.path.join(INBOX_DIR, name)
-            if os.path.isdir(path):
-                self.listbox.insert(tk.END, name)
+        for rec in recipients:
+            self.listbox.insert(tk.END, rec['name'])
+        self.status_var.set(f"{len(recipients)} recipients")
 
     def on_select_recipient(self, event):
         sel = self.listbox.curselection()
-        if not sel:
+        if not sel or self.index is None:
             return
-        name = self.listbox.get(sel[0])
-        rec_folder = os.path.join(INBOX_DIR, name)
-        files = sorted(os.listdir(rec_folder))
+        self.recipient = self.listbox.get(sel[0])
+        self.list_generation += 1
         self.mail_list.delete(0, tk.END)
-        # show only body or eml files
-        for f in files:
-            self.mail_list.insert(tk.END, f)
+        self.cursor = None
+        self.load_page()
+
+    def load_page(self):
+        """Fetch the next MAIL_PAGE_SIZE messages of the selected recipient on a worker."""
+        if self.loading_page:
+            return
+        self.loading_page = True
+        self.status_var.set("Loading mails...")
+        generation = self.list_generation
+        self.tasks.run(self.index.messages_page, self.recipient, MAIL_PAGE_SIZE, self.cursor,
+                       on_done=lambda page: self.show_page(generation, page),
+                       on_error=lambda e: self.show_page_error(generation, e))
+
+    def show_page(self, generation, page):
+        self.loading_page = False
+        if generation != self.list_generation:
+            self.load_page()  # the recipient changed while this page was loading
+            return
+        entries, self.cursor = page
+        # newest first: the .eml, its body text, then its attachments
+        for entry in entries:
+            for f in [entry['eml'], entry['body']] + entry['attachments']:
+                if f:
+                    self.mail_list.insert(tk.END, f)
+        more = ", scroll for more" if self.cursor else ""
+        self.status_var.set(f"{self.mail_list.size()} files{more}")
+        # a short page may not fill the list, so there is nothing to scroll yet
+        if self.cursor and self.mail_list.yview()[1] >= 1.0:
+            self.load_page()
+
+    def show_page_error(self, generation, e):
+        self.loading_page = False
+        if generation == self.list_generation:
+            self.show_error(e)
+
+    def on_mail_scroll(self, first, last):
+        self.mail_scroll.set(first, last)
+        if self.cursor and not self.loading_page and float(last) > 0.9:
+            self.load_page()
 
     def on_select_mail(self, event):
-        sel = self.listbox.curselection()
         mail_sel = self.mail_list.curselection()
-        if not sel or not mail_sel:
+        if not self.recipient or not mail_sel:
             return
-        rec = self.listbox.get(sel[0])
+        rec = self.recipient
         fname = self.mail_list.get(mail_sel[0])
-        path = os.path.join(INBOX_DIR, rec, fname)
-        try:
-            # if binary (attachment), show info
-            with open(path, "rb") as f:
-                data = f.read()
-            # try decode as utf-8
-            try:
-                text = data.decode("utf-8")
-            except Exception:
-                text = f"[Binary file: {fname}] ({len(data)} bytes)\n\nFile path:\n{path}"
-            self.content_text.delete("1.0", tk.END)
-            self.content_text.insert(tk.END, text)
-        except Exception as e:
-            self.content_text.delete("1.0", tk.END)
-            self.content_text.insert(tk.END, f"Cannot open file: {e}")
+        self.preview_generation += 1
+        generation = self.preview_generation
+        self.status_var.set(f"Opening {fname}...")
+        # only the first PREVIEW_BYTES are read, on a worker, however big the file is
+        self.tasks.run(read_preview, rec, fname,
+                       on_done=lambda result: self.show_preview(generation, fname, *result),
+                       on_error=lambda e: self.show_preview(generation, fname, None, f"Cannot open file: {e}"))
+
+    def show_preview(self, generation, fname, size, text):
+        if generation != self.preview_generation:
+            return  # another mail was selected meanwhile
+        self.content_text.delete("1.0", tk.END)
+        self.content_text.insert(tk.END, text)
+        self.status_var.set(fname if size is None else f"{fname} ({size} bytes)")
 
 if __name__ == "__main__":
     app = SMTPApp()
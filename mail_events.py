@@ -0,0 +1,73 @@
+# mail_events.py - new-message events from server.py to the web gateway
+import asyncio
+import json
+import time
+
+EVENTS_HOST = "localhost"
+EVENTS_PORT = 8788  # the web gateway listens here; server.py connects and publishes
+CONNECT_TIMEOUT = 1.0
+RETRY_INTERVAL = 5.0  # seconds between reconnect attempts while the gateway is down
+MAX_PENDING_BYTES = 1024 * 1024  # drop events instead of buffering more for a stuck gateway
+
+
+class EventPublisher:
+    """Sends newline-delimited JSON events to the gateway over a local TCP socket.
+
+    Publishing is best effort: if the gateway is not running, events are
+    dropped and delivery carries on unaffected.
+    """
+
+    def __init__(self, host=EVENTS_HOST, port=EVENTS_PORT):
+        self.host = host
+        self.port = port
+        self.writer = None
+        self.retry_at = 0.0
+        self.lock = None
+
+    async def publish(self, event):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                if time.monotonic() < self.retry_at:
+                    return
+                try:
+                    _, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError):
+                    self.writer = None
+                    self.retry_at = time.monotonic() + RETRY_INTERVAL
+                    return
+            if self.writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+                return
+            self.writer.write(json.dumps(event).encode("utf-8") + b"\n")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def serve_events(on_event, host=EVENTS_HOST, port=EVENTS_PORT):
+    """Start the listener side; on_event(event) is awaited for every event received."""
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                await on_event(event)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Gateway shutting down; nothing left to hand the event to
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,386 @@
+# mail_index.py - SQLite index of delivered messages, kept up to date by server.py
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from mailstore import open_store
+
+INDEX_FILE_NAME = ".index.sqlite3"  # lives inside the mailbox dir
+SEARCH_TEXT_LIMIT = 64 * 1024  # characters of body text put into the search index
+SEARCH_RANK_WINDOW = 5000  # only the newest this-many matches are ranked, which bounds query time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    sender TEXT,
+    subject TEXT,
+    size INTEGER,
+    eml TEXT,
+    body TEXT,
+    attachments TEXT,
+    has_attachments INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, ts);
+CREATE INDEX IF NOT EXISTS messages_with_attachments ON messages (recipient, has_attachments, ts, id);
+CREATE TABLE IF NOT EXISTS recipients (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Full-text index over the same rows (rowid = messages.id)
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    sender, subject, text, attachments, recipient,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def search_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = ['"' + word + '"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def make_snippet(text, words, width=12):
+    """Return about width words of text around the first search word, with matches in [brackets]."""
+    prefixes = [word.lower() for word in words]
+    tokens = text.split()
+    hit = lambda token: any(token.lower().strip(".,;:!?()\"'<>").startswith(p) for p in prefixes)
+    first = next((i for i, token in enumerate(tokens) if hit(token)), 0)
+    start = max(0, first - width // 3)
+    shown = [f"[{token}]" if hit(token) else token for token in tokens[start:start + width]]
+    return ("…" if start else "") + " ".join(shown) + ("…" if start + width < len(tokens) else "")
+
+
+class MailIndex:
+    """Per-message metadata (one row per recipient copy) stored next to the mailbox.
+
+    server.py adds rows as it delivers, so listings and recipient counts are
+    answered from here instead of walking the folders.
+    """
+
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path or os.path.join(root, INDEX_FILE_NAME)
+        os.makedirs(root, exist_ok=True)
+        is_new = not os.path.exists(self.path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # Searches get a connection (and lock) of their own: a slow ranking
+        # query must not hold up the listings and deliveries that use self.conn
+        self.search_lock = threading.Lock()
+        self.search_conn = None
+        with self.lock:
+            # WAL lets the web gateway read while the SMTP server writes
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(messages)")]
+            if columns and "has_attachments" not in columns:
+                # Index written before the attachments filter had its own column
+                with self.conn:
+                    self.conn.execute("ALTER TABLE messages ADD COLUMN has_attachments INTEGER NOT NULL DEFAULT 0")
+                    self.conn.execute("UPDATE messages SET has_attachments = attachments != '[]'")
+            self.conn.executescript(SCHEMA)
+            columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(recipients)")]
+            if "bytes" not in columns:
+                # Index written before quotas existed; per-recipient usage is derived once
+                with self.conn:
+                    self.conn.execute("ALTER TABLE recipients ADD COLUMN bytes INTEGER NOT NULL DEFAULT 0")
+                    self.conn.execute(
+                        "UPDATE recipients SET bytes = (SELECT COALESCE(SUM(size), 0) FROM messages"
+                        " WHERE messages.recipient = recipients.name)")
+            has_search = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+            self.conn.executescript(SEARCH_SCHEMA)
+            has_rows = self.conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+        if is_new and any(not name.startswith(".") for name in os.listdir(root)):
+            self.rebuild()
+        elif has_rows and not has_search:
+            # Index written before search existed; fill the search table once
+            self.rebuild()
+
+    def add(self, entries):
+        """Record delivered messages; entries are dicts with the messages columns."""
+        with self.lock, self.conn:
+            self._insert(entries)
+
+    def _insert(self, entries):
+        # A message rebuild() already picked up from the folders is not added twice
+        for entry in entries:
+            if self.conn.execute("SELECT 1 FROM messages WHERE recipient = ? AND ts = ?",
+                                 (entry["recipient"], entry["ts"])).fetchone():
+                continue
+            cur = self.conn.execute(
+                "INSERT INTO messages (recipient, ts, sender, subject, size, eml, body, attachments,"
+                " has_attachments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry["recipient"], entry["ts"], entry.get("sender", ""), entry.get("subject", ""),
+                 entry.get("size", 0), entry.get("eml", ""), entry.get("body", ""),
+                 json.dumps(entry.get("attachments", [])), bool(entry.get("attachments"))),
+            )
+            attachment_names = [f.split("__", 1)[-1] for f in entry.get("attachments", [])]
+            self.conn.execute(
+                "INSERT INTO messages_fts (rowid, sender, subject, text, attachments, recipient)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (cur.lastrowid, entry.get("sender", ""), entry.get("subject", ""),
+                 entry.get("text", "")[:SEARCH_TEXT_LIMIT], " ".join(attachment_names), entry["recipient"]),
+            )
+            self.conn.execute(
+                "INSERT INTO recipients (name, count, bytes) VALUES (?, 1, ?)"
+                " ON CONFLICT(name) DO UPDATE SET count = count + 1, bytes = bytes + excluded.bytes",
+                (entry["recipient"], entry.get("size", 0)),
+            )
+
+    def remove(self, ids):
+        """Drop messages by id (used by retention) and take them off the recipient totals."""
+        if not ids:
+            return
+        marks = ",".join("?" * len(ids))
+        with self.lock, self.conn:
+            totals = self.conn.execute(
+                f"SELECT recipient, COUNT(*) AS n, COALESCE(SUM(size), 0) AS size FROM messages"
+                f" WHERE id IN ({marks}) GROUP BY recipient", ids).fetchall()
+            self.conn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+            self.conn.execute(f"DELETE FROM messages_fts WHERE rowid IN ({marks})", ids)
+            for row in totals:
+                self.conn.execute(
+                    "UPDATE recipients SET count = MAX(count - ?, 0), bytes = MAX(bytes - ?, 0) WHERE name = ?",
+                    (row["n"], row["size"], row["recipient"]))
+
+    def usage(self, recipient):
+        """Return (message count, bytes) currently stored for a recipient."""
+        with self.lock:
+            row = self.conn.execute("SELECT count, bytes FROM recipients WHERE name = ?", (recipient,)).fetchone()
+        return (row["count"], row["bytes"]) if row else (0, 0)
+
+    def expired(self, recipient, before_ts=None, keep_messages=0, keep_bytes=0, limit=500):
+        """Return up to `limit` of a recipient's messages that fall outside the given limits, oldest first.
+
+        A message is expired if its ts sorts before before_ts, or if it is not
+        among the newest keep_messages, or if the newest messages up to and
+        including it add up to more than keep_bytes. 0 / None means no limit.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM ("
+                " SELECT *, ROW_NUMBER() OVER newest AS rank, SUM(size) OVER newest AS running"
+                " FROM messages WHERE recipient = ?"
+                " WINDOW newest AS (ORDER BY ts DESC, id DESC ROWS UNBOUNDED PRECEDING)"
+                ") WHERE ts < ? OR rank > ? OR running > ? ORDER BY ts, id LIMIT ?",
+                (recipient, before_ts or "", keep_messages or 2 ** 62, keep_bytes or 2 ** 62, limit),
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def recipients(self):
+        """Return [{'name', 'count'}] for every recipient folder, sorted by name."""
+        with self.lock:
+            rows = self.conn.execute("SELECT name, count FROM recipients ORDER BY name").fetchall()
+        return [{'name': row['name'], 'count': row['count']} for row in rows]
+
+    def messages(self, recipient):
+        """Return the messages for one recipient, newest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM messages WHERE recipient = ? ORDER BY ts DESC, id DESC", (recipient,)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def messages_page(self, recipient, limit, cursor=None, newest_first=True, with_attachments=False):
+        """Return (entries, next_cursor) for one page of a recipient's messages.
+
+        Uses keyset pagination on (ts, id), so the cost depends on the page
+        size rather than on how many messages the folder holds. cursor is the
+        next_cursor value from the previous page.
+        """
+        sql = "SELECT * FROM messages WHERE recipient = ?"
+        params = [recipient]
+        if with_attachments:
+            # Part of the messages_with_attachments key, so the filter never scans the whole folder
+            sql += " AND has_attachments = 1"
+        if cursor:
+            ts, _, last_id = cursor.rpartition(":")
+            op = "<" if newest_first else ">"
+            sql += f" AND (ts {op} ? OR (ts = ? AND id {op} ?))"
+            params += [ts, ts, int(last_id)]
+        order = "DESC" if newest_first else "ASC"
+        sql += f" ORDER BY ts {order}, id {order} LIMIT ?"
+        params.append(limit + 1)  # one extra row tells us whether another page exists
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        entries = [self._row_to_dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = f"{last['ts']}:{last['id']}"
+        return entries, next_cursor
+
+    def search(self, text, limit=20, offset=0, recipient=None):
+        """Ranked full-text search; returns (hits, next_offset or None, truncated).
+
+        Subject and sender matches weigh more than body text. Each hit carries
+        the message's index fields plus a highlighted snippet. Ranking every
+        match of a very common word is slow, so only the newest
+        SEARCH_RANK_WINDOW matches (by rowid) are ranked; truncated is True
+        when there were more matches than that.
+        """
+        query = search_query(text)
+        if query is None:
+            return [], None, False
+        matches = "FROM messages_fts WHERE messages_fts MATCH ?"
+        params = [query]
+        if recipient:
+            # The FTS column narrows the candidates, but unicode61 splits folder
+            # names on "_", so the exact mailbox is checked against messages
+            quoted = recipient.replace('"', '""')
+            params = [f'recipient : "{quoted}" AND ({query})', recipient]
+            matches = ("FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+                       " WHERE messages_fts MATCH ? AND m.recipient = ?")
+        with self.search_lock:
+            conn = self._search_conn()
+            # One match past the window is fetched (and left unranked) to tell whether it was full
+            rows = conn.execute(
+                "SELECT id, matched FROM ("
+                " SELECT id, score, COUNT(*) OVER () AS matched, ROW_NUMBER() OVER (ORDER BY id DESC) AS pos"
+                " FROM (SELECT messages_fts.rowid AS id, bm25(messages_fts, 5.0, 10.0, 1.0, 3.0, 0.0) AS score"
+                f"  {matches} ORDER BY messages_fts.rowid DESC LIMIT ?)"
+                ") WHERE pos <= ? ORDER BY score, id DESC LIMIT ? OFFSET ?",
+                (*params, SEARCH_RANK_WINDOW + 1, SEARCH_RANK_WINDOW, limit + 1, offset),
+            ).fetchall()
+            ranked = [row["id"] for row in rows]
+            truncated = bool(rows) and rows[0]["matched"] > SEARCH_RANK_WINDOW
+            hits = []
+            for rowid in ranked[:limit]:
+                # Plain rowid lookups; FTS5 snippet() would re-run the MATCH for every hit
+                row = conn.execute(
+                    "SELECT m.*, messages_fts.text AS text FROM messages m"
+                    " JOIN messages_fts ON messages_fts.rowid = m.id WHERE m.id = ?", (rowid,)
+                ).fetchone()
+                if row is not None:
+                    entry = self._row_to_dict(row)
+                    entry["snippet"] = make_snippet(entry.pop("text"), re.findall(r"\w+", text))
+                    hits.append(entry)
+        return hits, (offset + limit if len(ranked) > limit else None), truncated
+
+    def _search_conn(self):
+        # Called with search_lock held
+        if self.search_conn is None:
+            self.search_conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.search_conn.row_factory = sqlite3.Row
+            self.search_conn.execute("PRAGMA query_only = ON")
+        return self.search_conn
+
+    @staticmethod
+    def _row_to_dict(row):
+        entry = dict(row)
+        entry['attachments'] = json.loads(entry['attachments'] or "[]")
+        return entry
+
+    def rebuild(self):
+        """Re-create the index from the files already under the mailbox dir.
+
+        Safe while server.py delivers: rows other processes add after the scan
+        starts are kept, and only rows older than the scan are replaced, in
+        one transaction.
+        """
+        with self.lock:
+            scanned_before = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        store = open_store(self.root)
+        entries = []
+        for name in store.list_recipients():
+            entries.extend(scan_folder(store, name))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM messages WHERE id <= ?", (scanned_before,))
+                self.conn.execute("DELETE FROM messages_fts WHERE rowid <= ?", (scanned_before,))
+                self._insert(entries)
+                self.conn.execute("DELETE FROM recipients")
+                self.conn.execute(
+                    "INSERT INTO recipients (name, count, bytes)"
+                    " SELECT recipient, COUNT(*), COALESCE(SUM(size), 0) FROM messages GROUP BY recipient")
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return len(entries)
+
+    def close(self):
+        with self.search_lock:
+            if self.search_conn is not None:
+                self.search_conn.close()
+                self.search_conn = None
+        with self.lock:
+            self.conn.close()
+
+
+def scan_folder(store, recipient):
+    """Group the mail_/body_/attachment items of one recipient into index entries."""
+    by_ts = {}
+    for fname in store.list_entries(recipient):
+        if fname.startswith("mail_") and fname.endswith(".eml"):
+            by_ts.setdefault(fname[5:-4], {})["eml"] = fname
+        elif fname.startswith("body_") and fname.endswith(".txt"):
+            by_ts.setdefault(fname[5:-4], {})["body"] = fname
+        elif "__" in fname:
+            by_ts.setdefault(fname.split("__", 1)[0], {}).setdefault("attachments", []).append(fname)
+
+    entries = []
+    for ts, files in sorted(by_ts.items()):
+        entry = {
+            "recipient": recipient,
+            "ts": ts,
+            "eml": files.get("eml", ""),
+            "body": files.get("body", ""),
+            "attachments": sorted(files.get("attachments", [])),
+            "sender": "",
+            "subject": "",
+            "text": "",
+            "size": 0,
+        }
+        if entry["eml"]:
+            try:
+                with store.open_item(recipient, entry["eml"]) as f:
+                    entry["size"] = f.size
+            except OSError:
+                pass
+        if entry["body"]:
+            # body_<ts>.txt starts with the From/To/Subject lines written by server.py
+            try:
+                with store.open_item(recipient, entry["body"]) as f:
+                    data = f.read(4 * SEARCH_TEXT_LIMIT)
+            except OSError:
+                data = b""
+            head, _, text = data.decode("utf-8", errors="replace").partition("\n\n")
+            for line in head.splitlines():
+                if line.startswith("From: "):
+                    entry["sender"] = line[6:].strip()
+                elif line.startswith("Subject: "):
+                    entry["subject"] = line[9:].strip()
+            entry["text"] = text[:SEARCH_TEXT_LIMIT]
+        entries.append(entry)
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the inbox metadata index")
+    parser.add_argument("--inbox", default="inbox", help="mailbox directory")
+    parser.add_argument("--rebuild", action="store_true", help="re-scan the mailbox and rebuild the index")
+    args = parser.parse_args()
+    index = MailIndex(args.inbox)
+    if args.rebuild:
+        count = index.rebuild()
+        print(f"✅ Index rebuilt: {count} messages")
+    for rec in index.recipients():
+        print(f"{rec['name']}: {rec['count']}")
+    index.close()
@@ -0,0 +1,357 @@
+# mailstore.py - content-addressed storage shared by the server and both clients
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+BLOB_DIR_NAME = ".blobs"  # lives inside the mailbox dir; hidden from recipient listings
+SPOOL_DIR_NAME = ".spool"  # large incoming messages and decoded attachments in progress
+REF_SUFFIX = ".ref"  # fallback reference file when hardlinks are not available
+COPY_CHUNK = 1024 * 1024  # bytes read at a time when hashing or spooling files
+BLOB_GRACE = 3600  # seconds an unreferenced blob is kept, so compaction never races a delivery
+FORMAT_FILE_NAME = ".format"  # says which backend wrote the mailbox; missing means "files"
+STORE_FORMATS = ("files", "segments")
+
+
+def safe_recipient(rcpt):
+    """Turn an address into the folder name used under the mailbox dir."""
+    return rcpt.replace("@", "_at_").replace(".", "_")
+
+
+def message_stamp():
+    """Return a new message's file name stem: sortable by time, unique across processes."""
+    return f"{datetime.now():%Y%m%d_%H%M%S_%f}_{secrets.token_hex(4)}"
+
+
+def check_item_name(recipient, filename):
+    """Reject recipient/filename pairs that would escape the mailbox."""
+    for part in (recipient, filename):
+        if not part or part.startswith(".") or os.path.basename(part) != part:
+            raise ValueError(f"Invalid mailbox path: {recipient}/{filename}")
+
+
+def attachment_names(filenames, fallback):
+    """Turn the file names of one message's attachments into distinct, plain item names.
+
+    Directory parts and leading dots are dropped, so a name never leaves the
+    recipient folder, and repeats get a -1, -2, ... suffix before the extension.
+    """
+    names = []
+    for filename in filenames:
+        name = os.path.basename((filename or "").replace("\\", "/")).lstrip(".").replace("\0", "")
+        name = name or fallback
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 0
+        while candidate in names:
+            n += 1
+            candidate = f"{stem}-{n}{ext}"
+        names.append(candidate)
+    return names
+
+
+def read_format(root):
+    """Return (format, options) recorded for the mailbox at root."""
+    try:
+        with open(os.path.join(root, FORMAT_FILE_NAME), encoding="utf-8") as f:
+            settings = json.load(f)
+    except FileNotFoundError:
+        return "files", {}
+    return settings.pop("format", "files"), settings
+
+
+def write_format(root, fmt, **options):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, FORMAT_FILE_NAME), "w", encoding="utf-8") as f:
+        json.dump({"format": fmt, **options}, f)
+
+
+def open_store(root):
+    """Return the store that reads and writes the mailbox at root, in whatever format it uses."""
+    fmt, options = read_format(root)
+    if fmt == "segments":
+        from segmentstore import SegmentStore  # segmentstore builds on this module
+        return SegmentStore(root, **options)
+    return MailStore(root)
+
+
+@dataclass
+class Item:
+    """One file of a delivered message (mail_<ts>.eml, body_<ts>.txt or an attachment)."""
+    name: str
+    data: bytes = b""
+    path: str = ""  # set instead of data for payloads already spooled to disk
+    digest: str = ""  # sha256 of the payload, when already known
+
+
+class ItemFile:
+    """Read-only file object over one stored item: a whole file, or a byte range of a larger one."""
+
+    def __init__(self, f, offset=0, size=None):
+        self.f = f
+        self.offset = offset
+        self.size = os.fstat(f.fileno()).st_size - offset if size is None else size
+        self.pos = 0
+
+    def read(self, n=-1):
+        remaining = self.size - self.pos
+        n = remaining if n is None or n < 0 else min(n, remaining)
+        if n <= 0:
+            return b""
+        self.f.seek(self.offset + self.pos)
+        data = self.f.read(n)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MailStore:
+    """Stores each payload once under .blobs/ and links it into recipient folders.
+
+    Recipient folders hold hardlinks to the blobs, so readers can open them like
+    normal files. If the filesystem refuses hardlinks, a small "<name>.ref" file
+    containing the blob path is written instead; resolve() follows it.
+
+    write_items / list_recipients / list_entries / open_item are the storage
+    API shared with SegmentStore; everything else is specific to this layout.
+    """
+
+    format = "files"
+
+    def __init__(self, root):
+        self.root = root
+        self.blob_root = os.path.join(root, BLOB_DIR_NAME)
+        self.spool_root = os.path.join(root, SPOOL_DIR_NAME)
+
+    # ---- writing -------------------------------------------------------
+
+    def write_items(self, recipients, items):
+        """Store items (a list of Item) for every recipient folder name (blocking).
+
+        Each payload is written once and hardlinked into all the folders.
+        """
+        for recipient in recipients:
+            for item in items:
+                check_item_name(recipient, item.name)
+        for item in items:
+            suffix = os.path.splitext(item.name)[1]
+            if item.path:
+                blob = self.put_blob_file(item.path, suffix, item.digest or None)
+            else:
+                blob = self.put_blob(item.data, suffix)
+            for recipient in recipients:
+                folder = os.path.join(self.root, recipient)
+                os.makedirs(folder, exist_ok=True)
+                self.link_blob(blob, os.path.join(folder, item.name))
+
+    def put_blob(self, data, suffix=""):
+        """Store data under its SHA-256 and return the blob path (no-op if present)."""
+        digest = hashlib.sha256(data).hexdigest()
+        folder = os.path.join(self.blob_root, digest[:2])
+        path = os.path.join(folder, digest + suffix)
+        if os.path.exists(path):
+            os.utime(path)  # freshly used again; see compact()
+            return path
+        os.makedirs(folder, exist_ok=True)
+        # Write to a temp file first so readers never see a half-written blob
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def put_blob_file(self, path, suffix="", digest=None):
+        """Move an already-written file into the blob store and return the blob path.
+
+        The file must live on the same filesystem (e.g. under .spool/), so this is
+        a rename rather than a copy. Pass digest if it was computed while writing.
+        """
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+        folder = os.path.join(self.blob_root, digest[:2])
+        blob_path = os.path.join(folder, digest + suffix)
+        if os.path.exists(blob_path):
+            os.utime(blob_path)
+            os.remove(path)
+            return blob_path
+        os.makedirs(folder, exist_ok=True)
+        os.replace(path, blob_path)
+        return blob_path
+
+    def delete_items(self, recipient, names):
+        """Remove items from a recipient folder; their blobs go once compact() finds them unused."""
+        folder = os.path.join(self.root, recipient)
+        for name in names:
+            check_item_name(recipient, name)
+            for path in (os.path.join(folder, name), os.path.join(folder, name + REF_SUFFIX)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def compact(self, recipients=()):
+        """Delete blobs no recipient links to any more; returns the bytes freed.
+
+        A blob is unused when its link count is 1 and no .ref file names it.
+        Blobs touched within BLOB_GRACE are left alone, since a delivery may
+        be about to link them.
+        """
+        refs = set()
+        for recipient in self.list_recipients():
+            folder = os.path.join(self.root, recipient)
+            for name in os.listdir(folder):
+                if name.endswith(REF_SUFFIX):
+                    with open(os.path.join(folder, name), encoding="utf-8") as f:
+                        refs.add(os.path.normpath(os.path.join(self.root, f.read().strip())))
+        freed = 0
+        cutoff = time.time() - BLOB_GRACE
+        for dirpath, _, filenames in os.walk(self.blob_root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                if st.st_nlink == 1 and st.st_mtime < cutoff and os.path.normpath(path) not in refs:
+                    os.remove(path)
+                    freed += st.st_size
+        return freed
+
+    def discard(self, *paths):
+        """Remove leftover spool files; paths already moved into the store are ignored."""
+        for path in paths:
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def link_blob(self, blob_path, dest_path):
+        """Make dest_path refer to blob_path (hardlink, or a .ref file as fallback)."""
+        try:
+            os.link(blob_path, dest_path)
+            return dest_path
+        except FileExistsError:
+            raise
+        except OSError:
+            ref_path = dest_path + REF_SUFFIX
+            # Same temp-then-rename dance as put_blob, so readers never see an empty ref
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix=".tmp_")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(os.path.relpath(blob_path, self.root))
+            os.replace(tmp_path, ref_path)
+            return ref_path
+
+    # ---- reading -------------------------------------------------------
+
+    def list_recipients(self):
+        """Return the sorted recipient folder names (the blob store is skipped)."""
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            name for name in sorted(os.listdir(self.root))
+            if not name.startswith(".") and os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def list_entries(self, recipient):
+        """Return the item names stored for a recipient (.ref suffixes removed)."""
+        names = []
+        for name in os.listdir(os.path.join(self.root, recipient)):
+            if name.startswith("."):
+                continue
+            if name.endswith(REF_SUFFIX):
+                name = name[:-len(REF_SUFFIX)]
+            names.append(name)
+        return names
+
+    def open_item(self, recipient, filename):
+        """Open recipient/filename for reading; returns an ItemFile (use .size, .read, .seek)."""
+        check_item_name(recipient, filename)
+        return ItemFile(open(self.resolve(os.path.join(self.root, recipient, filename)), "rb"))
+
+    def resolve(self, path):
+        """Return the real file behind path, following a .ref file if needed."""
+        if os.path.exists(path):
+            return path
+        ref_path = path + REF_SUFFIX
+        if os.path.exists(ref_path):
+            with open(ref_path, encoding="utf-8") as f:
+                return os.path.join(self.root, f.read().strip())
+        return path
+
+
+class MessageSpool:
+    """Collects DATA in memory and spills it to a file under .spool/ past a threshold.
+
+    Disk writes happen in chunks on the default executor, so a session holds at
+    most threshold + COPY_CHUNK bytes no matter how big the message is.
+    """
+
+    def __init__(self, spool_dir, threshold):
+        self.spool_dir = spool_dir
+        self.threshold = threshold
+        self.buffer = bytearray()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+
+    async def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.buffer += data
+        if self.file is None and len(self.buffer) > self.threshold:
+            loop = asyncio.get_running_loop()
+            self.file, self.path = await loop.run_in_executor(None, self._open)
+        if self.file is not None and len(self.buffer) >= COPY_CHUNK:
+            await self._flush()
+
+    def _open(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, prefix="data_", suffix=".eml")
+        return os.fdopen(fd, "wb"), path
+
+    async def _flush(self):
+        chunk = bytes(self.buffer)
+        self.buffer = bytearray()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.file.write, chunk)
+
+    async def finish(self):
+        """Return the message bytes if it stayed small, else None (read it from .path)."""
+        if self.file is None:
+            return bytes(self.buffer)
+        await self._flush()
+        self.file.close()
+        return None
+
+    @property
+    def digest(self):
+        return self.hasher.hexdigest()
+
+    def discard(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,344 @@
+# message_pipeline.py - parse an incoming message once and hand the result to delivery
+import asyncio
+import binascii
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+
+PARSE_WORKERS = min(4, os.cpu_count() or 1)  # processes doing MIME decoding
+STREAM_LINE_LIMIT = 64 * 1024  # longest line read at once from a spooled message
+STREAM_HEADER_LIMIT = 256 * 1024  # header block size kept per MIME part
+STREAM_TEXT_LIMIT = 1024 * 1024  # plain-text body kept in memory for spooled messages
+
+
+@dataclass
+class Attachment:
+    filename: str  # may be empty; the store picks a name then
+    content_type: str
+    data: bytes = b""
+    path: str = ""  # set instead of data when the payload was decoded to a spool file
+    digest: str = ""  # sha256 of the decoded payload, when already known
+
+
+@dataclass
+class ExtractedMessage:
+    """Everything delivery needs from a message, decoded exactly once."""
+    mail_from: str
+    rcpt_tos: list
+    raw: bytes = b""
+    raw_path: str = ""  # set instead of raw for messages spooled to disk
+    raw_digest: str = ""
+    subject: str = ""
+    message_id: str = ""
+    date: str = ""
+    text: str = ""
+    attachments: list = field(default_factory=list)
+    timings: dict = field(default_factory=dict)  # stage name -> seconds, measured in the parse worker
+
+    def body_text(self):
+        """Text stored as body_<ts>.txt in each recipient folder."""
+        header = f"From: {self.mail_from}\nTo: {', '.join(self.rcpt_tos)}\nSubject: {self.subject}\n\n"
+        return header + (self.text if self.text else "[No plain text body]\n")
+
+
+def part_bytes(part):
+    """Decoded payload of an attachment part as bytes."""
+    data = part.get_payload(decode=True)
+    if data is None:
+        # message/* and multipart/* parts hold parsed messages rather than bytes
+        payload = part.get_payload()
+        inner = payload[0] if part.get_content_maintype() == "message" and payload else part
+        data = inner.as_bytes(policy=policy.SMTP)
+    return data
+
+
+def part_kind(content_type, disposition, filename, top_level):
+    """How a leaf MIME part is treated: "text" (body text), "attachment" or "skip".
+
+    Shared by extract_message and extract_message_file, so a message yields
+    the same body and attachments whichever path parsed it.
+    """
+    if content_type == "text/plain" and disposition is None:
+        return "text"
+    if disposition == "attachment" or filename or (not top_level and not content_type.startswith("text/")):
+        return "attachment"
+    # Alternative bodies such as text/html are not extracted
+    return "skip"
+
+
+def decode_text(data, charset):
+    """Body text from a part's decoded bytes, with \n line endings."""
+    try:
+        text = data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        text = data.decode("utf-8", errors="replace")
+    return text.replace("\r\n", "\n")
+
+
+def leaf_parts(part, top_level=True):
+    """Yield (part, top_level) for every non-multipart part, depth first.
+
+    message/* parts are leaves: a forwarded message is one attachment, its
+    own parts are not unpacked.
+    """
+    if part.get_content_maintype() == "multipart" and part.is_multipart():
+        for sub in part.iter_parts():
+            yield from leaf_parts(sub, top_level=False)
+    else:
+        yield part, top_level
+
+
+def extract_message(mail_from, rcpt_tos, raw):
+    """Parse raw bytes and pull out headers, plain-text body and decoded attachments."""
+    started = time.perf_counter()
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    parsed = time.perf_counter()
+
+    text = ""
+    attachments = []
+    for part, top_level in leaf_parts(msg):
+        kind = part_kind(part.get_content_type(), part.get_content_disposition(), part.get_filename(), top_level)
+        if kind == "text":
+            text += decode_text(part.get_payload(decode=True) or b"", part.get_content_charset())
+        elif kind == "attachment":
+            attachments.append(Attachment(part.get_filename() or "", part.get_content_type(), part_bytes(part)))
+
+    # raw is left out: the caller already holds it, and a process pool would pickle it back
+    return ExtractedMessage(
+        mail_from=mail_from,
+        rcpt_tos=list(rcpt_tos),
+        subject=str(msg.get('subject', '')),
+        message_id=str(msg.get('message-id', '')),
+        date=str(msg.get('date', '')),
+        text=text,
+        attachments=attachments,
+        timings={'parse': parsed - started, 'extract': time.perf_counter() - parsed},
+    )
+
+
+class _PartSink:
+    """Receives the transfer-encoded body lines of one MIME part and decodes them."""
+
+    def __init__(self, kind, encoding, path=None, limit=0):
+        self.kind = kind  # "text", "attachment" or "skip"
+        self.encoding = encoding
+        self.b64_tail = b""
+        self.hasher = hashlib.sha256()
+        self.path = path
+        self.file = open(path, "wb") if path else None
+        self.limit = limit
+        self.kept = bytearray()
+        self.truncated = False
+
+    def write(self, line):
+        if self.encoding == "base64":
+            data = self.b64_tail + b"".join(line.split())
+            usable = len(data) - len(data) % 4
+            self.b64_tail = data[usable:]
+            try:
+                decoded = binascii.a2b_base64(data[:usable])
+            except binascii.Error:
+                decoded = b""
+        elif self.encoding == "quoted-printable":
+            decoded = binascii.a2b_qp(line)
+        else:
+            decoded = line
+        self._emit(decoded)
+
+    def _emit(self, data):
+        if not data:
+            return
+        if self.file is not None:
+            self.hasher.update(data)
+            self.file.write(data)
+        elif len(self.kept) < self.limit:
+            self.kept += data[:self.limit - len(self.kept)]
+            self.truncated = self.truncated or len(self.kept) >= self.limit
+        else:
+            self.truncated = True
+
+    def close(self):
+        if self.b64_tail:
+            # Tolerate missing padding at the very end of the part
+            padded = self.b64_tail + b"=" * (-len(self.b64_tail) % 4)
+            self.b64_tail = b""
+            try:
+                self._emit(binascii.a2b_base64(padded))
+            except binascii.Error:
+                pass
+        if self.file is not None:
+            self.file.close()
+
+
+class _StreamingParser:
+    """Line-based MIME walker that never holds more than one line of a part body.
+
+    Attachments are decoded straight into files under work_dir; inline
+    text/plain parts are collected up to STREAM_TEXT_LIMIT.
+    """
+
+    def __init__(self, f, work_dir):
+        self.f = f
+        self.work_dir = work_dir
+        self.text = []
+        self.text_len = 0
+        self.attachments = []
+        self.temp_paths = []
+
+    def lines(self):
+        while True:
+            line = self.f.readline(STREAM_LINE_LIMIT)
+            if not line:
+                return
+            yield line
+
+    def read_headers(self, lines):
+        block = bytearray()
+        for line in lines:
+            if line in (b"\r\n", b"\n"):
+                break
+            if len(block) < STREAM_HEADER_LIMIT:
+                block += line
+        return BytesHeaderParser(policy=policy.default).parsebytes(bytes(block))
+
+    @staticmethod
+    def match_boundary(line, boundaries):
+        """Return (boundary, is_close) if line is a delimiter for one of boundaries."""
+        if not line.startswith(b"--"):
+            return None
+        stripped = line.rstrip()
+        for boundary in reversed(boundaries):
+            if stripped == b"--" + boundary:
+                return boundary, False
+            if stripped == b"--" + boundary + b"--":
+                return boundary, True
+        return None
+
+    def skip_until(self, lines, boundaries):
+        for line in lines:
+            found = self.match_boundary(line, boundaries)
+            if found:
+                return found
+        return None
+
+    def parse_body(self, lines, headers, boundaries, top_level=False):
+        """Consume one part body and return the delimiter that ended it (None at EOF)."""
+        if headers.get_content_maintype() == "multipart" and headers.get_boundary():
+            boundary = headers.get_boundary().encode("ascii", "replace")
+            inner = boundaries + [boundary]
+            found = self.skip_until(lines, inner)  # preamble
+            while found is not None and found == (boundary, False):
+                found = self.parse_body(lines, self.read_headers(lines), inner)
+            if found == (boundary, True):
+                found = self.skip_until(lines, boundaries)  # epilogue
+            return found
+
+        sink = self.open_sink(headers, top_level)
+        found = None
+        previous = None
+        for line in lines:
+            found = self.match_boundary(line, boundaries)
+            if found:
+                break
+            if previous is not None:
+                sink.write(previous)
+            previous = line
+        if previous is not None:
+            # The line break before a delimiter belongs to the delimiter
+            sink.write(previous.rstrip(b"\r\n") if found else previous)
+        self.close_sink(sink, headers)
+        return found
+
+    def open_sink(self, headers, top_level):
+        encoding = headers.get("content-transfer-encoding", "7bit").strip().lower()
+        kind = part_kind(headers.get_content_type(), headers.get_content_disposition(),
+                         headers.get_filename(), top_level)
+        if kind == "text":
+            return _PartSink("text", encoding, limit=max(STREAM_TEXT_LIMIT - self.text_len, 0))
+        if kind == "attachment":
+            fd, path = tempfile.mkstemp(dir=self.work_dir, prefix="att_")
+            os.close(fd)
+            self.temp_paths.append(path)
+            return _PartSink("attachment", encoding, path=path)
+        return _PartSink("skip", encoding)
+
+    def close_sink(self, sink, headers):
+        sink.close()
+        if sink.kind == "text":
+            text = decode_text(bytes(sink.kept), headers.get_content_charset())
+            if sink.truncated:
+                text += "\n[... text truncated ...]\n"
+            self.text.append(text)
+            self.text_len += len(sink.kept)
+        elif sink.kind == "attachment":
+            self.attachments.append(Attachment(
+                headers.get_filename() or "", headers.get_content_type(),
+                path=sink.path, digest=sink.hasher.hexdigest()))
+
+
+def extract_message_file(mail_from, rcpt_tos, path, digest, work_dir):
+    """Streaming variant of extract_message for messages spooled to disk.
+
+    Attachments are decoded chunk by chunk into files under work_dir, so memory
+    use does not grow with the message size.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        parser = _StreamingParser(f, work_dir)
+        lines = parser.lines()
+        headers = parser.read_headers(lines)
+        try:
+            parser.parse_body(lines, headers, [], top_level=True)
+        except BaseException:
+            for temp_path in parser.temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            raise
+
+    return ExtractedMessage(
+        mail_from=mail_from,
+        rcpt_tos=list(rcpt_tos),
+        raw_path=path,
+        raw_digest=digest,
+        subject=str(headers.get('subject', '')),
+        message_id=str(headers.get('message-id', '')),
+        date=str(headers.get('date', '')),
+        text="".join(parser.text),
+        attachments=parser.attachments,
+        # Decoding happens while parsing here, so there is no separate extract stage
+        timings={'parse': time.perf_counter() - started},
+    )
+
+
+class ParsePipeline:
+    """Runs extract_message on a worker pool so MIME decoding never holds the event loop.
+
+    With workers > 0 a process pool is used, which also keeps decoding off the
+    GIL; workers == 0 falls back to a single background thread.
+    """
+
+    def __init__(self, workers=PARSE_WORKERS):
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mime-parser")
+
+    async def extract(self, mail_from, rcpt_tos, raw):
+        loop = asyncio.get_running_loop()
+        extracted = await loop.run_in_executor(self.executor, extract_message, mail_from, list(rcpt_tos), raw)
+        extracted.raw = raw
+        return extracted
+
+    async def extract_file(self, mail_from, rcpt_tos, path, digest, work_dir):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, extract_message_file, mail_from, list(rcpt_tos), path, digest, work_dir)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,132 @@
+# metrics.py - counters, latency histograms and a Prometheus text endpoint for server.py and web_server.py
+import asyncio
+import json
+import threading
+from datetime import datetime
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+METRICS_HOST = "localhost"
+GATEWAY_METRICS_PORT = 9101  # web_server.py
+SERVER_METRICS_PORT = 9102  # server.py (worker N of --workers uses 9102 + N - 1)
+SLOW_THRESHOLD = 1.0  # seconds before a message or request is written to the slow log
+
+
+def format_labels(labels, extra=()):
+    """Render label pairs as {key="value",...} (empty string when there are none)."""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    """Process-local counters, gauges and histograms, rendered in the Prometheus text format.
+
+    Safe to update from the event loop and from worker threads alike.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}  # name -> (type, help text)
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [per-bucket counts..., sum, count]}
+        self.gauges = {}  # name -> callable returning the current value
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def gauge(self, name, func, text=""):
+        """Register a value that is read when the metrics are scraped."""
+        self.gauges[name] = func
+        self.describe(name, "gauge", text)
+
+    def render(self):
+        lines = []
+
+        def header(name, kind):
+            text = self.help.get(name, (kind, ""))[1]
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                header(name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for labels, values in sorted(series.items()):
+                    for bound, count in zip(LATENCY_BUCKETS, values):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {values[-2]:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        for name, func in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+class SlowLog:
+    """Appends one JSON line for every message or request that took at least `threshold` seconds."""
+
+    def __init__(self, path, threshold=SLOW_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+
+    def check(self, seconds, **details):
+        """Log the entry if it was slow; returns True when it was."""
+        if not self.path or seconds < self.threshold:
+            return False
+        record = {'time': datetime.now().isoformat(), 'seconds': round(seconds, 4), **details}
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        return True
+
+
+async def serve_metrics(metrics, host=METRICS_HOST, port=SERVER_METRICS_PORT):
+    """Answer GET /metrics with metrics.render(); returns the asyncio server."""
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # headers are not needed
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         "Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
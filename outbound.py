@@ -0,0 +1,356 @@
+# outbound.py - pooled, non-blocking SMTP sending for the asyncio web gateway
+import argparse
+import asyncio
+import base64
+import json
+import queue
+import secrets
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+OUTBOUND_CONCURRENCY = 4  # SMTP sessions (and sends) in flight at once
+OUTBOUND_IDLE_TIMEOUT = 30.0  # seconds an unused session stays open
+OUTBOUND_TIMEOUT = 10  # socket timeout per SMTP session
+ENCODE_CHUNK = 57 * 4096  # attachment bytes base64-encoded at a time (57 bytes = one 76-character line)
+DATA_CHUNK = 256 * 1024  # bytes of a queued file sent to the socket at a time
+DATA_LINE_LIMIT = 64 * 1024  # longest piece of a line read from a queued file at once
+
+
+class SMTPSessionPool:
+    """Keeps persistent smtplib sessions open and sends through them off the event loop.
+
+    smtplib is blocking, so every SMTP exchange runs on a small thread pool;
+    the asyncio side only awaits it. A session is reused for the next message
+    after an RSET, and closed once it has been idle for idle_timeout seconds.
+    """
+
+    def __init__(self, host, port, concurrency=OUTBOUND_CONCURRENCY,
+                 idle_timeout=OUTBOUND_IDLE_TIMEOUT, timeout=OUTBOUND_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="smtp-out")
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.idle = []  # [(session, last used)], only touched on the event loop
+        self.reaper = None
+
+    async def send(self, msg, from_addr=None, to_addrs=None):
+        """Send an EmailMessage; returns smtplib's dict of refused recipients."""
+        async with self.semaphore:
+            session = self.idle.pop()[0] if self.idle else None
+            loop = asyncio.get_running_loop()
+            session, refused, error = await loop.run_in_executor(
+                self.executor, self._send_sync, session,
+                lambda s: s.send_message(msg, from_addr, to_addrs))
+            if session is not None:
+                self.idle.append((session, time.monotonic()))
+                # Started only now: a reaper started earlier would find no idle session and exit
+                self._start_reaper()
+            if error is not None:
+                raise error
+            return refused
+
+    async def send_file(self, path, from_addr, to_addrs):
+        """Send the message stored in the file at path; returns the dict of refused recipients.
+
+        The file is streamed to the server DATA_CHUNK at a time, so memory use
+        does not depend on the message size.
+        """
+        async with self.semaphore:
+            session = self.idle.pop()[0] if self.idle else None
+            loop = asyncio.get_running_loop()
+            session, refused, error = await loop.run_in_executor(
+                self.executor, self._send_sync, session,
+                lambda s: send_file_sync(s, path, from_addr, to_addrs))
+            if session is not None:
+                self.idle.append((session, time.monotonic()))
+                self._start_reaper()
+            if error is not None:
+                raise error
+            return refused
+
+    def _connect(self):
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    def _send_sync(self, session, deliver):
+        """Runs on the pool's threads; returns (reusable session or None, refused, error).
+
+        deliver(session) does the actual SMTP transaction and returns the
+        refused recipients.
+        """
+        if session is not None:
+            try:
+                session.rset()
+            except (smtplib.SMTPException, OSError):
+                # The server dropped the idle session; open a fresh one
+                self._close_sync(session)
+                session = None
+        try:
+            if session is None:
+                session = self._connect()
+            refused = deliver(session)
+            return session, refused, None
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            # The server answered, so the session itself is still fine
+            return session, {}, e
+        except Exception as e:
+            if session is not None:
+                self._close_sync(session)
+            return None, {}, e
+
+    async def send_many(self, messages, parallelism=None):
+        """Async generator yielding (index, refused, error) as each message finishes.
+
+        `parallelism` is how many tasks take messages off the batch, clamped to
+        1..the pool size (the default). It does not raise the number of sends
+        in flight: the pool's semaphore caps that at `concurrency` for all
+        callers together, and every send reuses the pool's persistent sessions.
+        """
+        results = asyncio.Queue()
+        items = iter(enumerate(messages))
+
+        async def worker():
+            for index, msg in items:
+                try:
+                    refused = await self.send(msg)
+                    await results.put((index, refused, None))
+                except Exception as e:
+                    await results.put((index, {}, e))
+
+        parallelism = max(1, min(parallelism or self.concurrency, self.concurrency))
+        workers = [asyncio.create_task(worker()) for _ in range(parallelism)]
+        try:
+            for _ in range(len(messages)):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+
+    @staticmethod
+    def _close_sync(session):
+        try:
+            session.quit()
+        except (smtplib.SMTPException, OSError):
+            session.close()
+
+    def _start_reaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.get_running_loop().create_task(self._reap_idle())
+
+    async def _reap_idle(self):
+        """Close sessions that have not been used for idle_timeout seconds."""
+        loop = asyncio.get_running_loop()
+        while self.idle:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            stale = [s for s, used in self.idle if now - used >= self.idle_timeout]
+            self.idle = [(s, used) for s, used in self.idle if now - used < self.idle_timeout]
+            for session in stale:
+                await loop.run_in_executor(self.executor, self._close_sync, session)
+
+    async def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+        loop = asyncio.get_running_loop()
+        sessions, self.idle = self.idle, []
+        for session, _ in sessions:
+            await loop.run_in_executor(self.executor, self._close_sync, session)
+        self.executor.shutdown(wait=False)
+
+
+def send_file_sync(session, path, from_addr, to_addrs):
+    """smtplib's sendmail() for a message in a file, streamed instead of read into memory.
+
+    Line endings become CRLF and lines starting with "." are dot-stuffed on
+    the way. Raises the same exceptions as sendmail(); returns its refused dict.
+    """
+    session.ehlo_or_helo_if_needed()
+    code, resp = session.mail(from_addr)
+    if code != 250:
+        session.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for rcpt in to_addrs:
+        code, resp = session.rcpt(rcpt)
+        if code not in (250, 251):
+            refused[rcpt] = (code, resp)
+    if len(refused) == len(to_addrs):
+        session.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    session.putcmd("data")
+    code, resp = session.getreply()
+    if code != 354:
+        session.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    buffer = bytearray()
+    at_line_start = True
+    with open(path, "rb") as f:
+        # A line longer than DATA_LINE_LIMIT arrives in pieces; only the first may need a dot
+        for piece in iter(lambda: f.readline(DATA_LINE_LIMIT), b""):
+            if at_line_start and piece.startswith(b"."):
+                buffer += b"."
+            at_line_start = piece.endswith(b"\n")
+            if at_line_start and not piece.endswith(b"\r\n"):
+                piece = piece[:-1] + b"\r\n"
+            buffer += piece
+            if len(buffer) >= DATA_CHUNK:
+                session.send(bytes(buffer))
+                buffer.clear()
+    buffer += b".\r\n" if at_line_start else b"\r\n.\r\n"
+    session.send(bytes(buffer))
+    code, resp = session.getreply()
+    if code != 250:
+        session.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class _FormatVars(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"  # leave unknown placeholders as they are
+
+
+def build_message(sender, recipients, subject, body):
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = ", ".join(recipients)
+    msg["Subject"] = subject
+    msg.set_content(body if body else "")
+    return msg
+
+
+def encoded_size(size):
+    """Bytes an attachment of size bytes takes on the wire once write_message base64-encodes it."""
+    lines, rest = divmod(size, 57)  # 76 characters and CRLF per 57 bytes
+    return lines * 78 + ((rest + 2) // 3 * 4 + 2 if rest else 0)
+
+
+def write_message(f, sender, recipients, subject, body, attachments):
+    """Write a message with file attachments to the binary file f without loading the files.
+
+    attachments is a list of (filename, content type, path). The headers and
+    MIME structure come from EmailMessage; each attachment's payload is a
+    placeholder there, replaced by the file base64-encoded ENCODE_CHUNK at a time.
+    """
+    msg = build_message(sender, recipients, subject, body)
+    markers = []
+    for filename, content_type, _ in attachments:
+        maintype, _, subtype = content_type.partition("/")
+        marker = secrets.token_bytes(24)
+        msg.add_attachment(marker, maintype=maintype, subtype=subtype, filename=filename)
+        markers.append(base64.encodebytes(marker))
+    rest = bytes(msg)
+    for marker, (_, _, path) in zip(markers, attachments):
+        head, _, rest = rest.partition(marker)
+        f.write(head)
+        with open(path, "rb") as src:
+            for chunk in iter(lambda: src.read(ENCODE_CHUNK), b""):
+                f.write(base64.encodebytes(chunk))
+    f.write(rest)
+
+
+def build_batch(data):
+    """Turn a batch request into a list of EmailMessages.
+
+    Either {"messages": [{"sender", "recipients", "subject", "body"}, ...]} or
+    {"template": {"sender", "subject", "body"}, "rows": [{"to": ..., <vars>}, ...]},
+    where {placeholders} in the template are filled from each row.
+    """
+    messages = []
+    for item in data.get("messages", []):
+        recipients = item.get("recipients", [])
+        if isinstance(recipients, str):
+            recipients = [r.strip() for r in recipients.split(",") if r.strip()]
+        messages.append(build_message(item.get("sender", ""), recipients,
+                                      item.get("subject", ""), item.get("body", "")))
+
+    template = data.get("template")
+    if template:
+        for row in data.get("rows", []):
+            recipients = row.get("to", [])
+            if isinstance(recipients, str):
+                recipients = [r.strip() for r in recipients.split(",") if r.strip()]
+            variables = _FormatVars(row, to=", ".join(recipients))
+            messages.append(build_message(
+                template.get("sender", "").format_map(variables), recipients,
+                template.get("subject", "").format_map(variables),
+                template.get("body", "").format_map(variables)))
+    return messages
+
+
+def send_batch(messages, host, port, sessions=OUTBOUND_CONCURRENCY, timeout=OUTBOUND_TIMEOUT):
+    """Blocking batch sender for scripts: yields (index, error or None) as messages go out.
+
+    Each of the `sessions` threads keeps one SMTP connection open and sends
+    its share of the messages over it, with an RSET in between.
+    """
+    todo = queue.Queue()
+    for item in enumerate(messages):
+        todo.put(item)
+    results = queue.Queue()
+
+    def worker():
+        session = None
+        try:
+            while True:
+                try:
+                    index, msg = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    if session is None:
+                        session = smtplib.SMTP(host, port, timeout=timeout)
+                    else:
+                        session.rset()
+                    session.send_message(msg)
+                    results.put((index, None))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    # The server answered, so keep using this session
+                    results.put((index, e))
+                except Exception as e:
+                    results.put((index, e))
+                    if session is not None:
+                        session.close()
+                    session = None
+        finally:
+            if session is not None:
+                SMTPSessionPool._close_sync(session)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, sessions))]
+    for thread in threads:
+        thread.start()
+    for _ in range(len(messages)):
+        yield results.get()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a batch of messages over a few SMTP sessions")
+    parser.add_argument("batch_file", help="JSON file with 'messages' or 'template' + 'rows'")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--sessions", type=int, default=OUTBOUND_CONCURRENCY,
+                        help="SMTP connections used in parallel")
+    args = parser.parse_args()
+
+    with open(args.batch_file, encoding="utf-8") as f:
+        batch = build_batch(json.load(f))
+    print(f"📤 Sending {len(batch)} messages over {args.sessions} session(s)...")
+    started = time.monotonic()
+    failed = 0
+    for index, error in send_batch(batch, args.host, args.port, sessions=args.sessions):
+        if error is None:
+            print(f"✅ #{index} sent")
+        else:
+            failed += 1
+            print(f"❌ #{index} failed: {error}")
+    elapsed = time.monotonic() - started
+    rate = len(batch) / elapsed if elapsed > 0 else 0.0
+    print(f"Done: {len(batch) - failed} sent, {failed} failed in {elapsed:.2f}s ({rate:.1f} msg/s)")
@@ -0,0 +1,318 @@
+# outbox.py - on-disk outbound queue with retrying delivery workers for the web gateway
+import asyncio
+import functools
+import json
+import os
+import random
+import smtplib
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+OUTBOX_DIR = "outbox"
+DELIVERY_WORKERS = 4  # messages being delivered at once
+PER_DESTINATION_LIMIT = 2  # in-flight deliveries per recipient domain
+RETRY_BASE = 5.0  # seconds before the first retry; doubles on every failure
+RETRY_MAX = 600.0
+MAX_ATTEMPTS = 10  # after this many failures a message is marked failed
+POLL_INTERVAL = 1.0  # how often idle workers look for messages that became due
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    destination TEXT,
+    sender TEXT,
+    recipients TEXT,
+    subject TEXT,
+    path TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+CREATE INDEX IF NOT EXISTS outbox_path ON outbox (path);
+"""
+
+
+def retry_delay(attempts):
+    """Exponential backoff with a little jitter so retries do not arrive in waves."""
+    delay = min(RETRY_BASE * (2 ** (attempts - 1)), RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def is_permanent(error):
+    """5xx replies will not get better by retrying."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+class Outbox:
+    """Accepts messages immediately and delivers them in the background.
+
+    Every message is written to OUTBOX_DIR and recorded in a small SQLite
+    queue before enqueue() returns, so nothing is lost if the SMTP server is
+    down or the gateway restarts. Messages that were mid-delivery during a
+    crash are simply retried (at-least-once delivery).
+    """
+
+    def __init__(self, pool, root=OUTBOX_DIR, workers=DELIVERY_WORKERS,
+                 per_destination=PER_DESTINATION_LIMIT, max_attempts=MAX_ATTEMPTS, on_status=None):
+        self.pool = pool
+        self.root = root
+        self.workers = workers
+        self.per_destination = per_destination
+        self.max_attempts = max_attempts
+        self.on_status = on_status  # async callback(queue_id, status, error)
+        self.in_flight = {}  # destination -> deliveries in progress
+        self.tasks = []
+        self.wakeup = None
+        self.claim_lock = None
+        # All SQLite and file work happens on this one thread, off the event loop
+        self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox-db")
+        self.conn = None
+
+    # ---- runs on db_thread ---------------------------------------------
+
+    def _open_sync(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.root, "queue.sqlite3"), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._migrate_sync()
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            # Anything still marked "sending" was interrupted by a crash or restart
+            self.conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+
+    def _migrate_sync(self):
+        # Queues created before ids were AUTOINCREMENT could hand a deleted
+        # message's id to the next one, and its status to the wrong client
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'outbox'").fetchone()
+        if row is None or "AUTOINCREMENT" in row["sql"].upper():
+            return
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("ALTER TABLE outbox RENAME TO outbox_old")
+            self.conn.execute("DROP INDEX outbox_due")
+            for statement in SCHEMA.split(";"):
+                self.conn.execute(statement)
+            self.conn.execute("INSERT INTO outbox SELECT * FROM outbox_old")
+            self.conn.execute("DROP TABLE outbox_old")
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def _write_sync(self, write):
+        """Create a queue file and fill it with write(f); returns its path (any thread)."""
+        fd, path = tempfile.mkstemp(dir=self.root, prefix="msg_", suffix=".eml")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def _enqueue_sync(self, data, sender, recipients, subject):
+        path = self._write_sync(lambda f: f.write(data))
+        return self._record_sync(path, sender, recipients, subject)
+
+    def _record_sync(self, path, sender, recipients, subject):
+        destination = recipients[0].rpartition("@")[2].lower() if recipients else ""
+        now = time.time()
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO outbox (created, next_attempt, status, destination, sender, recipients, subject, path)"
+                " VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (now, now, destination, sender, json.dumps(recipients), subject, path),
+            )
+        return cur.lastrowid
+
+    def _due_sync(self, limit=100, skip=()):
+        """Oldest due messages, leaving out the destinations in skip."""
+        # Filtering here rather than in the caller keeps a long backlog for a
+        # saturated destination from hiding every other destination's mail
+        exclude = f" AND destination NOT IN ({', '.join('?' * len(skip))})" if skip else ""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT * FROM outbox WHERE status = 'queued' AND next_attempt <= ?" + exclude +
+            " ORDER BY next_attempt LIMIT ?", (time.time(), *skip, limit))]
+
+    def _update_sync(self, queue_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.conn:
+            self.conn.execute(f"UPDATE outbox SET {assignments} WHERE id = ?", (*fields.values(), queue_id))
+
+    def _delete_sync(self, queue_id, path):
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (queue_id,))
+            # A failed entry split off by _split_sync may still point at the file
+            shared = self.conn.execute("SELECT 1 FROM outbox WHERE path = ? LIMIT 1", (path,)).fetchone()
+        if path and not shared and os.path.exists(path):
+            os.remove(path)
+
+    def _split_sync(self, job, recipients, error):
+        """Record recipients of job as failed in an entry of their own, sharing its message file."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (created, next_attempt, attempts, status, destination, sender, recipients,"
+                " subject, path, last_error) VALUES (?, ?, ?, 'failed', ?, ?, ?, ?, ?, ?)",
+                (job["created"], time.time(), job["attempts"] + 1, job["destination"], job["sender"],
+                 json.dumps(recipients), job["subject"], job["path"], error),
+            )
+
+    def _status_sync(self, limit):
+        counts = {row["status"]: {"count": row["n"], "oldest": row["oldest"]} for row in self.conn.execute(
+            "SELECT status, COUNT(*) AS n, MIN(created) AS oldest FROM outbox GROUP BY status")}
+        destinations = {row["destination"]: row["n"] for row in self.conn.execute(
+            "SELECT destination, COUNT(*) AS n FROM outbox WHERE status != 'failed' GROUP BY destination")}
+        items = [dict(row) for row in self.conn.execute(
+            "SELECT id, created, next_attempt, attempts, status, destination, sender, recipients, subject, last_error"
+            " FROM outbox ORDER BY id DESC LIMIT ?", (limit,))]
+        return counts, destinations, items
+
+    # ---- event loop side -----------------------------------------------
+
+    async def _db(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_thread, functools.partial(func, *args, **kwargs))
+
+    async def start(self):
+        await self._db(self._open_sync)
+        self.wakeup = asyncio.Event()
+        self.claim_lock = asyncio.Lock()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def enqueue(self, msg, sender, recipients):
+        """Persist an EmailMessage for delivery and return its queue id."""
+        queue_id = await self._db(self._enqueue_sync, bytes(msg), sender, list(recipients),
+                                  str(msg.get("subject", "")))
+        self.wakeup.set()
+        return queue_id
+
+    async def enqueue_file(self, write, sender, recipients, subject):
+        """Like enqueue(), for messages too big to hold in memory: write(f) streams the message bytes.
+
+        The writing happens on the default executor, so the queue's own
+        thread stays free for other requests meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, self._write_sync, write)
+        try:
+            queue_id = await self._db(self._record_sync, path, sender, list(recipients), subject)
+        except BaseException:
+            os.remove(path)
+            raise
+        self.wakeup.set()
+        return queue_id
+
+    async def _claim(self):
+        """Pick the next due message whose destination is below its concurrency limit."""
+        async with self.claim_lock:
+            saturated = [d for d, n in self.in_flight.items() if n >= self.per_destination]
+            due = await self._db(self._due_sync, 1, saturated)
+            if not due:
+                return None
+            job = due[0]
+            self.in_flight[job["destination"]] = self.in_flight.get(job["destination"], 0) + 1
+            await self._db(self._update_sync, job["id"], status="sending")
+            return job
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"Outbox error: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            try:
+                await self._deliver(job)
+            finally:
+                self.in_flight[job["destination"]] -= 1
+
+    async def _deliver(self, job):
+        try:
+            # Streamed from the queue file; a large message is never held in memory
+            refused = await self.pool.send_file(job["path"], job["sender"], json.loads(job["recipients"]))
+        except smtplib.SMTPRecipientsRefused as e:
+            # Nobody accepted it; sort the recipients out the same way as a partial refusal
+            refused = e.recipients
+        except Exception as e:
+            await self._attempt_failed(job, str(e), is_permanent(e))
+            return
+        if refused:
+            await self._refused(job, refused)
+            return
+        await self._db(self._delete_sync, job["id"], job["path"])
+        await self._notify(job["id"], "delivered", None)
+
+    async def _refused(self, job, refused):
+        """Retry the recipients the server refused temporarily and fail the ones it refused for good."""
+        temporary = [rcpt for rcpt, (code, _) in refused.items() if code < 500]
+        permanent = [rcpt for rcpt, (code, _) in refused.items() if code >= 500]
+        error = "Refused " + "; ".join(
+            f"{rcpt}: {code} {reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else reply}"
+            for rcpt, (code, reply) in refused.items())
+        if temporary and permanent:
+            await self._db(self._split_sync, job, permanent, error)
+        # Everyone else got the message, so only the refused recipients stay on this entry
+        await self._attempt_failed(job, error, not temporary, recipients=json.dumps(temporary or permanent))
+
+    async def _attempt_failed(self, job, error, permanent, **fields):
+        attempts = job["attempts"] + 1
+        if permanent or attempts >= self.max_attempts:
+            await self._db(self._update_sync, job["id"], status="failed", attempts=attempts, last_error=error,
+                           **fields)
+            await self._notify(job["id"], "failed", error)
+        else:
+            await self._db(self._update_sync, job["id"], status="queued", attempts=attempts, last_error=error,
+                           next_attempt=time.time() + retry_delay(attempts), **fields)
+            await self._notify(job["id"], "retrying", error)
+
+    async def _notify(self, queue_id, status, error):
+        if self.on_status is not None:
+            try:
+                await self.on_status(queue_id, status, error)
+            except Exception as e:
+                print(f"Outbox status callback error: {e}")
+
+    async def status(self, limit=50):
+        """Queue depth, age and the most recent entries, for the WebSocket API."""
+        counts, destinations, items = await self._db(self._status_sync, limit)
+        now = time.time()
+        pending = [c for s, c in counts.items() if s in ("queued", "sending")]
+        oldest = min((c["oldest"] for c in pending), default=None)
+        for item in items:
+            item["recipients"] = json.loads(item["recipients"] or "[]")
+        return {
+            'depth': sum(c["count"] for c in pending),
+            'sending': counts.get("sending", {}).get("count", 0),
+            'failed': counts.get("failed", {}).get("count", 0),
+            'oldest_age': round(now - oldest, 1) if oldest else 0,
+            'in_flight': {d: n for d, n in self.in_flight.items() if n},
+            'by_destination': destinations,
+            'items': items,
+        }
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.conn is not None:
+            await self._db(self.conn.close)
+        self.db_thread.shutdown(wait=True)
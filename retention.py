@@ -0,0 +1,179 @@
+# retention.py - per-recipient retention limits, quotas and the janitor that enforces them for server.py
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+
+RETENTION_BATCH = 500  # messages deleted per index query, so one huge mailbox never blocks the others
+JANITOR_INTERVAL = 300  # seconds between retention passes
+ARCHIVE_SUFFIX = ".mbox"  # expired mail goes to <archive dir>/<recipient>.mbox when archiving is on
+
+
+@dataclass
+class Limits:
+    """Upper bounds for one mailbox; 0 means unlimited."""
+    days: float = 0
+    messages: int = 0
+    bytes: int = 0
+
+    def __bool__(self):
+        return bool(self.days or self.messages or self.bytes)
+
+    @classmethod
+    def from_dict(cls, data, default):
+        known = {f.name for f in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(f"Unknown limit(s): {', '.join(sorted(unknown))}")
+        return cls(**{**default.__dict__, **data})
+
+
+def append_mbox(path, messages):
+    """Append raw messages (bytes) to an mbox file, quoting body lines that start with "From "."""
+    with open(path, "ab") as f:
+        for raw in messages:
+            raw = raw.replace(b"\r\n", b"\n")
+            f.write(f"From MAILER-DAEMON {time.asctime()}\n".encode("ascii"))
+            f.write(re.sub(rb"(?m)^(>*From )", rb">\1", raw))
+            f.write(b"\n" if raw.endswith(b"\n") else b"\n\n")
+
+
+class RetentionPolicy:
+    """Retention limits (old mail is removed) and quotas (new mail is refused) per recipient folder.
+
+    Defaults apply to everyone; a JSON policy file can override them:
+
+        {"recipients": {"alice_at_example_com": {"retain": {"days": 30},
+                                                 "quota": {"bytes": 104857600}}}}
+    """
+
+    def __init__(self, retain=None, quota=None, overrides=None):
+        self.retain = retain or Limits()
+        self.quota = quota or Limits()
+        self.overrides = overrides or {}  # recipient -> {"retain": Limits, "quota": Limits}
+
+    @classmethod
+    def load(cls, path, retain=None, quota=None):
+        """Read per-recipient overrides from a JSON policy file on top of the given defaults."""
+        policy = cls(retain, quota)
+        with open(path, encoding="utf-8") as f:
+            settings = json.load(f)
+        for name, limits in settings.get("recipients", {}).items():
+            policy.overrides[name] = {
+                "retain": Limits.from_dict(limits.get("retain", {}), policy.retain),
+                "quota": Limits.from_dict(limits.get("quota", {}), policy.quota),
+            }
+        return policy
+
+    def retention_for(self, recipient):
+        return self.overrides.get(recipient, {}).get("retain", self.retain)
+
+    def quota_for(self, recipient):
+        return self.overrides.get(recipient, {}).get("quota", self.quota)
+
+    def has_quota(self):
+        return bool(self.quota) or any(o["quota"] for o in self.overrides.values())
+
+    def has_retention(self):
+        return bool(self.retain) or any(o["retain"] for o in self.overrides.values())
+
+    def over_quota(self, recipient, count, size):
+        """True if a mailbox holding count messages / size bytes may not take another message."""
+        quota = self.quota_for(recipient)
+        return bool(quota.messages and count >= quota.messages or quota.bytes and size >= quota.bytes)
+
+
+class Janitor:
+    """Background thread that expires mail past its retention limits, then compacts the store.
+
+    Each pass walks the recipients in the index and deletes (or archives and
+    deletes) their expired messages RETENTION_BATCH at a time. It only takes the
+    same short locks as a delivery, so receiving carries on while it runs.
+    """
+
+    def __init__(self, store, index, policy, interval=JANITOR_INTERVAL, archive_dir=None, batch=RETENTION_BATCH,
+                 on_pass=None, on_error=None):
+        self.store = store
+        self.index = index
+        self.policy = policy
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.on_pass = on_pass  # called with (removed, freed) after every pass
+        self.on_error = on_error  # called with the exception when a pass fails
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="retention-janitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            try:
+                removed, freed = self.run_once()
+                if self.on_pass:
+                    self.on_pass(removed, freed)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+            self.stopping.wait(self.interval)
+
+    def run_once(self):
+        """Run one retention pass; returns (messages removed, bytes reclaimed by compaction)."""
+        removed = 0
+        touched = []
+        for rec in self.index.recipients():
+            name = rec['name']
+            limits = self.policy.retention_for(name)
+            if not limits:
+                continue
+            before_ts = None
+            if limits.days:
+                before_ts = f"{datetime.now() - timedelta(days=limits.days):%Y%m%d_%H%M%S}"
+            while not self.stopping.is_set():
+                expired = self.index.expired(name, before_ts, limits.messages, limits.bytes, self.batch)
+                if not expired:
+                    break
+                self._expire(name, expired)
+                removed += len(expired)
+                if name not in touched:
+                    touched.append(name)
+                if len(expired) < self.batch:
+                    break
+        freed = self.store.compact(touched) if touched else 0
+        return removed, freed
+
+    def _expire(self, recipient, entries):
+        if self.archive_dir:
+            self._archive(recipient, entries)
+        # The index goes first: readers stop listing the messages before their files disappear
+        self.index.remove([entry['id'] for entry in entries])
+        names = []
+        for entry in entries:
+            names.extend(name for name in (entry['eml'], entry['body']) if name)
+            names.extend(entry['attachments'])
+        self.store.delete_items(recipient, names)
+
+    def _archive(self, recipient, entries):
+        def messages():
+            # One message in memory at a time
+            for entry in entries:
+                if not entry['eml']:
+                    continue
+                try:
+                    with self.store.open_item(recipient, entry['eml']) as f:
+                        yield f.read()
+                except FileNotFoundError:
+                    pass  # already gone from the store; nothing to keep
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        append_mbox(os.path.join(self.archive_dir, recipient + ARCHIVE_SUFFIX), messages())
@@ -0,0 +1,417 @@
+# segmentstore.py - mailbox backend that appends messages to rolling per-recipient segment files
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from mail_index import INDEX_FILE_NAME, MailIndex
+from mailstore import (COPY_CHUNK, STORE_FORMATS, Item, ItemFile, MailStore, check_item_name,
+                       open_store, write_format)
+
+try:
+    import fcntl  # keeps --workers processes from appending to the same segment at once
+except ImportError:
+    fcntl = None
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # a new segment file is started once the current one is this big
+SEGMENT_INDEX_NAME = "index.jsonl"  # one JSON line per stored item: name -> segment, offset, length
+LOCK_FILE_NAME = ".lock"
+SHARED_DIR_NAME = ".shared"  # segments holding payloads delivered to several recipients, keyed by SHA-256
+COMPRESS_MAX = 4 * 1024 * 1024  # bigger items are stored as-is, so reading them never inflates them in memory
+COMPACT_GARBAGE_RATIO = 0.5  # a sealed segment is rewritten once this share of it belongs to deleted items
+COMPACT_BATCH = 200  # records moved per lock hold while compacting, so deliveries are never held up for long
+
+
+def segment_name(number):
+    return f"segment_{number:06d}.dat"
+
+
+class SegmentStore(MailStore):
+    """Keeps each recipient's mail in a few large append-only files instead of one file per item.
+
+    inbox/<recipient>/segment_NNNNNN.dat holds the payloads back to back and
+    index.jsonl maps every item name to (segment, offset, length), so a read is
+    one seek. With compress=True, items up to COMPRESS_MAX are zlib-compressed
+    when that makes them smaller.
+
+    A message for several recipients is stored once: its payloads go to the
+    segments under .shared/, named by their SHA-256, and each recipient's
+    index.jsonl only gets {"name", "shared": digest} entries pointing at them.
+    """
+
+    format = "segments"
+
+    def __init__(self, root, compress=False):
+        super().__init__(root)
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.folder_locks = {}
+        self.indexes = {}  # recipient -> (index.jsonl inode, bytes already read, {name: entry})
+
+    # ---- writing -------------------------------------------------------
+
+    def write_items(self, recipients, items):
+        """Store items (a list of Item) for every recipient folder name (blocking).
+
+        For a single recipient the payloads are appended to its current
+        segment; for several they are written once to the shared segments.
+        Like the files backend, a name that is already stored (or repeated in
+        items) raises FileExistsError instead of replacing the earlier item.
+        """
+        names = [item.name for item in items]
+        if len(set(names)) != len(names):
+            raise FileExistsError(f"Item names repeated in one write: {names}")
+        for recipient in recipients:
+            for name in names:
+                check_item_name(recipient, name)
+            self._check_free(recipient, names)
+        if len(recipients) > 1:
+            self._write_shared(recipients, items)
+            return
+        for recipient in recipients:
+            folder = os.path.join(self.root, recipient)
+            os.makedirs(folder, exist_ok=True)
+            with self._locked(folder):
+                self._check_free(recipient, names)
+                segment = self._current_segment(folder)
+                lines = []
+                with open(os.path.join(folder, segment), "ab") as f:
+                    for item in items:
+                        offset = f.tell()
+                        codec, size = self._write_record(f, item)
+                        lines.append(json.dumps({"name": item.name, "segment": segment, "offset": offset,
+                                                 "length": f.tell() - offset, "size": size, "codec": codec}))
+                # The index is written last, so readers never see an entry before its bytes
+                self._append_index(folder, lines)
+
+    def _check_free(self, recipient, names):
+        taken = set(names) & set(self._entries(recipient))
+        if taken:
+            raise FileExistsError(f"Already stored for {recipient}: {', '.join(sorted(taken))}")
+
+    def _write_shared(self, recipients, items):
+        shared = os.path.join(self.root, SHARED_DIR_NAME)
+        os.makedirs(shared, exist_ok=True)
+        digests = [item.digest or self._digest(item) for item in items]
+        # Held until every recipient has its references, so compact() never
+        # sees a shared record that is about to be referenced as unused
+        with self._locked(shared):
+            stored = self._entries(SHARED_DIR_NAME)
+            segment = self._current_segment(shared)
+            lines = []
+            with open(os.path.join(shared, segment), "ab") as f:
+                for item, digest in zip(items, digests):
+                    if digest in stored:
+                        continue  # the same payload arrived before
+                    offset = f.tell()
+                    codec, size = self._write_record(f, item)
+                    stored[digest] = {"name": digest, "segment": segment, "offset": offset,
+                                      "length": f.tell() - offset, "size": size, "codec": codec}
+                    lines.append(json.dumps(stored[digest]))
+            self._append_index(shared, lines)
+            refs = [json.dumps({"name": item.name, "shared": digest}) for item, digest in zip(items, digests)]
+            for recipient in recipients:
+                folder = os.path.join(self.root, recipient)
+                os.makedirs(folder, exist_ok=True)
+                with self._locked(folder):
+                    self._append_index(folder, refs)
+
+    @staticmethod
+    def _digest(item):
+        if not item.path:
+            return hashlib.sha256(item.data).hexdigest()
+        hasher = hashlib.sha256()
+        with open(item.path, "rb") as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def delete_items(self, recipient, names):
+        """Mark items deleted with tombstone lines; compact() reclaims their space later."""
+        folder = os.path.join(self.root, recipient)
+        for name in names:
+            check_item_name(recipient, name)
+        if not os.path.isdir(folder):
+            return
+        with self._locked(folder):
+            self._append_index(folder, [json.dumps({"name": name, "deleted": True}) for name in names])
+
+    @staticmethod
+    def _append_index(folder, lines):
+        with open(os.path.join(folder, SEGMENT_INDEX_NAME), "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+
+    @contextmanager
+    def _locked(self, folder):
+        with self.lock:
+            lock = self.folder_locks.setdefault(folder, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(folder, LOCK_FILE_NAME), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _current_segment(folder):
+        numbers = [int(name[8:14]) for name in os.listdir(folder)
+                   if name.startswith("segment_") and name.endswith(".dat")]
+        if not numbers:
+            return segment_name(1)
+        latest = segment_name(max(numbers))
+        if os.path.getsize(os.path.join(folder, latest)) >= SEGMENT_SIZE:
+            return segment_name(max(numbers) + 1)
+        return latest
+
+    def _write_record(self, f, item):
+        """Write one payload at the end of f; returns (codec, uncompressed size)."""
+        size = os.path.getsize(item.path) if item.path else len(item.data)
+        if self.compress and size <= COMPRESS_MAX:
+            data = item.data
+            if item.path:
+                with open(item.path, "rb") as src:
+                    data = src.read()
+            packed = zlib.compress(data, 6)
+            if len(packed) < len(data):
+                f.write(packed)
+                return "zlib", size
+            f.write(data)
+        elif item.path:
+            with open(item.path, "rb") as src:
+                shutil.copyfileobj(src, f, COPY_CHUNK)
+        else:
+            f.write(item.data)
+        return "raw", size
+
+    # ---- reading -------------------------------------------------------
+
+    def _entries(self, recipient):
+        """Return {name: entry} for a recipient's live items, parsing only index lines added since last time.
+
+        compact() may replace index.jsonl with a shorter copy; a new inode or a
+        file smaller than what was already read means it starts over.
+        """
+        path = os.path.join(self.root, recipient, SEGMENT_INDEX_NAME)
+        with self.lock:
+            inode, done, entries = self.indexes.get(recipient, (None, 0, {}))
+            try:
+                with open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    if st.st_ino != inode or st.st_size < done:
+                        inode, done, entries = st.st_ino, 0, {}
+                    f.seek(done)
+                    tail = f.read()
+            except FileNotFoundError:
+                return {}
+            complete = tail.rfind(b"\n") + 1  # a line still being written is picked up next time
+            for line in tail[:complete].splitlines():
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    entries.pop(entry["name"], None)
+                else:
+                    entries[entry["name"]] = entry  # a relocated item keeps its place in the order
+            self.indexes[recipient] = (inode, done + complete, entries)
+            return dict(entries)
+
+    def list_entries(self, recipient):
+        """Return the item names stored for a recipient, in the order they were written."""
+        if not os.path.isdir(os.path.join(self.root, recipient)):
+            raise FileNotFoundError(f"No mailbox for {recipient}")
+        return list(self._entries(recipient))
+
+    def open_item(self, recipient, filename):
+        """Open recipient/filename for reading; returns an ItemFile over its slice of the segment."""
+        check_item_name(recipient, filename)
+        for attempt in range(2):
+            folder, entry = self._locate(recipient, filename)
+            try:
+                f = open(os.path.join(self.root, folder, entry["segment"]), "rb")
+                break
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                # compact() moved the item out of a segment it then removed; re-read the index
+                with self.lock:
+                    self.indexes.pop(folder, None)
+        if entry["codec"] == "zlib":
+            with f:
+                f.seek(entry["offset"])
+                data = zlib.decompress(f.read(entry["length"]))
+            return ItemFile(io.BytesIO(data), 0, len(data))
+        return ItemFile(f, entry["offset"], entry["length"])
+
+    def _locate(self, recipient, filename):
+        """Return (folder name, index entry) for the record holding recipient/filename."""
+        entry = self._entries(recipient).get(filename)
+        if entry is not None and "shared" in entry:
+            recipient, entry = SHARED_DIR_NAME, self._entries(SHARED_DIR_NAME).get(entry["shared"])
+        if entry is None:
+            raise FileNotFoundError(f"No such item: {recipient}/{filename}")
+        return recipient, entry
+
+    # ---- compaction ----------------------------------------------------
+
+    def compact(self, recipients=()):
+        """Reclaim space left by delete_items(); returns the bytes freed.
+
+        Sealed segments with nothing live in them are removed. Those that are
+        mostly garbage have their live records moved to the current segment,
+        COMPACT_BATCH at a time, so deliveries only wait for one batch.
+        index.jsonl is rewritten once most of its lines are dead. Shared
+        payloads no recipient refers to any more are dropped and their
+        segments compacted the same way.
+        """
+        freed = 0
+        for recipient in recipients or self.list_recipients():
+            freed += self._compact_folder(recipient)
+        shared = os.path.join(self.root, SHARED_DIR_NAME)
+        if os.path.isdir(shared):
+            with self._locked(shared):
+                self._drop_unreferenced(shared)
+            freed += self._compact_folder(SHARED_DIR_NAME)
+        return freed
+
+    def _drop_unreferenced(self, shared):
+        """Tombstone shared records no recipient index points at (shared lock held)."""
+        referenced = {entry["shared"] for recipient in self.list_recipients()
+                      for entry in self._entries(recipient).values() if "shared" in entry}
+        unused = [name for name in self._entries(SHARED_DIR_NAME) if name not in referenced]
+        if unused:
+            self._append_index(shared, [json.dumps({"name": name, "deleted": True}) for name in unused])
+
+    def _compact_folder(self, name):
+        folder = os.path.join(self.root, name)
+        if not os.path.isdir(folder):
+            return 0
+        freed = 0
+        with self._locked(folder):
+            sealed = self._sealed_segments(folder)
+        for segment in sealed:
+            path = os.path.join(folder, segment)
+            size = os.path.getsize(path)
+            live = sum(e["length"] for e in self._entries(name).values() if e.get("segment") == segment)
+            if live and (size - live) / size < COMPACT_GARBAGE_RATIO:
+                continue
+            while self._relocate(name, folder, segment):
+                pass
+            with self._locked(folder):
+                if not any(e.get("segment") == segment for e in self._entries(name).values()):
+                    os.remove(path)
+                    freed += size - live
+        with self._locked(folder):
+            self._rewrite_index(name, folder)
+        return freed
+
+    def _sealed_segments(self, folder):
+        current = self._current_segment(folder)
+        return sorted(name for name in os.listdir(folder)
+                      if name.startswith("segment_") and name.endswith(".dat") and name < current)
+
+    def _relocate(self, recipient, folder, segment):
+        """Copy up to COMPACT_BATCH live records out of segment; returns how many were moved."""
+        with self._locked(folder):
+            moving = [e for e in self._entries(recipient).values() if e.get("segment") == segment][:COMPACT_BATCH]
+            if not moving:
+                return 0
+            target = self._current_segment(folder)
+            lines = []
+            with open(os.path.join(folder, segment), "rb") as src, open(os.path.join(folder, target), "ab") as f:
+                for entry in moving:
+                    # Records are copied as stored, compressed or not
+                    src.seek(entry["offset"])
+                    offset = f.tell()
+                    remaining = entry["length"]
+                    while remaining:
+                        chunk = src.read(min(COPY_CHUNK, remaining))
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                    lines.append(json.dumps({**entry, "segment": target, "offset": offset}))
+            self._append_index(folder, lines)
+            return len(moving)
+
+    def _rewrite_index(self, recipient, folder):
+        """Replace index.jsonl with only the live entries once it is mostly dead lines (lock held)."""
+        path = os.path.join(folder, SEGMENT_INDEX_NAME)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            total = sum(1 for _ in f)
+        entries = self._entries(recipient)
+        if total < 2 * len(entries) + COMPACT_BATCH:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries.values()))
+        os.replace(tmp_path, path)
+
+
+def migrate(root, fmt, compress=False):
+    """Rewrite the mailbox at root in another format; the old tree is kept as <root>.old-<time>.
+
+    Stop server.py and web_server.py first: the copy is made next to the
+    mailbox and the directories are swapped at the end.
+    """
+    source = open_store(root)
+    target_root = root.rstrip("/\\") + ".migrating"
+    if os.path.exists(target_root):
+        shutil.rmtree(target_root)
+    write_format(target_root, fmt, **({"compress": True} if compress else {}))
+    target = open_store(target_root)
+    os.makedirs(target.spool_root, exist_ok=True)
+
+    # Items of one message carry the same name in every recipient folder, so
+    # writing each name once for all its recipients keeps payloads shared
+    holders = {}
+    for recipient in source.list_recipients():
+        for name in source.list_entries(recipient):
+            holders.setdefault(name, []).append(recipient)
+
+    count = 0
+    for name, recipients in sorted(holders.items()):
+        with source.open_item(recipients[0], name) as f:
+            if f.size <= COMPRESS_MAX:
+                item = Item(name, data=f.read())
+            else:
+                # Large items go through a spool file so memory stays flat
+                fd, path = tempfile.mkstemp(dir=target.spool_root)
+                with os.fdopen(fd, "wb") as out:
+                    shutil.copyfileobj(f, out, COPY_CHUNK)
+                item = Item(name, path=path)
+        try:
+            target.write_items(recipients, [item])
+        finally:
+            target.discard(item.path)
+        count += len(recipients)
+
+    # Item names do not change, so the delivery index carries over as it is
+    MailIndex(root).close()
+    if os.path.exists(os.path.join(root, INDEX_FILE_NAME)):
+        shutil.copy2(os.path.join(root, INDEX_FILE_NAME), os.path.join(target_root, INDEX_FILE_NAME))
+    backup = f"{root.rstrip('/')}.old-{datetime.now():%Y%m%d_%H%M%S}"
+    os.rename(root, backup)
+    os.rename(target_root, root)
+    return count, backup
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a mailbox between the files and segments formats")
+    parser.add_argument("--inbox", default="inbox", help="mailbox directory")
+    parser.add_argument("--to", choices=STORE_FORMATS, default="segments", help="format to convert to")
+    parser.add_argument("--compress", action="store_true", help="zlib-compress items (segments only)")
+    args = parser.parse_args()
+    if args.compress and args.to != "segments":
+        parser.error("--compress only applies to --to segments")
+    count, backup = migrate(args.inbox, args.to, args.compress)
+    print(f"✅ Migrated {count} items to {args.to} format")
+    print(f"📦 Old mailbox kept in {backup}; delete it once everything looks right")
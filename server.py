@@ -1,85 +1,561 @@
 # server.py
+import argparse
+import asyncio
+import multiprocessing
 import os
+import signal
+import socket
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from email import policy
-from email.parser import BytesParser
 
 # Use aiosmtpd for Python 3.12+ (smtpd removed in 3.12)
 from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import MISSING, SMTP, syntax
+
+from admission import RATE_BURST, SHED_RATIO, AdmissionControl
+from mail_events import EventPublisher
+from mail_index import MailIndex
+from mailstore import (STORE_FORMATS, Item, MessageSpool, attachment_names, message_stamp, open_store,
+                       read_format, safe_recipient, write_format)
+from message_pipeline import PARSE_WORKERS, ParsePipeline
+from metrics import SERVER_METRICS_PORT, SLOW_THRESHOLD, Metrics, SlowLog, serve_metrics
+from retention import JANITOR_INTERVAL, Janitor, Limits, RetentionPolicy
 
 MAILBOX_DIR = "inbox"  # ensure this folder exists
+SMTP_HOST = "localhost"
+SMTP_PORT = 2525  # avoids conflicts with privileged or system services
+STORAGE_WORKERS = 4  # threads that write messages into the mailbox
+STORAGE_QUEUE_DEPTH = 64  # messages allowed to wait for storage before we answer 451
+SPOOL_THRESHOLD = 1024 * 1024  # DATA bigger than this is spooled to disk and stream-parsed
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024  # larger messages are rejected with 552
+SLOW_LOG = "slow_messages.log"  # JSON lines for messages slower than --slow-threshold
+
+mail_store = open_store(MAILBOX_DIR)
+
+
+class StorageQueueFull(Exception):
+    """Raised when the storage stage already holds STORAGE_QUEUE_DEPTH messages."""
+
+
+class StorageStage:
+    """Runs blocking mailbox writes on a thread pool behind a bounded queue."""
+
+    def __init__(self, workers=STORAGE_WORKERS, depth=STORAGE_QUEUE_DEPTH):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mailbox-writer")
+        self.depth = depth
+        self.pending = 0  # only touched from the event loop thread
+
+    def is_full(self):
+        return self.pending >= self.depth
+
+    async def submit(self, func, *args):
+        """Run func(*args) on the writer pool and wait for it to finish."""
+        if self.is_full():
+            raise StorageQueueFull()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def store_message(extracted, index, timings=None):
+    """Write the message's files for every recipient through the mailbox store (blocking).
+
+    If a timings dict is passed, the time spent per write stage is recorded in it.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    # Several worker processes may deliver in the same microsecond, so the stamp carries a random suffix
+    ts = message_stamp()
+    # The same mailbox listed twice in RCPT TO gets one copy
+    recipients = list(dict.fromkeys(safe_recipient(rcpt) for rcpt in extracted.rcpt_tos))
+
+    if extracted.raw_path:
+        size = os.path.getsize(extracted.raw_path)
+        eml = Item(f"mail_{ts}.eml", path=extracted.raw_path, digest=extracted.raw_digest)
+    else:
+        size = len(extracted.raw)
+        eml = Item(f"mail_{ts}.eml", data=extracted.raw)
+    body = Item(f"body_{ts}.txt", data=extracted.body_text().encode("utf-8"))
+    # Attachment file names come from the sender: made safe and distinct before they touch the store
+    names = attachment_names([att.filename for att in extracted.attachments], f"attachment_{ts}")
+    attachments = [
+        Item(f"{ts}__{name}", data=att.data, path=att.path, digest=att.digest)
+        for name, att in zip(names, extracted.attachments)
+    ]
+    entries = [{
+        "recipient": recipient,
+        "ts": ts,
+        "sender": extracted.mail_from,
+        "subject": extracted.subject,
+        "size": size,
+        "eml": eml.name,
+        "body": body.name,
+        "attachments": [item.name for item in attachments],
+        "text": extracted.text,
+    } for recipient in recipients]
+    try:
+        mail_store.write_items(recipients, [eml, body])
+        timings['raw_write'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        mail_store.write_items(recipients, attachments)
+        timings['attachment_write'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        index.add(entries)
+        timings['index'] = time.perf_counter() - started
+    except BaseException:
+        # Nothing indexes these items yet; leaving them would orphan them on every retry
+        for recipient in recipients:
+            try:
+                mail_store.delete_items(recipient, [item.name for item in (eml, body, *attachments)])
+            except OSError:
+                pass
+        raise
+    return entries
+
+
+class SpoolingSMTP(SMTP):
+    """aiosmtpd session that spools DATA to disk instead of buffering all of it.
+
+    Small messages still reach handle_DATA as envelope.content; anything over
+    spool_threshold arrives with envelope.content = None and envelope.spool_path
+    pointing at the spooled file (removed again once the handler returns).
+    """
+
+    def __init__(self, handler, *, spool_threshold=SPOOL_THRESHOLD, **kwargs):
+        super().__init__(handler, **kwargs)
+        self.spool_threshold = spool_threshold
+        self.admitted = False
+
+    async def _handle_client(self):
+        # aiosmtpd has no connect hook; ask the handler before the 220 greeting
+        admit = getattr(self.event_handler, "admit_connection", None)
+        if admit is not None:
+            status = admit(self.session)
+            if status is not None:
+                await self.push(status)
+                self.transport.close()
+                return
+            self.admitted = True
+        await super()._handle_client()
+
+    def connection_lost(self, error):
+        if self.admitted:
+            self.admitted = False
+            self.event_handler.release_connection(self.session)
+        super().connection_lost(error)
+
+    @syntax('DATA')
+    async def smtp_DATA(self, arg):
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed("DATA"):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        started = time.perf_counter()
+        spool = MessageSpool(mail_store.spool_root, self.spool_threshold)
+        limit = self.data_size_limit
+        num_bytes = 0
+        error = None
+        line_start = True
+        line_length = 0  # a line drained in pieces after LimitOverrunError is counted whole
+        try:
+            while self.transport is not None:
+                try:
+                    line = await self._reader.readuntil(b'\r\n')
+                except asyncio.CancelledError:
+                    # The connection got reset during the DATA command
+                    self._writer.close()
+                    raise
+                except asyncio.LimitOverrunError as e:
+                    # Drain the over-long line; the message is rejected once DATA ends
+                    error = error or '500 Line too long (see RFC5321 4.5.3.1.6)'
+                    line = await self._reader.read(e.consumed)
+                if line_start and line == b'.\r\n':
+                    break
+                num_bytes += len(line)
+                line_length += len(line)
+                if error is None and limit and num_bytes > limit:
+                    error = '552 Error: Too much mail data'
+                if error is None and line_length > self.line_length_limit:
+                    # readuntil() lets lines a few bytes over its limit through
+                    error = '500 Line too long (see RFC5321 4.5.3.1.6)'
+                if error is None:
+                    # Undo dot-stuffing (RFC 5321, section 4.5.2)
+                    await spool.write(line[1:] if line_start and line.startswith(b'.') else line)
+                line_start = line.endswith(b'\r\n')
+                if line_start:
+                    line_length = 0
+
+            if error:
+                await self.push(error)
+                self._set_post_data_state()
+                return
+
+            content = await spool.finish()
+            self.envelope.content = content
+            self.envelope.original_content = content
+            self.envelope.spool_path = spool.path
+            self.envelope.spool_digest = spool.digest
+            self.envelope.receive_seconds = time.perf_counter() - started
+            status = await self._call_handler_hook('DATA')
+        finally:
+            spool.discard()
+        self._set_post_data_state()
+        await self.push('250 OK' if status is MISSING else status)
+
+
+class SpoolingController(Controller):
+    def __init__(self, handler, spool_threshold=SPOOL_THRESHOLD, **kwargs):
+        super().__init__(handler, **kwargs)
+        self.spool_threshold = spool_threshold
+
+    def factory(self):
+        return SpoolingSMTP(self.handler, spool_threshold=self.spool_threshold, **self.SMTP_kwargs)
+
+
+def client_ip(session):
+    return session.peer[0] if isinstance(session.peer, tuple) else str(session.peer)
+
 
 class SMTPHandler:
+    def __init__(self, storage=None, pipeline=None, index=None, events=None, metrics=None, slow_log=None,
+                 policy=None, admission=None, shed_ratio=SHED_RATIO):
+        self.storage = storage or StorageStage()
+        self.pipeline = pipeline or ParsePipeline()
+        self.index = index or MailIndex(MAILBOX_DIR)
+        self.events = events or EventPublisher()
+        self.metrics = metrics or Metrics()
+        self.slow_log = slow_log or SlowLog(None)
+        self.policy = policy or RetentionPolicy()
+        self.admission = admission or AdmissionControl()
+        self.shed_at = max(1, int(self.storage.depth * shed_ratio)) if shed_ratio else 0
+        self.metrics.describe("smtp_connections_rejected_total", "counter", "Connections refused with 421, by reason")
+        self.metrics.describe("smtp_rcpt_rejected_total", "counter", "Recipients refused at RCPT time, by reason")
+        self.metrics.describe("smtp_messages_total", "counter", "Messages by result (accepted, busy, failed)")
+        self.metrics.describe("smtp_message_bytes_total", "counter", "Bytes of accepted messages")
+        self.metrics.describe("smtp_recipients_total", "counter", "Recipients of accepted messages")
+        self.metrics.describe("smtp_errors_total", "counter", "Messages that failed, by the stage that failed")
+        self.metrics.describe("smtp_stage_seconds", "histogram", "Time spent per receive-path stage")
+        self.metrics.gauge("smtp_storage_pending", lambda: self.storage.pending,
+                           "Messages waiting for or inside the storage stage")
+        self.metrics.gauge("smtp_connections", lambda: self.admission.total, "Open SMTP sessions")
+
+    def admit_connection(self, session):
+        """Called before the greeting; returns None to accept, or a 421 reply."""
+        if self.storage.is_full():
+            # Shed load at the door while storage is saturated
+            reason, status = "busy", '421 4.3.2 System busy, try again later'
+        else:
+            reason = self.admission.open(client_ip(session))
+            status = '421 4.7.0 Too many connections, try again later' if reason else None
+        if status:
+            print(f"🚫 {client_ip(session)} এর সংযোগ ফেরত দেওয়া হলো ({reason})")
+            self.metrics.inc("smtp_connections_rejected_total", reason=reason)
+        return status
+
+    def release_connection(self, session):
+        self.admission.close(client_ip(session))
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        """Gate each recipient: 451 for load shedding or rate limits, 452 for a full mailbox."""
+        if not envelope.rcpt_tos:
+            # Checked once per message, at its first recipient
+            if self.shed_at and self.storage.pending >= self.shed_at:
+                self.metrics.inc("smtp_rcpt_rejected_total", reason="shed")
+                return '451 4.3.2 System busy, try again later'
+            reason = self.admission.check_message(client_ip(session))
+            if reason:
+                print(f"🐌 {client_ip(session)} রেট লিমিট ছাড়িয়েছে ({reason}) — 451 পাঠানো হলো।")
+                self.metrics.inc("smtp_rcpt_rejected_total", reason=f"rate_{reason}")
+                return '451 4.7.1 Rate limit exceeded, try again later'
+        if self.policy.has_quota():
+            recipient = safe_recipient(address)
+            loop = asyncio.get_running_loop()
+            count, size = await loop.run_in_executor(None, self.index.usage, recipient)
+            if self.policy.over_quota(recipient, count, size):
+                print(f"📦 {address} এর মেইলবক্স পূর্ণ — 452 পাঠানো হলো।")
+                self.metrics.inc("smtp_rcpt_rejected_total", reason="quota")
+                return '452 4.2.2 Mailbox full, try again later'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
     async def handle_DATA(self, server, session, envelope):
-        """Handle incoming DATA from a client (envelope.content is bytes)."""
+        """Handle incoming DATA (envelope.content is bytes, or None when the message was spooled)."""
         print("📩 নতুন মেইল এসেছে:", datetime.now().isoformat())
-        raw = envelope.content
+        if self.storage.is_full():
+            # Ask the client to retry later instead of piling more work onto the loop
+            print("⏳ স্টোরেজ কিউ পূর্ণ — 451 পাঠানো হলো।")
+            self.metrics.inc("smtp_messages_total", result="busy")
+            return '451 4.3.0 Mailbox storage busy, try again later'
+
+        started = time.perf_counter()
+        timings = {}
+        if getattr(envelope, "receive_seconds", None) is not None:
+            timings['receive'] = envelope.receive_seconds
+        extracted = None
+        stage = "parse"
+        spool_path = getattr(envelope, "spool_path", None)
+        size = os.path.getsize(spool_path) if spool_path else len(envelope.content)
+        self.admission.charge(client_ip(session), size)
         try:
-            msg = BytesParser(policy=policy.default).parsebytes(raw)
-
-            for rcpt in envelope.rcpt_tos:
-                safe_rcpt = rcpt.replace("@", "_at_").replace(".", "_")
-                rec_folder = os.path.join(MAILBOX_DIR, safe_rcpt)
-                os.makedirs(rec_folder, exist_ok=True)
-
-                ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                eml_path = os.path.join(rec_folder, f"mail_{ts}.eml")
-                with open(eml_path, "wb") as f:
-                    f.write(raw)
-
-                body_path = os.path.join(rec_folder, f"body_{ts}.txt")
-                with open(body_path, "w", encoding="utf-8") as f:
-                    f.write(f"From: {envelope.mail_from}\n")
-                    f.write(f"To: {', '.join(envelope.rcpt_tos)}\n")
-                    subj = msg.get('subject', '')
-                    f.write(f"Subject: {subj}\n\n")
-
-                    text = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            ctype = part.get_content_type()
-                            if ctype == "text/plain" and part.get_content_disposition() is None:
-                                try:
-                                    text += part.get_content()
-                                except Exception:
-                                    pass
-                    else:
-                        try:
-                            text = msg.get_content()
-                        except Exception:
-                            text = ""
-
-                    f.write(text if text else "[No plain text body]\n")
-
-                for part in msg.iter_attachments():
-                    filename = part.get_filename()
-                    if not filename:
-                        filename = f"attachment_{ts}"
-                    att_path = os.path.join(rec_folder, f"{ts}__{filename}")
-                    content = part.get_content()
-                    if isinstance(content, str):
-                        content = content.encode("utf-8")
-                    with open(att_path, "wb") as af:
-                        af.write(content)
-
-            print("✅ সেভ হয়েছে inbox ফোল্ডারে।")
+            # Parse once on the worker pool, then fan the result out to recipients
+            if spool_path:
+                extracted = await self.pipeline.extract_file(
+                    envelope.mail_from, envelope.rcpt_tos, spool_path,
+                    envelope.spool_digest, mail_store.spool_root)
+            else:
+                extracted = await self.pipeline.extract(envelope.mail_from, envelope.rcpt_tos, envelope.content)
+            timings.update(extracted.timings)
+            stage = "store"
+            entries = await self.storage.submit(store_message, extracted, self.index, timings)
+            print("✅ সেভ হয়েছে inbox ফোল্ডারে।")
+            self.metrics.inc("smtp_messages_total", result="accepted")
+            self.metrics.inc("smtp_message_bytes_total", size)
+            self.metrics.inc("smtp_recipients_total", len(envelope.rcpt_tos))
+            # Tell the web gateway exactly what arrived so it can push just this entry
+            for entry in entries:
+                # The body text only feeds the search index; keep events small
+                event = {key: value for key, value in entry.items() if key != "text"}
+                await self.events.publish({'type': 'new_message', **event})
+        except StorageQueueFull:
+            print("⏳ স্টোরেজ কিউ পূর্ণ — 451 পাঠানো হলো।")
+            self.metrics.inc("smtp_messages_total", result="busy")
+            return '451 4.3.0 Mailbox storage busy, try again later'
         except Exception as e:
-            print("❌ প্রসেসিংয়ে সমস্যা:", e)
+            print("❌ প্রসেসিংয়ে সমস্যা:", e)
+            self.metrics.inc("smtp_messages_total", result="failed")
+            self.metrics.inc("smtp_errors_total", stage=stage)
+            # Never answer 250 for mail that was not stored: the sender would
+            # consider it delivered and drop it
+            return '451 4.3.0 Error storing message, try again later'
+        finally:
+            if extracted is not None:
+                # Decoded attachments that never made it into the blob store
+                mail_store.discard(*[att.path for att in extracted.attachments])
+            timings['total'] = time.perf_counter() - started
+            for name, seconds in timings.items():
+                self.metrics.observe("smtp_stage_seconds", seconds, stage=name)
+            elapsed = timings['total'] + timings.get('receive', 0)
+            if self.slow_log.check(elapsed, sender=envelope.mail_from, recipients=len(envelope.rcpt_tos),
+                                   size=size, stages={name: round(s, 4) for name, s in timings.items()}):
+                print(f"🐢 ধীর মেইল: {elapsed:.2f}s ({self.slow_log.path} দেখুন)")
 
         return '250 Message accepted for delivery'
 
+
+async def serve_smtp(handler, args, metrics_port=0):
+    """Accept SMTP connections on a SO_REUSEPORT socket; the kernel spreads them over the workers."""
+    loop = asyncio.get_running_loop()
+    if metrics_port:
+        await serve_metrics(handler.metrics, port=metrics_port)
+    hostname = socket.getfqdn()
+    server = await loop.create_server(
+        lambda: SpoolingSMTP(handler, spool_threshold=args.spool_threshold,
+                             data_size_limit=args.max_message_size, hostname=hostname),
+        host=SMTP_HOST, port=SMTP_PORT, reuse_port=True)
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(args, number):
+    """Body of one receiver process in --workers mode."""
+    storage = StorageStage(workers=args.storage_workers, depth=args.queue_depth)
+    pipeline = ParsePipeline(workers=args.parse_workers)
+    handler = SMTPHandler(storage, pipeline, slow_log=SlowLog(args.slow_log, args.slow_threshold),
+                          policy=args.policy, admission=make_admission(args), shed_ratio=args.shed_ratio)
+    # One janitor is enough; two would only race each other over the same mailboxes
+    janitor = start_janitor(handler, args) if number == 1 else None
+    # Every worker keeps its own numbers, so each one gets its own metrics port
+    metrics_port = args.metrics_port + number - 1 if args.metrics_port else 0
+    print(f"👷 ওয়ার্কার {number} চালু হয়েছে (pid {os.getpid()}, মেট্রিক্স পোর্ট {metrics_port or '-'})")
+    try:
+        asyncio.run(serve_smtp(handler, args, metrics_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if janitor:
+            janitor.stop()
+        storage.shutdown()
+        pipeline.shutdown()
+
+
+def make_admission(args):
+    return AdmissionControl(args.max_connections, args.max_connections_per_ip,
+                            args.rate_messages, args.rate_bytes, args.rate_burst, args.max_message_size)
+
+
+def start_janitor(handler, args):
+    """Start the retention janitor if any retention limit is configured."""
+    if not args.policy.has_retention():
+        return None
+
+    def on_pass(removed, freed):
+        if removed or freed:
+            print(f"🧹 রিটেনশন: {removed}টি মেইল সরানো হয়েছে, {freed} বাইট খালি হয়েছে")
+
+    janitor = Janitor(mail_store, handler.index, args.policy, args.janitor_interval, args.archive_dir or None,
+                      on_pass=on_pass, on_error=lambda e: print("❌ রিটেনশনে সমস্যা:", e))
+    janitor.start()
+    archive = f", আর্কাইভ: {args.archive_dir}" if args.archive_dir else ""
+    print(f"🧹 রিটেনশন জ্যানিটর চালু হয়েছে (প্রতি {args.janitor_interval:g}s{archive})")
+    return janitor
+
+
+def run_workers(args):
+    """Run args.workers receiver processes that all listen on SMTP_PORT."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("❌ এই সিস্টেমে SO_REUSEPORT নেই — --workers 1 দিয়ে চালান।")
+        sys.exit(1)
+    # Create (or rebuild) the index once here so the workers don't race to do it
+    MailIndex(MAILBOX_DIR).close()
+    workers = [multiprocessing.Process(target=run_worker, args=(args, n + 1), name=f"smtp-worker-{n + 1}")
+               for n in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    print(f"📡 SMTP Server চালু হয়েছে — {SMTP_HOST}:{SMTP_PORT} ({args.workers} ওয়ার্কার)")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # A terminal Ctrl+C already reached the workers; a plain SIGINT to this process did not
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+        for worker in workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+    print("\n🛑 Server বন্ধ করা হয়েছে।")
+
+
+def init_store(args):
+    """Apply --storage/--compress to a new mailbox; an existing one keeps the format it was written in."""
+    global mail_store
+    fmt, options = read_format(MAILBOX_DIR)
+    if args.storage and (args.storage != fmt or args.compress != options.get("compress", False)):
+        if any(not name.startswith(".") for name in os.listdir(MAILBOX_DIR)):
+            print(f"❌ inbox/ ইতিমধ্যে '{fmt}' ফরম্যাটে আছে — রূপান্তর করতে: python segmentstore.py --to {args.storage}")
+            sys.exit(1)
+        write_format(MAILBOX_DIR, args.storage, **({"compress": True} if args.compress else {}))
+    mail_store = open_store(MAILBOX_DIR)
+    compressed = " (compressed)" if getattr(mail_store, "compress", False) else ""
+    print(f"🗄️  স্টোরেজ ফরম্যাট: {mail_store.format}{compressed}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local SMTP server that stores mail under inbox/")
+    parser.add_argument("--storage-workers", type=int, default=STORAGE_WORKERS,
+                        help="threads used for mailbox writes")
+    parser.add_argument("--queue-depth", type=int, default=STORAGE_QUEUE_DEPTH,
+                        help="messages waiting for storage before new ones get a 451")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="receiver processes sharing the SMTP port via SO_REUSEPORT")
+    parser.add_argument("--parse-workers", type=int, default=None,
+                        help="processes used for MIME parsing (0 = one background thread); "
+                             f"defaults to {PARSE_WORKERS}, or 0 per process with --workers")
+    parser.add_argument("--spool-threshold", type=int, default=SPOOL_THRESHOLD,
+                        help="bytes of DATA kept in memory before spooling to disk")
+    parser.add_argument("--max-message-size", type=int, default=MAX_MESSAGE_SIZE,
+                        help="largest accepted message in bytes (larger ones get a 552)")
+    parser.add_argument("--storage", choices=STORE_FORMATS,
+                        help="mailbox format for a new inbox/ (default: files, or whatever inbox/ already uses)")
+    parser.add_argument("--compress", action="store_true",
+                        help="zlib-compress stored items (segments format only)")
+    parser.add_argument("--metrics-port", type=int, default=SERVER_METRICS_PORT,
+                        help="port for GET /metrics in Prometheus format (0 = off; worker N uses port + N - 1)")
+    parser.add_argument("--slow-log", default=SLOW_LOG,
+                        help="file that gets a JSON line per slow message ('' = off)")
+    parser.add_argument("--slow-threshold", type=float, default=SLOW_THRESHOLD,
+                        help="seconds (receive + processing) before a message counts as slow")
+    parser.add_argument("--retain-days", type=float, default=0,
+                        help="delete mail older than this many days (0 = keep forever)")
+    parser.add_argument("--retain-messages", type=int, default=0,
+                        help="keep only the newest N messages per recipient (0 = no limit)")
+    parser.add_argument("--retain-bytes", type=int, default=0,
+                        help="keep only the newest messages that fit in N bytes per recipient (0 = no limit)")
+    parser.add_argument("--quota-messages", type=int, default=0,
+                        help="answer RCPT with 452 once a recipient holds N messages (0 = no quota)")
+    parser.add_argument("--quota-bytes", type=int, default=0,
+                        help="answer RCPT with 452 once a recipient holds N bytes (0 = no quota)")
+    parser.add_argument("--policy",
+                        help='JSON file with per-recipient overrides: {"recipients": {name: {"retain": ..., "quota": ...}}}')
+    parser.add_argument("--janitor-interval", type=float, default=JANITOR_INTERVAL,
+                        help="seconds between retention passes")
+    parser.add_argument("--archive-dir", default="",
+                        help="append expired mail to <dir>/<recipient>.mbox instead of just deleting it")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="open SMTP sessions before new ones get a 421 (0 = no limit; per worker)")
+    parser.add_argument("--max-connections-per-ip", type=int, default=0,
+                        help="open sessions per client IP before new ones get a 421 (0 = no limit; per worker)")
+    parser.add_argument("--rate-messages", type=float, default=0,
+                        help="messages per second per client IP before RCPT gets a 451 (0 = no limit)")
+    parser.add_argument("--rate-bytes", type=float, default=0,
+                        help="message bytes per second per client IP before RCPT gets a 451 (0 = no limit)")
+    parser.add_argument("--rate-burst", type=float, default=RATE_BURST,
+                        help="seconds' worth of the rate limits a quiet client may use at once")
+    parser.add_argument("--shed-ratio", type=float, default=SHED_RATIO,
+                        help="share of --queue-depth in use before new messages get a 451 (0 = off)")
+    args = parser.parse_args()
+    if args.compress and args.storage != "segments":
+        parser.error("--compress needs --storage segments")
+    retain = Limits(args.retain_days, args.retain_messages, args.retain_bytes)
+    quota = Limits(messages=args.quota_messages, bytes=args.quota_bytes)
+    try:
+        args.policy = RetentionPolicy.load(args.policy, retain, quota) if args.policy else RetentionPolicy(retain, quota)
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(f"--policy: {e}")
+    if args.parse_workers is None:
+        # With several receivers the cores are already busy; parse in-process
+        args.parse_workers = PARSE_WORKERS if args.workers == 1 else 0
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_args()
     os.makedirs(MAILBOX_DIR, exist_ok=True)
-    handler = SMTPHandler()
-    # Use port 2525 to avoid conflicts with privileged or system services
-    controller = Controller(handler, hostname="localhost", port=2525)
+    init_store(args)
+    if args.workers > 1:
+        run_workers(args)
+        sys.exit(0)
+    storage = StorageStage(workers=args.storage_workers, depth=args.queue_depth)
+    pipeline = ParsePipeline(workers=args.parse_workers)
+    handler = SMTPHandler(storage, pipeline, slow_log=SlowLog(args.slow_log, args.slow_threshold),
+                          policy=args.policy, admission=make_admission(args), shed_ratio=args.shed_ratio)
+    janitor = start_janitor(handler, args)
+    controller = SpoolingController(handler, spool_threshold=args.spool_threshold,
+                                    hostname=SMTP_HOST, port=SMTP_PORT,
+                                    data_size_limit=args.max_message_size)
     controller.start()
-    print("📡 SMTP Server চালু হয়েছে — localhost:2525")
+    print(f"📡 SMTP Server চালু হয়েছে — {SMTP_HOST}:{SMTP_PORT}")
+    if args.metrics_port:
+        # The metrics listener shares the controller's event loop
+        asyncio.run_coroutine_threadsafe(
+            serve_metrics(handler.metrics, port=args.metrics_port), controller.loop).result()
+        print(f"📊 মেট্রিক্স: http://localhost:{args.metrics_port}/metrics")
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         controller.stop()
-        print("\n🛑 Server বন্ধ করা হয়েছে।")
-
+        if janitor:
+            janitor.stop()
+        storage.shutdown()
+        pipeline.shutdown()
+        print("\n🛑 Server বন্ধ করা হয়েছে।")
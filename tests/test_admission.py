@@ -0,0 +1,24 @@
+from admission import AdmissionControl
+
+
+def test_low_message_rate_still_admits_one_message():
+    admission = AdmissionControl(messages_per_sec=0.1)
+    assert admission.check_message("10.0.0.1") is None
+    admission.charge("10.0.0.1", 100)
+    assert admission.check_message("10.0.0.1") == "messages"
+
+
+def test_low_byte_rate_still_admits_one_full_size_message():
+    admission = AdmissionControl(bytes_per_sec=10, max_message=1000)
+    assert admission.check_message("10.0.0.1") is None
+    admission.charge("10.0.0.1", 1500)
+    assert admission.check_message("10.0.0.1") == "bytes"
+
+
+def test_per_ip_connection_limit():
+    admission = AdmissionControl(per_ip=1)
+    assert admission.open("10.0.0.1") is None
+    assert admission.open("10.0.0.1") == "client_connections"
+    assert admission.open("10.0.0.2") is None
+    admission.close("10.0.0.1")
+    assert admission.open("10.0.0.1") is None
@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+
+import pytest
+
+import mail_index
+from mail_index import MailIndex
+from mailstore import Item, MailStore
+
+
+def entry(recipient, ts, subject="hello", text="", attachments=()):
+    return {"recipient": recipient, "ts": ts, "sender": "a@example.com", "subject": subject, "size": 100,
+            "eml": f"mail_{ts}.eml", "body": f"body_{ts}.txt", "attachments": list(attachments), "text": text}
+
+
+@pytest.fixture
+def index(tmp_path):
+    idx = MailIndex(str(tmp_path / "inbox"))
+    yield idx
+    idx.close()
+
+
+def test_search_reports_truncated_ranking(index, monkeypatch):
+    index.add([entry("bob", f"2024010{i}_000000") for i in range(1, 6)])
+    monkeypatch.setattr(mail_index, "SEARCH_RANK_WINDOW", 3)
+    hits, next_offset, truncated = index.search("hello", limit=10)
+    assert len(hits) == 3
+    assert next_offset is None
+    assert truncated
+
+    monkeypatch.setattr(mail_index, "SEARCH_RANK_WINDOW", 5)
+    hits, _, truncated = index.search("hello", limit=10)
+    assert len(hits) == 5
+    assert not truncated
+
+
+def test_search_pages(index):
+    index.add([entry("bob", f"2024010{i}_000000", subject=f"report {i}") for i in range(1, 6)])
+    hits, next_offset, _ = index.search("report", limit=2)
+    assert len(hits) == 2 and next_offset == 2
+    more, next_offset, _ = index.search("report", limit=2, offset=4)
+    assert len(more) == 1 and next_offset is None
+
+
+def test_search_does_not_take_the_shared_lock(index):
+    index.add([entry("bob", "20240101_000000")])
+    result = []
+    with index.lock:
+        # Held by a "delivery"; a search must still complete
+        thread = threading.Thread(target=lambda: result.append(index.search("hello")))
+        thread.start()
+        thread.join(5)
+    assert result and len(result[0][0]) == 1
+
+
+def test_attachment_filter_pages_through_its_own_index(index):
+    index.add([entry("bob", f"20240101_0000{i:02d}") for i in range(40)])
+    index.add([entry("bob", f"20240102_0000{i:02d}", attachments=[f"20240102_0000{i:02d}__a.pdf"])
+               for i in range(3)])
+    page, cursor = index.messages_page("bob", 2, with_attachments=True)
+    assert [e["ts"] for e in page] == ["20240102_000002", "20240102_000001"]
+    page, cursor = index.messages_page("bob", 2, cursor, with_attachments=True)
+    assert [e["ts"] for e in page] == ["20240102_000000"] and cursor is None
+
+    plan = " ".join(row[3] for row in index.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM messages WHERE recipient = ? AND has_attachments = 1"
+        " ORDER BY ts DESC, id DESC LIMIT 3", ("bob",)))
+    assert "messages_with_attachments" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_old_index_gets_the_attachment_column(tmp_path):
+    root = tmp_path / "inbox"
+    root.mkdir()
+    conn = sqlite3.connect(root / mail_index.INDEX_FILE_NAME)
+    conn.executescript("""
+        CREATE TABLE messages (id INTEGER PRIMARY KEY, recipient TEXT NOT NULL, ts TEXT NOT NULL, sender TEXT,
+            subject TEXT, size INTEGER, eml TEXT, body TEXT, attachments TEXT);
+        INSERT INTO messages (recipient, ts, attachments) VALUES ('bob', '1', '[]'), ('bob', '2', '["2__a.pdf"]');
+    """)
+    conn.executescript(mail_index.SEARCH_SCHEMA)
+    conn.commit()
+    conn.close()
+
+    idx = MailIndex(str(root))
+    try:
+        page, _ = idx.messages_page("bob", 10, with_attachments=True)
+        assert [e["ts"] for e in page] == ["2"]
+    finally:
+        idx.close()
+
+
+def test_rebuild_keeps_rows_delivered_while_it_scans(tmp_path, monkeypatch):
+    root = str(tmp_path / "inbox")
+    store = MailStore(root)
+    for ts in ("20240101_000001", "20240101_000002"):
+        store.write_items(["bob"], [Item(f"mail_{ts}.eml", data=b"x"), Item(f"body_{ts}.txt", data=b"x")])
+    index = MailIndex(root)
+    other = MailIndex(root)  # stands in for server.py delivering meanwhile
+    scan = mail_index.scan_folder
+
+    def scan_while_delivering(store, recipient):
+        entries = scan(store, recipient)
+        other.add([entry("bob", "20240101_000002"), entry("bob", "20240101_000003")])
+        return entries
+
+    monkeypatch.setattr(mail_index, "scan_folder", scan_while_delivering)
+    try:
+        index.rebuild()
+        assert sorted(e["ts"] for e in index.messages("bob")) == [
+            "20240101_000001", "20240101_000002", "20240101_000003"]
+        assert index.recipients() == [{"name": "bob", "count": 3}]
+    finally:
+        other.close()
+        index.close()
+
+
+def test_search_in_one_mailbox_does_not_match_similar_names(index):
+    index.add([entry(name, "20240101_000000") for name in ("bob_at_x_com", "bob_at_x_com_au", "evil_bob_at_x_com")])
+    hits, _, _ = index.search("hello", recipient="bob_at_x_com")
+    assert [hit["recipient"] for hit in hits] == ["bob_at_x_com"]
+    hits, _, _ = index.search("hello")
+    assert len(hits) == 3
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import mailstore
+from mailstore import Item, MailStore, attachment_names
+
+RECIPIENTS = ["a_at_example_com", "b_at_example_com"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MailStore(str(tmp_path))
+
+
+def test_payload_is_written_once_and_linked_per_recipient(store, tmp_path):
+    store.write_items(RECIPIENTS, [Item("mail_1.eml", data=b"raw message")])
+    paths = [os.path.join(tmp_path, recipient, "mail_1.eml") for recipient in RECIPIENTS]
+    assert os.path.samefile(*paths)
+    for recipient in RECIPIENTS:
+        with store.open_item(recipient, "mail_1.eml") as f:
+            assert f.read() == b"raw message"
+
+
+def test_compact_removes_blobs_nobody_links_to(store, monkeypatch):
+    monkeypatch.setattr(mailstore, "BLOB_GRACE", -1)
+    store.write_items(RECIPIENTS, [Item("mail_1.eml", data=b"raw message")])
+    store.delete_items(RECIPIENTS[0], ["mail_1.eml"])
+    assert store.compact() == 0
+    store.delete_items(RECIPIENTS[1], ["mail_1.eml"])
+    assert store.compact() == len(b"raw message")
+
+
+def test_item_names_cannot_escape_the_mailbox(store):
+    with pytest.raises(ValueError):
+        store.open_item("a_at_example_com", "../secret")
+    with pytest.raises(ValueError):
+        store.open_item(".blobs", "x")
+
+
+def test_attachment_names_are_plain_and_distinct():
+    names = attachment_names(["a.png", "a.png", "a.png", "../../etc/passwd", "C:\\x\\y.doc", "..", "", None],
+                             "attachment")
+    assert names == ["a.png", "a-1.png", "a-2.png", "passwd", "y.doc", "attachment", "attachment-1",
+                     "attachment-2"]
+
+
+def test_write_items_rejects_names_outside_the_folder(store):
+    with pytest.raises(ValueError):
+        store.write_items(RECIPIENTS, [Item("../escape", data=b"x")])
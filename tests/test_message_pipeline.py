@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+from email import policy
+from email.message import EmailMessage
+
+from message_pipeline import ParsePipeline, extract_message, extract_message_file
+
+FORWARDED = (
+    b"From: a@example.com\r\n"
+    b"To: b@example.com\r\n"
+    b"Subject: fwd\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b"Content-Type: multipart/mixed; boundary=BOUNDARY\r\n"
+    b"\r\n"
+    b"--BOUNDARY\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"\r\n"
+    b"see attached\r\n"
+    b"--BOUNDARY\r\n"
+    b"Content-Type: message/rfc822\r\n"
+    b"Content-Disposition: attachment; filename=inner.eml\r\n"
+    b"\r\n"
+    b"Subject: inner\r\n"
+    b"\r\n"
+    b"hello\r\n"
+    b"--BOUNDARY--\r\n"
+)
+
+
+def test_message_attachment_is_extracted_as_bytes():
+    extracted = extract_message("a@example.com", ["b@example.com"], FORWARDED)
+    [attachment] = extracted.attachments
+    assert attachment.content_type == "message/rfc822"
+    assert attachment.filename == "inner.eml"
+    assert isinstance(attachment.data, bytes)
+    assert attachment.data.startswith(b"Subject: inner\r\n\r\nhello")
+
+
+def test_pipeline_keeps_raw_on_the_caller_side():
+    pipeline = ParsePipeline(workers=0)
+    try:
+        extracted = asyncio.run(pipeline.extract("a@example.com", ["b@example.com"], FORWARDED))
+    finally:
+        pipeline.shutdown()
+    assert extracted.raw == FORWARDED
+    assert extracted.subject == "fwd"
+
+
+def build_message():
+    msg = EmailMessage()
+    msg["From"] = "a@example.com"
+    msg["To"] = "b@example.com"
+    msg["Subject"] = "both paths"
+    msg.set_content("first line\nsecond line\n" * 50)
+    msg.add_alternative("<p>html body</p>", subtype="html")
+    msg.add_attachment("one\ntwo\nthree\n" * 100, filename="notes.txt")
+    msg.add_attachment("café\n" * 20, filename="latin.txt", cte="quoted-printable")
+    msg.add_attachment(bytes(range(256)) * 40, maintype="application", subtype="octet-stream", filename="blob.bin")
+
+    nested = EmailMessage()
+    nested.set_content("nested text\n")
+    nested.add_attachment(b"\x89PNG" + bytes(100), maintype="image", subtype="png", filename="pic.png")
+    msg.attach(nested)
+
+    inner = EmailMessage()
+    inner["Subject"] = "inner"
+    inner.set_content("forwarded\n")
+    msg.add_attachment(inner, filename="inner.eml")
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def test_spooled_and_in_memory_parsing_agree(tmp_path):
+    raw = build_message()
+    path = tmp_path / "message.eml"
+    path.write_bytes(raw)
+    in_memory = extract_message("a@example.com", ["b@example.com"], raw)
+    spooled = extract_message_file("a@example.com", ["b@example.com"], str(path), "", str(tmp_path / "work"))
+
+    assert spooled.text == in_memory.text
+    assert "\r" not in in_memory.text
+    assert in_memory.text.startswith("first line\nsecond line\n")
+    assert "nested text" in in_memory.text
+
+    def attachments(extracted):
+        result = []
+        for att in extracted.attachments:
+            data = att.data
+            if att.path:
+                with open(att.path, "rb") as f:
+                    data = f.read()
+                assert att.digest == hashlib.sha256(data).hexdigest()
+            result.append((att.filename, att.content_type, data))
+        return result
+
+    expected = attachments(in_memory)
+    assert [name for name, _, _ in expected] == ["notes.txt", "latin.txt", "blob.bin", "pic.png", "inner.eml"]
+    assert attachments(spooled) == expected
+    assert expected[2][2] == bytes(range(256)) * 40
@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import smtplib
+import socket
+
+from aiosmtpd.controller import Controller
+
+import outbound
+from outbound import SMTPSessionPool
+
+
+class FakeSession:
+    def __init__(self):
+        self.sent = 0
+        self.closed = False
+
+    def rset(self):
+        pass
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        self.sent += 1
+        return {}
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(SMTPSessionPool):
+    def __init__(self, **kwargs):
+        super().__init__("localhost", 0, **kwargs)
+        self.sessions = []
+
+    def _connect(self):
+        self.sessions.append(FakeSession())
+        return self.sessions[-1]
+
+
+def test_idle_sessions_are_closed_after_a_sequential_send():
+    async def run():
+        pool = FakePool(idle_timeout=0.2)
+        try:
+            await pool.send("message")
+            await pool.send("message")
+            assert len(pool.sessions) == 1  # the session was reused
+            await asyncio.sleep(0.6)
+            assert pool.idle == []
+            assert pool.sessions[0].closed
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+class Sink:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return "250 OK"
+
+
+def test_send_file_sync_streams_with_crlf_and_dot_stuffing(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbound, "DATA_LINE_LIMIT", 8)  # lines are read in pieces
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    sink = Sink()
+    controller = Controller(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        path = tmp_path / "queued.eml"
+        # LF endings as the outbox writes them; only the dot at the start of a whole line is doubled
+        long_line = b"." + b"x" * 7 + b"." * 10
+        path.write_bytes(b"Subject: hi\n\n.\n..two\n" + long_line + b"\n.last")
+        with smtplib.SMTP("127.0.0.1", port) as session:
+            refused = outbound.send_file_sync(session, path, "a@example.com", ["b@example.com"])
+    finally:
+        controller.stop()
+
+    assert refused == {}
+    envelope, = sink.envelopes
+    assert envelope.rcpt_tos == ["b@example.com"]
+    assert envelope.original_content == b"Subject: hi\r\n\r\n.\r\n..two\r\n" + long_line + b"\r\n.last\r\n"
+
+
+def test_encoded_size_counts_base64_lines_with_crlf():
+    for size in (0, 1, 57, 58, outbound.ENCODE_CHUNK + 3):
+        encoded = base64.encodebytes(b"\0" * size)
+        assert outbound.encoded_size(size) == len(encoded) + encoded.count(b"\n")  # LF becomes CRLF on the wire
+
+
+def test_send_many_clamps_parallelism_to_the_pool():
+    class CountingPool(FakePool):
+        async def send(self, msg, from_addr=None, to_addrs=None):
+            self.senders.add(asyncio.current_task())
+            await asyncio.sleep(0)
+            return await super().send(msg, from_addr, to_addrs)
+
+    async def run(parallelism):
+        pool = CountingPool(concurrency=2)
+        pool.senders = set()
+        try:
+            results = [result async for result in pool.send_many(["message"] * 20, parallelism)]
+        finally:
+            await pool.close()
+        assert sorted(index for index, _, _ in results) == list(range(20))
+        return len(pool.senders)
+
+    assert asyncio.run(run(10 ** 6)) == 2
+    assert asyncio.run(run(-5)) == 1
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+import pytest
+
+from outbox import Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    box = Outbox(pool=None, root=str(tmp_path / "outbox"))
+    box._open_sync()
+    yield box
+    box.conn.close()
+    box.db_thread.shutdown()
+
+
+def test_queue_ids_are_not_reused(outbox):
+    first = outbox._enqueue_sync(b"Subject: 1\r\n\r\n", "a@example.com", ["b@example.com"], "1")
+    path = outbox.conn.execute("SELECT path FROM outbox WHERE id = ?", (first,)).fetchone()["path"]
+    outbox._delete_sync(first, path)
+    second = outbox._enqueue_sync(b"Subject: 2\r\n\r\n", "a@example.com", ["b@example.com"], "2")
+    assert second != first
+
+
+def test_old_queue_is_migrated_to_autoincrement(tmp_path):
+    root = tmp_path / "outbox"
+    root.mkdir()
+    conn = sqlite3.connect(root / "queue.sqlite3")
+    conn.executescript("""
+        CREATE TABLE outbox (id INTEGER PRIMARY KEY, created REAL NOT NULL, next_attempt REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, destination TEXT, sender TEXT,
+            recipients TEXT, subject TEXT, path TEXT, last_error TEXT);
+        CREATE INDEX outbox_due ON outbox (status, next_attempt);
+        INSERT INTO outbox (id, created, next_attempt, status, destination, recipients)
+            VALUES (7, 0, 0, 'queued', 'example.com', '["b@example.com"]');
+    """)
+    conn.commit()
+    conn.close()
+
+    box = Outbox(pool=None, root=str(root))
+    box._open_sync()
+    try:
+        sql = box.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'outbox'").fetchone()["sql"]
+        assert "AUTOINCREMENT" in sql
+        assert [row["id"] for row in box._due_sync()] == [7]
+        path = box._write_sync(lambda f: f.write(b""))
+        assert box._record_sync(path, "a@example.com", ["b@example.com"], "") == 8
+        assert os.path.exists(path)
+    finally:
+        box.conn.close()
+        box.db_thread.shutdown()
+
+
+def test_backlog_for_a_saturated_destination_does_not_block_others(outbox):
+    for i in range(150):
+        outbox._enqueue_sync(b"", "a@example.com", [f"u{i}@slow.example"], "")
+    other = outbox._enqueue_sync(b"", "a@example.com", ["b@fast.example"], "")
+    assert outbox._due_sync(1)[0]["destination"] == "slow.example"
+    [job] = outbox._due_sync(1, ["slow.example"])
+    assert job["id"] == other
+
+
+def test_claim_skips_destinations_at_their_limit(outbox):
+    for i in range(150):
+        outbox._enqueue_sync(b"", "a@example.com", [f"u{i}@slow.example"], "")
+    other = outbox._enqueue_sync(b"", "a@example.com", ["b@fast.example"], "")
+    outbox.in_flight["slow.example"] = outbox.per_destination
+
+    async def claim():
+        outbox.claim_lock = asyncio.Lock()
+        return await outbox._claim()
+
+    assert asyncio.run(claim())["id"] == other
+    assert outbox.in_flight["fast.example"] == 1
+
+
+class RefusingPool:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.sent = []
+
+    async def send_file(self, path, from_addr, to_addrs):
+        self.sent.append(list(to_addrs))
+        return self.results.pop(0)
+
+
+def deliver(outbox, queue_id):
+    statuses = []
+
+    async def on_status(queue_id, status, error):
+        statuses.append(status)
+
+    async def run():
+        outbox.on_status = on_status
+        job = dict(outbox.conn.execute("SELECT * FROM outbox WHERE id = ?", (queue_id,)).fetchone())
+        await outbox._deliver(job)
+
+    asyncio.run(run())
+    return statuses
+
+
+def test_refused_recipients_are_retried_or_failed(outbox):
+    recipients = ["ok@example.com", "full@example.com", "gone@example.com"]
+    outbox.pool = RefusingPool({"full@example.com": (452, b"4.2.2 Mailbox full"),
+                                "gone@example.com": (550, b"5.1.1 No such user")}, {})
+    queue_id = outbox._enqueue_sync(b"Subject: hi\r\n\r\nbody\r\n", "a@example.com", recipients, "hi")
+
+    assert deliver(outbox, queue_id) == ["retrying"]
+    rows = {row["id"]: dict(row) for row in outbox.conn.execute("SELECT * FROM outbox")}
+    assert json.loads(rows[queue_id]["recipients"]) == ["full@example.com"]
+    assert rows[queue_id]["status"] == "queued"
+    [failed] = [row for row in rows.values() if row["id"] != queue_id]
+    assert failed["status"] == "failed"
+    assert json.loads(failed["recipients"]) == ["gone@example.com"]
+
+    # The retry only goes to the temporarily refused recipient
+    assert deliver(outbox, queue_id) == ["delivered"]
+    assert outbox.pool.sent[1] == ["full@example.com"]
+    # The failed entry still has its message
+    assert os.path.exists(failed["path"])
+
+
+def test_permanently_refused_recipients_fail_the_entry(outbox):
+    outbox.pool = RefusingPool({"gone@example.com": (550, b"5.1.1 No such user")})
+    queue_id = outbox._enqueue_sync(b"", "a@example.com", ["ok@example.com", "gone@example.com"], "")
+    assert deliver(outbox, queue_id) == ["failed"]
+    row = outbox.conn.execute("SELECT * FROM outbox WHERE id = ?", (queue_id,)).fetchone()
+    assert row["status"] == "failed"
+    assert json.loads(row["recipients"]) == ["gone@example.com"]
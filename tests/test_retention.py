@@ -0,0 +1,106 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from mail_index import MailIndex
+from mailstore import Item, MailStore
+from retention import Janitor, Limits, RetentionPolicy
+
+DAYS = ["20240101_000000", "20240102_000000", "20240103_000000", "20240104_000000", "20240105_000000"]
+
+
+def entry(recipient, ts, size=100):
+    return {"recipient": recipient, "ts": ts, "sender": "a@example.com", "subject": "hello", "size": size,
+            "eml": f"mail_{ts}.eml", "body": f"body_{ts}.txt", "attachments": []}
+
+
+@pytest.fixture
+def index(tmp_path):
+    idx = MailIndex(str(tmp_path / "inbox"))
+    yield idx
+    idx.close()
+
+
+def deliver(store, index, recipient, ts):
+    raw = f"Subject: {ts}\r\n\r\nFrom the start of a line\r\n".encode()
+    store.write_items([recipient], [Item(f"mail_{ts}.eml", data=raw), Item(f"body_{ts}.txt", data=b"body")])
+    index.add([entry(recipient, ts, size=len(raw))])
+
+
+def stamps(entries):
+    return [e["ts"] for e in entries]
+
+
+def test_expired_by_age(index):
+    index.add([entry("bob", ts) for ts in DAYS])
+    assert stamps(index.expired("bob", before_ts="20240103_000000")) == DAYS[:2]
+
+
+def test_expired_by_count(index):
+    index.add([entry("bob", ts) for ts in DAYS])
+    assert stamps(index.expired("bob", keep_messages=2)) == DAYS[:3]
+
+
+def test_expired_by_bytes(index):
+    index.add([entry("bob", ts) for ts in DAYS])
+    # The newest two add up to 200 bytes; the third would make it 300
+    assert stamps(index.expired("bob", keep_bytes=250)) == DAYS[:3]
+
+
+def test_expired_leaves_other_recipients_and_respects_limit(index):
+    index.add([entry("bob", ts) for ts in DAYS] + [entry("carol", DAYS[0])])
+    assert stamps(index.expired("bob", keep_messages=1, limit=2)) == DAYS[:2]
+    assert index.expired("carol", keep_messages=1) == []
+
+
+def test_janitor_deletes_expired_mail(tmp_path, index):
+    store = MailStore(str(tmp_path / "inbox"))
+    recent = f"{datetime.now() - timedelta(hours=1):%Y%m%d_%H%M%S}"
+    for ts in (DAYS[0], DAYS[1], recent):
+        deliver(store, index, "bob", ts)
+    janitor = Janitor(store, index, RetentionPolicy(retain=Limits(days=7)))
+
+    removed, _ = janitor.run_once()
+    assert removed == 2
+    assert stamps(index.messages("bob")) == [recent]
+    assert sorted(os.listdir(tmp_path / "inbox" / "bob")) == [f"body_{recent}.txt", f"mail_{recent}.eml"]
+    assert janitor.run_once() == (0, 0)
+
+
+def test_janitor_archives_before_deleting(tmp_path, index):
+    store = MailStore(str(tmp_path / "inbox"))
+    for ts in DAYS[:3]:
+        deliver(store, index, "bob", ts)
+    archive = tmp_path / "archive"
+    janitor = Janitor(store, index, RetentionPolicy(retain=Limits(messages=1)), archive_dir=str(archive), batch=1)
+
+    removed, _ = janitor.run_once()
+    assert removed == 2
+    assert stamps(index.messages("bob")) == [DAYS[2]]
+    mbox = (archive / "bob.mbox").read_bytes()
+    assert mbox.count(b"From MAILER-DAEMON ") == 2
+    assert f"Subject: {DAYS[0]}\n".encode() in mbox and f"Subject: {DAYS[1]}\n".encode() in mbox
+    assert b"\n>From the start of a line\n" in mbox
+
+
+def test_over_quota_by_count_and_bytes():
+    policy = RetentionPolicy(quota=Limits(messages=2, bytes=1000))
+    assert not policy.over_quota("bob", 1, 999)
+    assert policy.over_quota("bob", 2, 0)
+    assert policy.over_quota("bob", 0, 1000)
+    assert not RetentionPolicy().over_quota("bob", 10 ** 6, 10 ** 12)
+
+
+def test_policy_file_overrides_the_defaults(tmp_path):
+    path = tmp_path / "policy.json"
+    path.write_text('{"recipients": {"bob": {"quota": {"messages": 5}}, "carol": {"retain": {"days": 1}}}}')
+    policy = RetentionPolicy.load(str(path), quota=Limits(messages=2, bytes=1000))
+    assert not policy.over_quota("bob", 4, 0)
+    assert policy.over_quota("bob", 0, 1000)  # the default byte quota still applies
+    assert policy.over_quota("carol", 2, 0)
+    assert policy.retention_for("carol") == Limits(days=1)
+
+    path.write_text('{"recipients": {"bob": {"quota": {"mesages": 5}}}}')
+    with pytest.raises(ValueError):
+        RetentionPolicy.load(str(path))
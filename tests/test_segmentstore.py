@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import segmentstore
+from mailstore import Item, MailStore, write_format
+from segmentstore import SHARED_DIR_NAME, SegmentStore, migrate
+
+RECIPIENTS = ["a_at_example_com", "b_at_example_com", "c_at_example_com"]
+
+
+def segment_bytes(root):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(root) for name in names if name.endswith(".dat"))
+
+
+def read(store, recipient, name):
+    with store.open_item(recipient, name) as f:
+        return f.read()
+
+
+@pytest.fixture
+def store(tmp_path):
+    write_format(str(tmp_path), "segments")
+    return SegmentStore(str(tmp_path))
+
+
+def test_payload_for_several_recipients_is_stored_once(store, tmp_path):
+    payload = os.urandom(100_000)
+    store.write_items(RECIPIENTS, [Item("1__report.pdf", data=payload)])
+    assert segment_bytes(tmp_path) == len(payload)
+    for recipient in RECIPIENTS:
+        assert store.list_entries(recipient) == ["1__report.pdf"]
+        assert read(store, recipient, "1__report.pdf") == payload
+
+    # The same bytes in a later message are not written again
+    store.write_items(RECIPIENTS[:2], [Item("2__copy.pdf", data=payload)])
+    assert segment_bytes(tmp_path) == len(payload)
+    assert read(store, RECIPIENTS[1], "2__copy.pdf") == payload
+
+
+def test_shared_payload_is_reclaimed_once_every_reference_is_gone(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(segmentstore, "SEGMENT_SIZE", 1)  # every write seals the segment before it
+    payload = os.urandom(50_000)
+    store.write_items(RECIPIENTS, [Item("1__a.bin", data=payload)])
+    store.write_items(RECIPIENTS, [Item("2__b.bin", data=b"later")])
+
+    for recipient in RECIPIENTS[:2]:
+        store.delete_items(recipient, ["1__a.bin"])
+    assert store.compact() == 0
+    assert read(store, RECIPIENTS[2], "1__a.bin") == payload
+
+    store.delete_items(RECIPIENTS[2], ["1__a.bin"])
+    assert store.compact() == len(payload)
+    assert segment_bytes(tmp_path / SHARED_DIR_NAME) == len(b"later")
+    assert read(store, RECIPIENTS[0], "2__b.bin") == b"later"
+
+
+def test_migrate_keeps_payloads_shared(tmp_path):
+    root = str(tmp_path / "inbox")
+    files = MailStore(root)
+    payload = os.urandom(20_000)
+    files.write_items(RECIPIENTS, [Item("1__a.bin", data=payload), Item("body_1.txt", data=b"hi")])
+    files.write_items(RECIPIENTS[:1], [Item("body_2.txt", data=b"only a")])
+
+    count, _ = migrate(root, "segments")
+    assert count == 7
+    store = SegmentStore(root)
+    assert segment_bytes(root) == len(payload) + len(b"hi") + len(b"only a")
+    assert read(store, RECIPIENTS[2], "1__a.bin") == payload
+    assert read(store, RECIPIENTS[0], "body_2.txt") == b"only a"
+
+
+@pytest.mark.parametrize("recipients", [RECIPIENTS[:1], RECIPIENTS])
+def test_names_are_never_stored_twice(store, recipients):
+    with pytest.raises(FileExistsError):
+        store.write_items(recipients, [Item("1__a.png", data=b"one"), Item("1__a.png", data=b"two")])
+    store.write_items(recipients, [Item("1__a.png", data=b"one")])
+    with pytest.raises(FileExistsError):
+        store.write_items(recipients, [Item("1__a.png", data=b"two")])
+    assert store.list_entries(recipients[0]) == ["1__a.png"]
+    assert read(store, recipients[0], "1__a.png") == b"one"
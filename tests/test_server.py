@@ -0,0 +1,207 @@
+import asyncio
+import importlib
+import smtplib
+import socket
+import threading
+from email import policy
+from email.message import EmailMessage
+from types import SimpleNamespace
+
+import pytest
+
+from mail_index import MailIndex
+from mailstore import open_store, write_format
+from message_pipeline import ParsePipeline, extract_message
+from retention import Limits, RetentionPolicy
+from test_message_pipeline import FORWARDED
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # server.py opens ./inbox when it is imported
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module("server")
+    monkeypatch.setattr(module, "mail_store", module.open_store(str(tmp_path / "inbox")))
+    return module
+
+
+class FailingStorage:
+    depth = 8
+    pending = 0
+
+    def is_full(self):
+        return False
+
+    async def submit(self, func, *args):
+        raise OSError("disk full")
+
+
+def test_handle_data_does_not_accept_mail_it_failed_to_store(server):
+    handler = server.SMTPHandler(storage=FailingStorage(), pipeline=ParsePipeline(workers=0), index=object(),
+                                 events=object())
+    envelope = SimpleNamespace(mail_from="a@example.com", rcpt_tos=["b@example.com"],
+                               content=b"Subject: hi\r\n\r\nbody\r\n")
+    session = SimpleNamespace(peer=("127.0.0.1", 1234))
+    status = asyncio.run(handler.handle_DATA(None, session, envelope))
+    assert status.startswith("451")
+
+
+def test_store_message_with_forwarded_attachment(server, tmp_path):
+    index = MailIndex(str(tmp_path / "inbox"))
+    extracted = extract_message("a@example.com", ["b@example.com"], FORWARDED)
+    extracted.raw = FORWARDED
+    [entry] = server.store_message(extracted, index)
+    [name] = entry["attachments"]
+    with server.mail_store.open_item("b_at_example_com", name) as f:
+        assert f.read().startswith(b"Subject: inner")
+    assert index.messages("b_at_example_com")[0]["attachments"] == [name]
+
+
+def test_storage_stage_refuses_work_past_its_depth(server):
+    stage = server.StorageStage(workers=1, depth=1)
+    release = threading.Event()
+
+    async def run():
+        first = asyncio.ensure_future(stage.submit(release.wait))
+        await asyncio.sleep(0)
+        assert stage.is_full()
+        with pytest.raises(server.StorageQueueFull):
+            await stage.submit(release.wait)
+        release.set()
+        await first
+        assert stage.pending == 0
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        stage.shutdown()
+
+
+def message_with_attachments(*named):
+    msg = EmailMessage()
+    msg["From"] = "a@example.com"
+    msg["To"] = "b@example.com"
+    msg["Subject"] = "files"
+    msg.set_content("see attached\n")
+    for filename, data in named:
+        msg.add_attachment(data, maintype="application", subtype="octet-stream", filename=filename)
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def deliver(server, handler, raw):
+    envelope = SimpleNamespace(mail_from="a@example.com", rcpt_tos=["b@example.com"], content=raw)
+    session = SimpleNamespace(peer=("127.0.0.1", 1234))
+    return asyncio.run(handler.handle_DATA(None, session, envelope))
+
+
+@pytest.fixture
+def handler(server, tmp_path):
+    pipeline = ParsePipeline(workers=0)
+    handler = server.SMTPHandler(storage=server.StorageStage(workers=1), pipeline=pipeline,
+                                 index=MailIndex(str(tmp_path / "inbox")), events=SimpleNamespace(publish=noop))
+    yield handler
+    handler.index.close()
+    handler.storage.shutdown()
+    pipeline.shutdown()
+
+
+async def noop(event):
+    pass
+
+
+def test_repeated_and_unsafe_attachment_names_are_stored_apart(server, handler):
+    raw = message_with_attachments(("image.png", b"one"), ("image.png", b"two"), ("../../x", b"three"),
+                                   ("dir/report.pdf", b"four"), (".hidden", b"five"))
+    assert deliver(server, handler, raw).startswith("250")
+    [entry] = handler.index.messages("b_at_example_com")
+    names = [name.split("__", 1)[1] for name in entry["attachments"]]
+    assert names == ["image.png", "image-1.png", "x", "report.pdf", "hidden"]
+    contents = []
+    for name in entry["attachments"]:
+        with server.mail_store.open_item("b_at_example_com", name) as f:
+            contents.append(f.read())
+    assert contents == [b"one", b"two", b"three", b"four", b"five"]
+
+
+def test_failed_delivery_leaves_no_orphaned_items(server, handler, monkeypatch):
+    def fail(entries):
+        raise OSError("index unavailable")
+
+    monkeypatch.setattr(handler.index, "add", fail)
+    raw = message_with_attachments(("a.pdf", b"data"))
+    assert deliver(server, handler, raw).startswith("451")
+    assert server.mail_store.list_entries("b_at_example_com") == []
+
+
+def test_repeated_attachment_names_on_the_segments_backend(server, handler, tmp_path, monkeypatch):
+    root = str(tmp_path / "segments")
+    write_format(root, "segments")
+    monkeypatch.setattr(server, "mail_store", open_store(root))
+    raw = message_with_attachments(("image.png", b"one"), ("image.png", b"two"))
+    assert deliver(server, handler, raw).startswith("250")
+    [entry] = handler.index.messages("b_at_example_com")
+    assert len(set(entry["attachments"])) == 2
+    contents = []
+    for name in entry["attachments"]:
+        with server.mail_store.open_item("b_at_example_com", name) as f:
+            contents.append(f.read())
+    assert contents == [b"one", b"two"]
+
+
+class Sink:
+    def __init__(self):
+        self.contents = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.contents.append(envelope.content)
+        return "250 OK"
+
+
+@pytest.fixture
+def smtp(server):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    sink = Sink()
+    controller = server.SpoolingController(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        with smtplib.SMTP("127.0.0.1", port) as session:
+            yield session, sink
+    finally:
+        controller.stop()
+
+
+def test_help_lists_data(smtp):
+    session, _ = smtp
+    code, reply = session.docmd("HELP")
+    assert code == 250
+    assert b"DATA" in reply.split()
+    assert session.docmd("HELP", "DATA") == (250, b"Syntax: DATA")
+
+
+def test_data_rejects_lines_over_the_limit(smtp):
+    session, sink = smtp
+    session.ehlo()
+    for line, expected in ((b"x" * 999, 250), (b"x" * 1000, 500)):  # the limit is 1001 bytes with CRLF
+        session.mail("a@example.com")
+        session.rcpt("b@example.com")
+        assert session.docmd("DATA")[0] == 354
+        session.send(b"Subject: long\r\n\r\n" + line + b"\r\n.\r\n")
+        assert session.getreply()[0] == expected
+    assert len(sink.contents) == 1
+
+
+def test_rcpt_refuses_a_recipient_over_quota(server, handler):
+    handler.policy = RetentionPolicy(quota=Limits(messages=1))
+    session = SimpleNamespace(peer=("127.0.0.1", 1234))
+
+    def rcpt(address):
+        envelope = SimpleNamespace(rcpt_tos=[])
+        return asyncio.run(handler.handle_RCPT(None, session, envelope, address, []))
+
+    assert rcpt("b@example.com") == "250 OK"
+    assert deliver(server, handler, message_with_attachments()) == "250 Message accepted for delivery"
+    assert rcpt("b@example.com").startswith("452 ")
+    assert rcpt("c@example.com") == "250 OK"
@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import pytest
+
+import web_server
+from web_server import ResponseCache, WebSMTPHandler, upload_content_type
+
+
+@pytest.mark.parametrize("reported, expected", [
+    ("text/plain", "text/plain"),
+    ("image/PNG", "image/png"),
+    ("application/pdf", "application/pdf"),
+    ("text/csv; charset=utf-8", "text/csv"),
+    ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+     "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+])
+def test_upload_content_type_keeps_discrete_types(reported, expected):
+    assert upload_content_type(reported) == expected
+
+
+@pytest.mark.parametrize("reported", [
+    "message/rfc822", "multipart/mixed", "", None, "text", "text/", "font/woff2", "a/b/c", "x-foo/bar",
+])
+def test_upload_content_type_falls_back_to_octet_stream(reported):
+    assert upload_content_type(reported) == "application/octet-stream"
+
+
+def test_cache_evicts_least_recently_used_by_bytes():
+    cache = ResponseCache(max_bytes=10, ttl=60)
+    cache.put("a", "aaaa", "t", 0)
+    cache.put("b", "bbbb", "t", 0)
+    assert cache.get("a") == "aaaa"  # now b is the least recently used
+    cache.put("c", "cccc", "t", 0)
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa" and cache.get("c") == "cccc"
+    assert cache.bytes == 8
+
+    cache.put("a", "aaaaaa", "t", 0)  # replacing an entry counts only the new frame
+    assert cache.bytes == 10
+    cache.put("huge", "x" * 11, "t", 0)  # bigger than the whole cache: not stored, nothing evicted
+    assert cache.get("huge") is None and cache.bytes == 10
+
+
+def test_cache_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(web_server.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(max_bytes=100, ttl=30)
+    cache.put("a", "frame", "t", 0)
+    now[0] += 29
+    assert cache.get("a") == "frame"
+    now[0] += 2
+    assert cache.get("a") is None
+    assert cache.bytes == 0 and cache.tags == {}
+
+
+def test_cache_invalidate_drops_entries_and_stale_puts():
+    cache = ResponseCache(max_bytes=100, ttl=60)
+    cache.put("a", "frame a", ("emails", "bob"), 0)
+    cache.put("b", "frame b", ("emails", "carol"), 0)
+    stale = cache.version(("emails", "bob"))
+
+    cache.invalidate(("emails", "bob"))
+    assert cache.get("a") is None
+    assert cache.get("b") == "frame b"
+    assert cache.bytes == len("frame b")
+
+    # A frame built before the invalidation must not come back
+    cache.put("a", "old frame", ("emails", "bob"), stale)
+    assert cache.get("a") is None
+    cache.put("a", "new frame", ("emails", "bob"), cache.version(("emails", "bob")))
+    assert cache.get("a") == "new frame"
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.queued = []
+
+    async def enqueue_file(self, write, sender, recipients, subject):
+        self.queued.append(subject)
+        return len(self.queued)
+
+
+def finished_upload(tmp_path, name, size):
+    path = tmp_path / name
+    f = open(path, "wb")  # left empty: the size check uses the received count
+    f.close()
+    return {'name': name, 'content_type': 'application/pdf', 'size': size, 'received': size,
+            'file': f, 'path': str(path), 'done': True}
+
+
+def test_send_with_uploads_refuses_attachments_over_the_message_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outbox = FakeOutbox()
+    handler = WebSMTPHandler(outbound=object(), outbox=outbox)
+    websocket = FakeWebsocket()
+    each = web_server.UPLOAD_MAX_SIZE
+    handler.uploads[websocket] = {1: finished_upload(tmp_path, "a.pdf", each),
+                                  2: finished_upload(tmp_path, "b.pdf", each)}
+
+    asyncio.run(handler.send_with_uploads(websocket, "a@example.com", ["b@example.com"], "two", "body", [1, 2]))
+    assert websocket.sent[-1]['type'] == 'error'
+    assert outbox.queued == []
+    assert set(handler.uploads[websocket]) == {1, 2}  # kept so the client can drop one and retry
+
+    asyncio.run(handler.send_with_uploads(websocket, "a@example.com", ["b@example.com"], "one", "body", [1]))
+    assert websocket.sent[-1]['type'] == 'send_success'
+    assert outbox.queued == ["one"]
@@ -4,6 +4,17 @@ let ws = null;
 let attachments = [];
 let selectedRecipient = null;
 let selectedEmail = null;
+let recipientsData = [];
+let searchQuery = null;  // set while the email list shows search results
+let searchOffset = null;
+let emailsCursor = null;
+let emailsLoading = false;
+let nextDownloadId = 1;
+const downloads = {};  // id -> { recipient, filename, chunks, received, size, offset }
+let nextUploadId = 1;
+
+const EMAILS_PAGE_SIZE = 50;
+const UPLOAD_WINDOW = 4;  // upload frames sent ahead of the server's acks
 
 // DOM Elements
 const statusIndicator = document.getElementById('statusIndicator');
@@ -19,6 +30,9 @@ const attachmentList = document.getElementById('attachmentList');
 const recipientsList = document.getElementById('recipientsList');
 const emailsList = document.getElementById('emailsList');
 const emailContent = document.getElementById('emailContent');
+const emailSort = document.getElementById('emailSort');
+const emailFilter = document.getElementById('emailFilter');
+const searchInput = document.getElementById('searchInput');
 
 // Initialize
 window.addEventListener('load', () => {
@@ -29,15 +43,22 @@ window.addEventListener('load', () => {
 // WebSocket Connection
 function connectWebSocket() {
     ws = new WebSocket('ws://localhost:8787');
+    ws.binaryType = 'arraybuffer';
 
     ws.onopen = () => {
         console.log('Connected to WebSocket server');
         updateConnectionStatus(true);
         showStatus('Connected to SMTP server', 'success');
         loadInbox();
+        resumeDownloads();
+        restartUploads();
     };
 
     ws.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer) {
+            handleDownloadChunk(event.data);
+            return;
+        }
         const data = JSON.parse(event.data);
         handleMessage(data);
     };
@@ -78,7 +99,6 @@ function handleMessage(data) {
         case 'send_success':
             showStatus(data.message, 'success');
             clearForm();
-            loadInbox();
             break;
 
         case 'recipients':
@@ -86,15 +106,66 @@ function handleMessage(data) {
             break;
 
         case 'emails':
-            displayEmails(data.data, data.recipient);
+            displayEmails(data);
             break;
 
         case 'email_content':
-            displayEmailContent(data.content, data.is_binary);
+            displayEmailContent(data);
             break;
 
-        case 'inbox_updated':
-            loadInbox();
+        case 'download_start':
+            if (downloads[data.id]) {
+                downloads[data.id].size = data.size;
+            }
+            break;
+
+        case 'download_end':
+            finishDownload(data);
+            break;
+
+        case 'download_error':
+            delete downloads[data.id];
+            showStatus(data.message, 'error');
+            break;
+
+        case 'upload_ready':
+            handleUploadReady(data);
+            break;
+
+        case 'upload_progress':
+            handleUploadProgress(data);
+            break;
+
+        case 'upload_done':
+            handleUploadDone(data);
+            break;
+
+        case 'upload_error':
+            attachments = attachments.filter(att => att.id !== data.id);
+            updateAttachmentDisplay();
+            showStatus(data.message, 'error');
+            break;
+
+        case 'delivery_status':
+            if (data.status === 'delivered') {
+                showStatus('✅ Email delivered', 'success');
+            } else if (data.status === 'failed') {
+                showStatus(`❌ Delivery failed: ${data.error}`, 'error');
+            } else {
+                showStatus(`⏳ Delivery delayed, retrying: ${data.error}`, '');
+            }
+            break;
+
+        case 'search_results':
+            displaySearchResults(data);
+            break;
+
+        case 'recipient_count':
+            updateRecipientCount(data.name, data.delta);
+            break;
+
+        case 'new_message':
+            addNewEmails(data);
             break;
 
         case 'error':
@@ -114,28 +185,125 @@ function setupEventListeners() {
     refreshBtn.addEventListener('click', loadInbox);
 
     fileInput.addEventListener('change', handleFileSelect);
+
+    // Load the next page when the email list is scrolled near its end
+    emailsList.addEventListener('scroll', () => {
+        if (emailsList.scrollTop + emailsList.clientHeight >= emailsList.scrollHeight - 40) {
+            if (searchQuery) {
+                loadMoreSearchResults();
+            } else {
+                loadMoreEmails();
+            }
+        }
+    });
+
+    searchInput.addEventListener('keydown', (e) => {
+        if (e.key === 'Enter') {
+            startSearch(searchInput.value.trim());
+        }
+    });
+    emailSort.addEventListener('change', reloadEmails);
+    emailFilter.addEventListener('change', reloadEmails);
 }
 
 // File Handling
+// Attachments upload as soon as they are picked, as binary frames: 4-byte upload id + file bytes
 function handleFileSelect(e) {
     const files = Array.from(e.target.files);
 
     files.forEach(file => {
-        const reader = new FileReader();
-        reader.onload = (event) => {
-            attachments.push({
-                name: file.name,
-                data: event.target.result
-            });
-            updateAttachmentDisplay();
-        };
-        reader.readAsDataURL(file);
+        const attachment = { id: nextUploadId++, name: file.name, file: file, sent: 0, acked: 0, done: false };
+        attachments.push(attachment);
+        startUpload(attachment);
     });
+    updateAttachmentDisplay();
 
     // Clear file input
     fileInput.value = '';
 }
 
+function startUpload(attachment) {
+    attachment.generation = (attachment.generation || 0) + 1;  // stops a pump from the previous connection
+    attachment.sent = 0;
+    attachment.acked = 0;
+    attachment.done = false;
+    attachment.ended = false;
+    attachment.pumping = false;
+    attachment.chunkSize = null;
+    if (!ws || ws.readyState !== WebSocket.OPEN) {
+        return;  // restartUploads() picks it up once connected
+    }
+    ws.send(JSON.stringify({
+        type: 'upload_start',
+        id: attachment.id,
+        name: attachment.name,
+        size: attachment.file.size,
+        content_type: attachment.file.type
+    }));
+}
+
+function restartUploads() {
+    attachments.forEach(startUpload);
+    updateAttachmentDisplay();
+}
+
+function handleUploadReady(data) {
+    const attachment = attachments.find(att => att.id === data.id);
+    if (attachment) {
+        attachment.chunkSize = data.chunk_size;
+        pumpUpload(attachment);
+    }
+}
+
+async function pumpUpload(attachment) {
+    // Slices are read one at a time, so memory use does not depend on the file size
+    const { file, chunkSize, generation } = attachment;
+    while (!attachment.pumping && attachment.sent < file.size &&
+           attachment.sent - attachment.acked < UPLOAD_WINDOW * chunkSize) {
+        attachment.pumping = true;
+        const start = attachment.sent;
+        const payload = await file.slice(start, start + chunkSize).arrayBuffer();
+        if (!attachments.includes(attachment) || attachment.generation !== generation) {
+            return;  // removed or restarted meanwhile
+        }
+        attachment.pumping = false;
+        const frame = new Uint8Array(4 + payload.byteLength);
+        new DataView(frame.buffer).setUint32(0, attachment.id);
+        frame.set(new Uint8Array(payload), 4);
+        ws.send(frame);
+        attachment.sent += payload.byteLength;
+    }
+    if (attachment.sent === file.size && !attachment.ended) {
+        attachment.ended = true;
+        ws.send(JSON.stringify({ type: 'upload_end', id: attachment.id }));
+    }
+}
+
+function handleUploadProgress(data) {
+    const attachment = attachments.find(att => att.id === data.id);
+    if (attachment) {
+        attachment.acked = data.received;
+        updateAttachmentDisplay();
+        pumpUpload(attachment);
+    }
+}
+
+function handleUploadDone(data) {
+    const attachment = attachments.find(att => att.id === data.id);
+    if (attachment) {
+        attachment.done = true;
+        updateAttachmentDisplay();
+    }
+}
+
+function uploadLabel(att) {
+    if (att.done) {
+        return '';
+    }
+    const percent = att.file.size ? Math.floor(att.acked * 100 / att.file.size) : 0;
+    return ` (${percent}%)`;
+}
+
 function updateAttachmentDisplay() {
     if (attachments.length === 0) {
         attachmentCount.textContent = 'No attachments';
@@ -144,7 +312,7 @@ function updateAttachmentDisplay() {
         attachmentCount.textContent = `${attachments.length} file(s) attached`;
         attachmentList.innerHTML = attachments.map((att, index) => `
             <div class="attachment-item">
-                <span>📎 ${att.name}</span>
+                <span>📎 ${escapeHtml(att.name)}${uploadLabel(att)}</span>
                 <button onclick="removeAttachment(${index})">×</button>
             </div>
         `).join('');
@@ -152,7 +320,10 @@ function updateAttachmentDisplay() {
 }
 
 function removeAttachment(index) {
-    attachments.splice(index, 1);
+    const [attachment] = attachments.splice(index, 1);
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'cancel_upload', id: attachment.id }));
+    }
     updateAttachmentDisplay();
 }
 
@@ -175,13 +346,18 @@ function sendEmail() {
         return;
     }
 
+    if (attachments.some(att => !att.done)) {
+        showStatus('Attachments are still uploading', 'error');
+        return;
+    }
+
     const emailData = {
         type: 'send_email',
         sender: sender,
         recipients: recipients,
         subject: subject,
         body: body,
-        attachments: attachments
+        uploads: attachments.map(att => att.id)
     };
 
     sendBtn.disabled = true;
@@ -212,6 +388,7 @@ function loadInbox() {
 }
 
 function displayRecipients(recipients) {
+    recipientsData = recipients;
     if (recipients.length === 0) {
         recipientsList.innerHTML = '<div class="empty-state">No emails yet</div>';
         return;
@@ -226,6 +403,41 @@ function displayRecipients(recipients) {
     `).join('');
 }
 
+// Pushed by the server for every delivered message; no inbox re-scan needed
+function updateRecipientCount(name, delta) {
+    const recipient = recipientsData.find(r => r.name === name);
+    if (recipient) {
+        recipient.count += delta;
+    } else {
+        recipientsData.push({ name: name, count: delta });
+        recipientsData.sort((a, b) => a.name.localeCompare(b.name));
+    }
+    displayRecipients(recipientsData);
+}
+
+function addNewEmails(data) {
+    if (data.recipient !== selectedRecipient || searchQuery) {
+        return;
+    }
+    const filter = emailFilter.value;
+    const emails = data.data.filter(email =>
+        filter === 'all' || (filter === 'attachments') === email.isAttachment);
+    if (emails.length === 0) {
+        return;
+    }
+
+    const emptyState = emailsList.querySelector('.empty-state');
+    if (emptyState) {
+        emptyState.remove();
+    }
+    if (emailSort.value === 'newest') {
+        emailsList.insertAdjacentHTML('afterbegin', renderEmails(emails, data.recipient));
+    } else if (!emailsCursor) {
+        // Oldest first: only show it once the list has been paged to the end
+        emailsList.insertAdjacentHTML('beforeend', renderEmails(emails, data.recipient));
+    }
+}
+
 function selectRecipient(recipient) {
     selectedRecipient = recipient;
     selectedEmail = null;
@@ -237,22 +449,140 @@ function selectRecipient(recipient) {
     event.target.closest('.list-item').classList.add('active');
 
     // Load emails for this recipient
+    reloadEmails();
+
+    // Clear email content
+    emailContent.innerHTML = '<div class="empty-state">Select an email to view</div>';
+}
+
+// Search
+function startSearch(query) {
+    if (!query) {
+        searchQuery = null;
+        if (selectedRecipient) {
+            reloadEmails();
+        } else {
+            emailsList.innerHTML = '<div class="empty-state">Select a recipient</div>';
+        }
+        return;
+    }
+    searchQuery = query;
+    searchOffset = null;
+    requestSearch(0);
+}
+
+function requestSearch(offset) {
+    emailsLoading = true;
+    ws.send(JSON.stringify({
+        type: 'search',
+        query: searchQuery,
+        offset: offset
+    }));
+}
+
+function loadMoreSearchResults() {
+    if (searchOffset !== null && !emailsLoading) {
+        requestSearch(searchOffset);
+    }
+}
+
+function displaySearchResults(data) {
+    emailsLoading = false;
+    if (data.query !== searchQuery) {
+        return;
+    }
+    searchOffset = data.next_offset;
+
+    if (data.offset === 0 && data.data.length === 0) {
+        emailsList.innerHTML = '<div class="empty-state">No matches</div>';
+        return;
+    }
+
+    const html = data.data.map(hit => `
+        <div class="list-item" onclick="selectEmail('${hit.recipient}', '${hit.filename}')">
+            <div class="list-item-name">📧 ${escapeHtml(hit.subject || '(no subject)')}</div>
+            <div class="list-item-count">${escapeHtml(hit.sender)} → ${hit.recipient.replace(/_at_/g, '@').replace(/_/g, '.')}</div>
+            <div class="list-item-snippet">${escapeHtml(hit.snippet || '')}</div>
+        </div>
+    `).join('');
+
+    if (data.offset === 0) {
+        emailsList.innerHTML = html;
+        emailsList.scrollTop = 0;
+        const partial = data.truncated ? ' (only the newest matches were ranked; refine the query to see others)' : '';
+        showStatus(`${data.data.length}${data.next_offset !== null ? '+' : ''} result(s) in ${data.took_ms} ms${partial}`, '');
+    } else {
+        emailsList.insertAdjacentHTML('beforeend', html);
+    }
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+function requestEmails(cursor) {
+    emailsLoading = true;
     ws.send(JSON.stringify({
         type: 'get_emails',
-        recipient: recipient
+        recipient: selectedRecipient,
+        limit: EMAILS_PAGE_SIZE,
+        cursor: cursor,
+        sort: emailSort.value,
+        filter: emailFilter.value
     }));
+}
 
-    // Clear email content
-    emailContent.innerHTML = '<div class="empty-state">Select an email to view</div>';
+function reloadEmails() {
+    if (!selectedRecipient) {
+        return;
+    }
+    searchQuery = null;
+    searchInput.value = '';
+    emailsCursor = null;
+    requestEmails(null);
 }
 
-function displayEmails(emails, recipient) {
-    if (emails.length === 0) {
+function loadMoreEmails() {
+    if (selectedRecipient && emailsCursor && !emailsLoading) {
+        requestEmails(emailsCursor);
+    }
+}
+
+function displayEmails(page) {
+    const emails = page.data;
+    const recipient = page.recipient;
+    const isFirstPage = !page.cursor;
+
+    emailsLoading = false;
+    if (recipient !== selectedRecipient || searchQuery) {
+        return;
+    }
+    emailsCursor = page.next_cursor;
+
+    if (isFirstPage && emails.length === 0) {
         emailsList.innerHTML = '<div class="empty-state">No emails</div>';
         return;
     }
 
-    emailsList.innerHTML = emails.map(email => {
+    const html = renderEmails(emails, recipient);
+
+    if (isFirstPage) {
+        emailsList.innerHTML = html;
+        emailsList.scrollTop = 0;
+    } else {
+        emailsList.insertAdjacentHTML('beforeend', html);
+    }
+
+    // Keep going if the first page does not fill the list yet
+    if (emailsCursor && emailsList.scrollHeight <= emailsList.clientHeight) {
+        loadMoreEmails();
+    }
+}
+
+function renderEmails(emails, recipient) {
+    return emails.map(email => {
         const icon = email.isAttachment ? '📎' : '📧';
         return `
             <div class="list-item ${selectedEmail === email.filename ? 'active' : ''}" 
@@ -281,12 +611,81 @@ function selectEmail(recipient, filename) {
     }));
 }
 
-function displayEmailContent(content, isBinary) {
-    if (isBinary) {
-        emailContent.innerHTML = `<div style="color: #667eea;">${content}</div>`;
-    } else {
-        emailContent.textContent = content;
+function displayEmailContent(data) {
+    emailContent.textContent = '';
+
+    const text = document.createElement('div');
+    text.textContent = data.content;
+    if (data.is_binary) {
+        text.style.color = '#667eea';
+    }
+    emailContent.appendChild(text);
+
+    // Previews are capped on the server; the full file comes through a download
+    if (data.is_binary || data.truncated) {
+        if (data.truncated && !data.is_binary) {
+            const note = document.createElement('div');
+            note.className = 'list-item-attachment';
+            note.textContent = `[Preview truncated: ${data.size} bytes in total]`;
+            emailContent.appendChild(note);
+        }
+        const button = document.createElement('button');
+        button.className = 'btn btn-small';
+        button.textContent = '⬇️ Download';
+        button.addEventListener('click', () => startDownload(data.recipient, data.filename));
+        emailContent.appendChild(button);
+    }
+}
+
+// Downloads arrive as binary frames: 4-byte download id + file bytes
+function startDownload(recipient, filename) {
+    const id = nextDownloadId++;
+    downloads[id] = { recipient, filename, chunks: [], received: 0, size: null, offset: 0 };
+    requestDownload(id);
+}
+
+function requestDownload(id) {
+    const download = downloads[id];
+    ws.send(JSON.stringify({
+        type: 'download',
+        id: id,
+        recipient: download.recipient,
+        filename: download.filename,
+        offset: download.offset + download.received
+    }));
+}
+
+function resumeDownloads() {
+    Object.keys(downloads).forEach(id => requestDownload(Number(id)));
+}
+
+function handleDownloadChunk(buffer) {
+    const id = new DataView(buffer).getUint32(0);
+    const download = downloads[id];
+    if (!download) {
+        return;
+    }
+    download.chunks.push(buffer.slice(4));
+    download.received += buffer.byteLength - 4;
+    if (download.size) {
+        const percent = Math.floor((download.offset + download.received) * 100 / download.size);
+        showStatus(`Downloading ${download.filename}: ${percent}%`, '');
+    }
+}
+
+function finishDownload(data) {
+    const download = downloads[data.id];
+    if (!download || !data.complete) {
+        return;
     }
+    delete downloads[data.id];
+
+    const link = document.createElement('a');
+    link.href = URL.createObjectURL(new Blob(download.chunks));
+    link.download = download.filename;
+    link.click();
+    setTimeout(() => URL.revokeObjectURL(link.href), 1000);
+    showStatus(`Downloaded ${download.filename}`, 'success');
 }
 
 // Status Messages
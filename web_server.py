@@ -1,20 +1,163 @@
 # web_server.py - WebSocket server for web-based SMTP client
+import argparse
 import asyncio
+import codecs
+import functools
 import websockets
 import json
-import smtplib
 import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+from collections import OrderedDict
 from email.message import EmailMessage
 from datetime import datetime
 import base64
 
+from mail_events import EVENTS_PORT, serve_events
+from mail_index import MailIndex
+from mailstore import open_store
+from metrics import GATEWAY_METRICS_PORT, SLOW_THRESHOLD, Metrics, SlowLog, serve_metrics
+from outbox import DELIVERY_WORKERS, PER_DESTINATION_LIMIT, Outbox
+from outbound import OUTBOUND_CONCURRENCY, OUTBOUND_IDLE_TIMEOUT, SMTPSessionPool, build_batch, encoded_size, write_message
+
 INBOX_DIR = "inbox"
 SMTP_HOST = "localhost"
 SMTP_PORT = 2525
+EMAILS_PAGE_SIZE = 50  # messages per get_emails page unless the client asks for another limit
+EMAILS_PAGE_MAX = 500
+SEARCH_PAGE_SIZE = 20
+PREVIEW_BYTES = 64 * 1024  # get_email_content never reads more than this
+DOWNLOAD_CHUNK = 256 * 1024  # payload bytes per binary download frame
+SLOW_LOG = "slow_requests.log"  # JSON lines for requests slower than --slow-threshold
+UPLOAD_DIR = "uploads"  # attachments being uploaded; emptied when the gateway starts
+UPLOAD_CHUNK = 256 * 1024  # payload bytes per binary upload frame (the client is told this)
+UPLOAD_MAX_SIZE = 23 * 1024 * 1024  # per attachment; base64 makes it ~31.5 MB, so one always fits
+MESSAGE_MAX_SIZE = 32 * 1024 * 1024  # server.py's default --max-message-size; bigger messages get a 552
+MESSAGE_OVERHEAD = 64 * 1024  # headers and MIME boundaries allowed for on top of body and attachments
+CACHE_BYTES = 32 * 1024 * 1024  # memory for cached listings and previews (0 = no cache)
+CACHE_TTL = 30.0  # seconds; catches changes no delivery event reports, like retention deletes
+UPLOAD_MAINTYPES = ('text', 'image', 'audio', 'video', 'application')  # discrete types only; see RFC 2046
+
+
+def upload_content_type(value):
+    """Content type for an uploaded attachment, from whatever the browser reported.
+
+    Composite types (multipart/*, message/*) cannot be sent base64-encoded, and
+    the receiving side would parse them as nested messages, so anything that is
+    not a plain discrete type becomes application/octet-stream.
+    """
+    maintype, _, subtype = str(value or '').split(';')[0].strip().lower().partition('/')
+    if maintype not in UPLOAD_MAINTYPES or not re.fullmatch(r"[a-z0-9][a-z0-9!#$&^_.+-]*", subtype):
+        return 'application/octet-stream'
+    return f"{maintype}/{subtype}"
+
+
+def read_preview(store, recipient, filename, limit):
+    """Return (item size, first `limit` bytes) without reading the whole item."""
+    with store.open_item(recipient, filename) as f:
+        return f.size, f.read(limit)
+
+
+def read_at(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+def open_upload():
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix="upload_")
+    return os.fdopen(fd, "wb"), path
+
+
+def discard_upload(upload):
+    upload['file'].close()
+    if os.path.exists(upload['path']):
+        os.remove(upload['path'])
+
+
+class ResponseCache:
+    """LRU of ready-to-send JSON frames, bounded by their total size.
+    
+    Every entry carries a tag; invalidate(tag) drops all entries with it and
+    keeps frames built before the invalidation from being stored afterwards.
+    """
+    
+    def __init__(self, max_bytes=CACHE_BYTES, ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (frame, tag, expires)
+        self.tags = {}  # tag -> keys
+        self.versions = {}  # tag -> invalidation count
+        self.bytes = 0
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+    
+    def version(self, tag):
+        return self.versions.get(tag, 0)
+    
+    def put(self, key, frame, tag, version):
+        """Store frame unless tag was invalidated since version was read (see version())."""
+        if version != self.version(tag) or len(frame) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (frame, tag, time.monotonic() + self.ttl)
+        self.tags.setdefault(tag, set()).add(key)
+        self.bytes += len(frame)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+    
+    def invalidate(self, tag):
+        self.versions[tag] = self.version(tag) + 1
+        for key in self.tags.pop(tag, ()):
+            frame, _, _ = self.entries.pop(key)
+            self.bytes -= len(frame)
+    
+    def _remove(self, key):
+        frame, tag, _ = self.entries.pop(key)
+        self.bytes -= len(frame)
+        keys = self.tags.get(tag)
+        keys.discard(key)
+        if not keys:
+            del self.tags[tag]
+
 
 class WebSMTPHandler:
-    def __init__(self):
+    def __init__(self, outbound=None, outbox=None, metrics=None, slow_log=None, cache=None):
         self.connected_clients = set()
+        self.outbound = outbound or SMTPSessionPool(SMTP_HOST, SMTP_PORT)
+        self.outbox = outbox or Outbox(self.outbound)
+        self.outbox.on_status = self.on_delivery_status
+        self.queued_by = {}  # outbox queue id -> websocket that submitted it
+        self.store = open_store(INBOX_DIR)
+        self.index = MailIndex(INBOX_DIR)
+        self.downloads = {}  # websocket -> {download id: streaming task}
+        self.uploads = {}  # websocket -> {upload id: {'name', 'content_type', 'size', 'received', 'file', 'path', 'done'}}
+        self.batches = {}  # websocket -> running send_batch tasks
+        self.subscribers = {}  # recipient -> websockets that get its new_message events
+        self.subscriptions = {}  # websocket -> recipients it is subscribed to
+        self.metrics = metrics or Metrics()
+        self.slow_log = slow_log or SlowLog(None)
+        self.metrics.describe("gateway_request_seconds", "histogram", "Time to handle a client request, by type")
+        self.metrics.describe("gateway_errors_total", "counter", "Requests that failed, by type")
+        self.metrics.gauge("gateway_clients", lambda: len(self.connected_clients), "Connected web clients")
+        # Recipient counts, list pages and previews are served from here until a delivery changes them
+        self.cache = cache or ResponseCache()
+        self.metrics.describe("gateway_cache_hits_total", "counter", "Responses served from the cache, by kind")
+        self.metrics.describe("gateway_cache_misses_total", "counter", "Responses that had to be built, by kind")
+        self.metrics.gauge("gateway_cache_bytes", lambda: self.cache.bytes, "Size of the cached responses")
+        self.metrics.gauge("gateway_cache_entries", lambda: len(self.cache.entries), "Number of cached responses")
     
     async def handle_client(self, websocket):
         """Handle WebSocket connections from web clients"""
@@ -28,12 +171,29 @@ class WebSMTPHandler:
             }))
             
             async for message in websocket:
+                request_type = 'invalid'
+                started = time.perf_counter()
                 try:
+                    if isinstance(message, bytes):
+                        request_type = 'upload_chunk'
+                        await self.upload_chunk(websocket, message)
+                        continue
+                    
                     data = json.loads(message)
+                    request_type = data['type']
                     
                     if data['type'] == 'send_email':
                         await self.send_email(websocket, data)
                     
+                    elif data['type'] == 'send_batch':
+                        self.start_batch(websocket, data)
+                    
+                    elif data['type'] == 'search':
+                        await self.search(websocket, data)
+                    
+                    elif data['type'] == 'get_queue_status':
+                        await self.get_queue_status(websocket)
+                    
                     elif data['type'] == 'get_inbox':
                         await self.get_inbox(websocket)
                     
@@ -41,26 +201,65 @@ class WebSMTPHandler:
                         await self.get_recipients(websocket)
                     
                     elif data['type'] == 'get_emails':
-                        await self.get_emails(websocket, data['recipient'])
+                        await self.get_emails(websocket, data)
                     
                     elif data['type'] == 'get_email_content':
                         await self.get_email_content(websocket, data['recipient'], data['filename'])
                     
+                    elif data['type'] == 'subscribe':
+                        self.subscribe(websocket, data.get('recipients', []))
+                    
+                    elif data['type'] == 'download':
+                        self.start_download(websocket, data)
+                    
+                    elif data['type'] == 'cancel_download':
+                        task = self.downloads.get(websocket, {}).get(data['id'])
+                        if task:
+                            task.cancel()
+                    
+                    elif data['type'] == 'upload_start':
+                        await self.start_upload(websocket, data)
+                    
+                    elif data['type'] == 'upload_end':
+                        await self.finish_upload(websocket, data)
+                    
+                    elif data['type'] == 'cancel_upload':
+                        upload = self.uploads.get(websocket, {}).pop(data['id'], None)
+                        if upload:
+                            discard_upload(upload)
+                    
+                    else:
+                        request_type = 'unknown'  # keeps client-chosen strings out of the metric labels
+                    
                 except json.JSONDecodeError:
+                    self.metrics.inc('gateway_errors_total', type=request_type)
                     await websocket.send(json.dumps({
                         'type': 'error',
                         'message': 'Invalid JSON format'
                     }))
                 except Exception as e:
+                    self.metrics.inc('gateway_errors_total', type=request_type)
                     await websocket.send(json.dumps({
                         'type': 'error',
                         'message': f'Error: {str(e)}'
                     }))
+                finally:
+                    elapsed = time.perf_counter() - started
+                    self.metrics.observe('gateway_request_seconds', elapsed, type=request_type)
+                    if self.slow_log.check(elapsed, type=request_type):
+                        print(f"🐢 Slow {request_type} request: {elapsed:.2f}s")
         
         except websockets.exceptions.ConnectionClosed:
             print("📱 Web client disconnected")
         finally:
             self.connected_clients.discard(websocket)
+            self.subscribe(websocket, [])
+            for task in self.downloads.pop(websocket, {}).values():
+                task.cancel()
+            for task in self.batches.pop(websocket, set()):
+                task.cancel()
+            for upload in self.uploads.pop(websocket, {}).values():
+                discard_upload(upload)
     
     async def send_email(self, websocket, data):
         """Send email via SMTP"""
@@ -70,6 +269,7 @@ class WebSMTPHandler:
             subject = data.get('subject', '').strip()
             body = data.get('body', '').strip()
             attachments = data.get('attachments', [])
+            upload_ids = data.get('uploads', [])
             
             if not sender or not recipients:
                 await websocket.send(json.dumps({
@@ -78,6 +278,10 @@ class WebSMTPHandler:
                 }))
                 return
             
+            if upload_ids:
+                await self.send_with_uploads(websocket, sender, recipients, subject, body, upload_ids)
+                return
+            
             # Create email message
             msg = EmailMessage()
             msg["From"] = sender
@@ -101,18 +305,18 @@ class WebSMTPHandler:
                 except Exception as e:
                     print(f"Attachment error: {e}")
             
-            # Send email
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10) as smtp:
-                smtp.send_message(msg)
+            # Persist it in the outbox and answer right away; delivery workers
+            # send it (and retry with backoff) even if the SMTP server is down
+            queue_id = await self.outbox.enqueue(msg, sender, recipients)
+            self.queued_by[queue_id] = websocket
             
             await websocket.send(json.dumps({
                 'type': 'send_success',
-                'message': '✅ Email sent successfully!',
+                'message': '📨 Email queued for delivery',
+                'queue_id': queue_id,
                 'timestamp': datetime.now().isoformat()
             }))
-            
-            # Broadcast to all clients that inbox updated
-            await self.broadcast_inbox_update()
+            # The inbox update itself arrives as a new_message event from server.py
             
         except Exception as e:
             await websocket.send(json.dumps({
@@ -120,134 +324,567 @@ class WebSMTPHandler:
                 'message': f'Failed to send email: {str(e)}'
             }))
     
+    async def send_with_uploads(self, websocket, sender, recipients, subject, body, upload_ids):
+        """Queue a message whose attachments were uploaded beforehand (see start_upload).
+        
+        The message is written straight into the outbox, streaming each upload
+        through base64, so its size never matters for the gateway's memory.
+        """
+        uploads = self.uploads.get(websocket, {})
+        missing = [upload_id for upload_id in upload_ids
+                   if upload_id not in uploads or not uploads[upload_id]['done']]
+        if missing:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'Uploads not finished: {missing}'
+            }))
+            return
+        
+        # Checked here because the server would refuse the message only once it is queued
+        size = (MESSAGE_OVERHEAD + len(body.encode())
+                + sum(encoded_size(uploads[i]['received']) for i in upload_ids))
+        if size > MESSAGE_MAX_SIZE:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'Attachments add up to more than the {MESSAGE_MAX_SIZE // (1024 * 1024)} MB a message may take'
+            }))
+            return
+        
+        attachments = [(uploads[i]['name'], uploads[i]['content_type'], uploads[i]['path']) for i in upload_ids]
+        queue_id = await self.outbox.enqueue_file(
+            lambda f: write_message(f, sender, recipients, subject, body, attachments),
+            sender, recipients, subject)
+        self.queued_by[queue_id] = websocket
+        for upload_id in upload_ids:
+            discard_upload(uploads.pop(upload_id))
+        
+        await websocket.send(json.dumps({
+            'type': 'send_success',
+            'message': '📨 Email queued for delivery',
+            'queue_id': queue_id,
+            'timestamp': datetime.now().isoformat()
+        }))
+    
+    async def start_upload(self, websocket, data):
+        """Open a temp file for an attachment the client is about to send.
+        
+        The client picks the id and, after upload_ready, sends binary frames of
+        a 4-byte big-endian upload id followed by up to UPLOAD_CHUNK bytes (the
+        same framing as downloads). Every frame is acked with upload_progress
+        once it is on disk, and upload_end completes the upload.
+        """
+        upload_id = int(data['id'])
+        name = os.path.basename(str(data.get('name') or '')) or 'attachment'
+        size = int(data.get('size') or 0)
+        if size < 0 or size > UPLOAD_MAX_SIZE:
+            await websocket.send(json.dumps({
+                'type': 'upload_error',
+                'id': upload_id,
+                'message': f'Attachments are limited to {UPLOAD_MAX_SIZE // (1024 * 1024)} MB'
+            }))
+            return
+        
+        content_type = upload_content_type(data.get('content_type'))
+        
+        uploads = self.uploads.setdefault(websocket, {})
+        if upload_id in uploads:
+            discard_upload(uploads.pop(upload_id))
+        loop = asyncio.get_running_loop()
+        f, path = await loop.run_in_executor(None, open_upload)
+        uploads[upload_id] = {'name': name, 'content_type': content_type, 'size': size,
+                              'received': 0, 'file': f, 'path': path, 'done': False}
+        await websocket.send(json.dumps({
+            'type': 'upload_ready',
+            'id': upload_id,
+            'chunk_size': UPLOAD_CHUNK
+        }))
+    
+    async def upload_chunk(self, websocket, frame):
+        """Append one binary upload frame to its temp file and ack it."""
+        if len(frame) < 4:
+            raise ValueError('Binary frame too short')
+        upload_id = struct.unpack('!I', frame[:4])[0]
+        upload = self.uploads.get(websocket, {}).get(upload_id)
+        if upload is None or upload['done']:
+            return  # cancelled (or finished) while frames were in flight
+        chunk = frame[4:]
+        if upload['received'] + len(chunk) > upload['size']:
+            discard_upload(self.uploads[websocket].pop(upload_id))
+            await websocket.send(json.dumps({
+                'type': 'upload_error',
+                'id': upload_id,
+                'message': 'Upload is larger than announced'
+            }))
+            return
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, upload['file'].write, chunk)
+        upload['received'] += len(chunk)
+        await websocket.send(json.dumps({
+            'type': 'upload_progress',
+            'id': upload_id,
+            'received': upload['received']
+        }))
+    
+    async def finish_upload(self, websocket, data):
+        upload_id = int(data['id'])
+        upload = self.uploads.get(websocket, {}).get(upload_id)
+        if upload is None:
+            return
+        if upload['received'] != upload['size']:
+            discard_upload(self.uploads[websocket].pop(upload_id))
+            await websocket.send(json.dumps({
+                'type': 'upload_error',
+                'id': upload_id,
+                'message': f"Upload incomplete: {upload['received']} of {upload['size']} bytes"
+            }))
+            return
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, upload['file'].close)
+        upload['done'] = True
+        await websocket.send(json.dumps({
+            'type': 'upload_done',
+            'id': upload_id,
+            'size': upload['size']
+        }))
+    
+    async def on_delivery_status(self, queue_id, status, error):
+        """Tell the submitting client how its queued message is doing"""
+        websocket = self.queued_by.get(queue_id)
+        if status != 'retrying':
+            self.queued_by.pop(queue_id, None)
+        if websocket is None or websocket not in self.connected_clients:
+            return
+        await websocket.send(json.dumps({
+            'type': 'delivery_status',
+            'queue_id': queue_id,
+            'status': status,
+            'error': error
+        }))
+    
+    async def get_queue_status(self, websocket):
+        """Outbound queue depth, age and recent entries"""
+        try:
+            status = await self.outbox.status()
+            await websocket.send(json.dumps({
+                'type': 'queue_status',
+                **status
+            }))
+        except Exception as e:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'Error loading queue status: {str(e)}'
+            }))
+    
+    def start_batch(self, websocket, data):
+        """Run a batch in the background; results stream back as they finish"""
+        tasks = self.batches.setdefault(websocket, set())
+        task = asyncio.create_task(self.send_batch(websocket, data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    async def send_batch(self, websocket, data):
+        """Send many messages over the pooled SMTP sessions.
+        
+        The request carries either 'messages' or a 'template' plus 'rows'
+        (see outbound.build_batch), an optional 'id' echoed back, and an
+        optional 'parallelism' (capped at the pool's concurrency by
+        send_many). One batch_result frame is sent per message,
+        then a batch_done frame with totals and throughput.
+        """
+        batch_id = data.get('id')
+        try:
+            messages = build_batch(data)
+            parallelism = int(data['parallelism']) if data.get('parallelism') else None
+        except Exception as e:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'Invalid batch: {str(e)}'
+            }))
+            return
+        
+        await websocket.send(json.dumps({
+            'type': 'batch_started',
+            'id': batch_id,
+            'total': len(messages)
+        }))
+        
+        started = time.monotonic()
+        sent = failed = 0
+        async for index, refused, error in self.outbound.send_many(messages, parallelism):
+            if error is None:
+                sent += 1
+            else:
+                failed += 1
+            await websocket.send(json.dumps({
+                'type': 'batch_result',
+                'id': batch_id,
+                'index': index,
+                'ok': error is None,
+                'error': str(error) if error else None,
+                'refused': sorted(refused)
+            }))
+        
+        elapsed = time.monotonic() - started
+        await websocket.send(json.dumps({
+            'type': 'batch_done',
+            'id': batch_id,
+            'total': len(messages),
+            'sent': sent,
+            'failed': failed,
+            'elapsed': round(elapsed, 3),
+            'messages_per_sec': round(len(messages) / elapsed, 1) if elapsed > 0 else None
+        }))
+    
+    async def cached(self, key, tag, build):
+        """Return the cached frame for key, or await build() for it and cache the result.
+        
+        key[0] names the kind of response in the hit/miss counters. Failures
+        are not cached: the exception goes to the caller.
+        """
+        frame = self.cache.get(key)
+        if frame is not None:
+            self.metrics.inc('gateway_cache_hits_total', cache=key[0])
+            return frame
+        self.metrics.inc('gateway_cache_misses_total', cache=key[0])
+        version = self.cache.version(tag)
+        frame = await build()
+        self.cache.put(key, frame, tag, version)
+        return frame
+    
     async def get_recipients(self, websocket):
         """Get list of recipient folders"""
         try:
-            if not os.path.isdir(INBOX_DIR):
-                os.makedirs(INBOX_DIR, exist_ok=True)
-            
-            recipients = []
-            for name in sorted(os.listdir(INBOX_DIR)):
-                path = os.path.join(INBOX_DIR, name)
-                if os.path.isdir(path):
-                    # Count emails in folder
-                    files = [f for f in os.listdir(path) if f.endswith('.txt') or f.endswith('.eml')]
-                    recipients.append({
-                        'name': name,
-                        'count': len([f for f in files if f.endswith('.txt')])
-                    })
+            # Counts come from the delivery index, not from listing every folder
+            async def build():
+                loop = asyncio.get_running_loop()
+                return json.dumps({
+                    'type': 'recipients',
+                    'data': await loop.run_in_executor(None, self.index.recipients)
+                })
             
-            await websocket.send(json.dumps({
-                'type': 'recipients',
-                'data': recipients
-            }))
+            await websocket.send(await self.cached(('recipients',), ('recipients',), build))
         except Exception as e:
             await websocket.send(json.dumps({
                 'type': 'error',
                 'message': f'Error loading recipients: {str(e)}'
             }))
     
-    async def get_emails(self, websocket, recipient):
-        """Get list of emails for a recipient"""
+    async def get_emails(self, websocket, data):
+        """Get one page of emails for a recipient.
+        
+        Optional fields: limit, cursor (next_cursor from the previous page),
+        sort ('newest' or 'oldest') and filter ('all', 'messages' or 'attachments').
+        """
         try:
-            rec_folder = os.path.join(INBOX_DIR, recipient)
-            if not os.path.isdir(rec_folder):
-                await websocket.send(json.dumps({
+            recipient = data['recipient']
+            limit = max(1, min(int(data.get('limit') or EMAILS_PAGE_SIZE), EMAILS_PAGE_MAX))
+            cursor = data.get('cursor')
+            sort = data.get('sort', 'newest')
+            show = data.get('filter', 'all')
+            
+            async def build():
+                # Off the event loop: the index lock may be held by a delivery or the janitor
+                loop = asyncio.get_running_loop()
+                entries, next_cursor = await loop.run_in_executor(None, functools.partial(
+                    self.index.messages_page, recipient, limit, cursor,
+                    newest_first=(sort != 'oldest'),
+                    with_attachments=(show == 'attachments')
+                ))
+                
+                email_list = []
+                for entry in entries:
+                    email_list.extend(self.email_items(entry, show))
+                
+                return json.dumps({
                     'type': 'emails',
                     'recipient': recipient,
-                    'data': []
-                }))
-                return
+                    'data': email_list,
+                    'cursor': cursor,
+                    'next_cursor': next_cursor,
+                    'sort': sort,
+                    'filter': show
+                })
             
-            files = sorted(os.listdir(rec_folder), reverse=True)
-            email_list = []
+            frame = await self.cached(('emails', recipient, limit, cursor, sort, show), ('emails', recipient), build)
             
-            for f in files:
-                if f.endswith('.txt') or f.endswith('.eml'):
-                    # Extract timestamp from filename
-                    timestamp = f.split('_')[1:4]
-                    email_list.append({
-                        'filename': f,
-                        'display': f,
-                        'isAttachment': False
-                    })
-                elif not f.startswith('body_') and not f.startswith('mail_'):
-                    # It's an attachment
-                    email_list.append({
-                        'filename': f,
-                        'display': f,
-                        'isAttachment': True
-                    })
+            # Opening a recipient's list subscribes this client to its new mail
+            if not cursor:
+                self.subscribe(websocket, [recipient])
             
+            await websocket.send(frame)
+        except Exception as e:
             await websocket.send(json.dumps({
-                'type': 'emails',
-                'recipient': recipient,
-                'data': email_list
+                'type': 'error',
+                'message': f'Error loading emails: {str(e)}'
+            }))
+    
+    async def search(self, websocket, data):
+        """Full-text search over sender, subject, body text and attachment names.
+        
+        Fields: query, optional recipient, limit and offset (next_offset from
+        the previous page).
+        """
+        try:
+            query = data.get('query', '')
+            limit = max(1, min(int(data.get('limit') or SEARCH_PAGE_SIZE), EMAILS_PAGE_MAX))
+            offset = max(0, int(data.get('offset') or 0))
+            
+            started = time.monotonic()
+            loop = asyncio.get_running_loop()
+            hits, next_offset, truncated = await loop.run_in_executor(
+                None, self.index.search, query, limit, offset, data.get('recipient'))
+            took_ms = round((time.monotonic() - started) * 1000, 1)
+            
+            await websocket.send(json.dumps({
+                'type': 'search_results',
+                'query': query,
+                'offset': offset,
+                'next_offset': next_offset,
+                'truncated': truncated,
+                'took_ms': took_ms,
+                'data': [{
+                    'recipient': hit['recipient'],
+                    'ts': hit['ts'],
+                    'sender': hit['sender'],
+                    'subject': hit['subject'],
+                    'snippet': hit['snippet'],
+                    'filename': hit['body'] or hit['eml'],
+                    'attachments': hit['attachments']
+                } for hit in hits]
             }))
         except Exception as e:
             await websocket.send(json.dumps({
                 'type': 'error',
-                'message': f'Error loading emails: {str(e)}'
+                'message': f'Search failed: {str(e)}'
             }))
     
+    @staticmethod
+    def email_items(entry, show='all'):
+        """List items (as sent in 'emails' frames) for one indexed message"""
+        items = []
+        if show != 'attachments':
+            for f in (entry['eml'], entry['body']):
+                if f:
+                    items.append({
+                        'filename': f,
+                        'display': f,
+                        'isAttachment': False
+                    })
+        if show != 'messages':
+            for f in entry['attachments']:
+                items.append({
+                    'filename': f,
+                    'display': f,
+                    'isAttachment': True
+                })
+        return items
+    
+    def subscribe(self, websocket, recipients):
+        """Replace the set of recipients whose new mail is pushed to this client"""
+        for recipient in self.subscriptions.pop(websocket, ()):
+            clients = self.subscribers.get(recipient)
+            if clients is not None:
+                clients.discard(websocket)
+                if not clients:
+                    del self.subscribers[recipient]
+        if recipients:
+            self.subscriptions[websocket] = set(recipients)
+            for recipient in recipients:
+                self.subscribers.setdefault(recipient, set()).add(websocket)
+    
     async def get_email_content(self, websocket, recipient, filename):
-        """Get content of a specific email"""
+        """Get a preview (first PREVIEW_BYTES) of a specific email; use 'download' for the rest"""
         try:
-            filepath = os.path.join(INBOX_DIR, recipient, filename)
-            
-            with open(filepath, 'rb') as f:
-                data = f.read()
+            async def build():
+                loop = asyncio.get_running_loop()
+                size, data = await loop.run_in_executor(
+                    None, read_preview, self.store, recipient, filename, PREVIEW_BYTES)
+                truncated = size > len(data)
+                
+                # Try to decode as text (a cut-off multi-byte character at the end is fine)
+                try:
+                    content = codecs.getincrementaldecoder('utf-8')().decode(data, final=not truncated)
+                    is_binary = False
+                except UnicodeDecodeError:
+                    content = f"[Binary file: {filename}]\nSize: {size} bytes"
+                    is_binary = True
+                
+                return json.dumps({
+                    'type': 'email_content',
+                    'recipient': recipient,
+                    'filename': filename,
+                    'content': content,
+                    'is_binary': is_binary,
+                    'size': size,
+                    'truncated': truncated
+                })
             
-            # Try to decode as text
+            # Stored items never change once written, so the name alone is a safe key
+            frame = await self.cached(('preview', recipient, filename), ('preview', recipient), build)
+            await websocket.send(frame)
+        except Exception as e:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'Error loading email content: {str(e)}'
+            }))
+    
+    def start_download(self, websocket, data):
+        """Stream a file in the background so the client can keep sending requests"""
+        download_id = int(data['id'])
+        downloads = self.downloads.setdefault(websocket, {})
+        task = asyncio.create_task(self.stream_file(websocket, download_id, data))
+        downloads[download_id] = task
+        task.add_done_callback(lambda t: downloads.pop(download_id, None))
+    
+    async def stream_file(self, websocket, download_id, data):
+        """Send a file (or an offset/length range of it) as binary frames.
+        
+        Each frame is a 4-byte big-endian download id followed by up to
+        DOWNLOAD_CHUNK bytes. A download_start message comes first and a
+        download_end message last, so an interrupted download can be resumed
+        by asking again with offset = bytes received.
+        """
+        recipient = data.get('recipient')
+        filename = data.get('filename')
+        try:
+            loop = asyncio.get_running_loop()
+            f = await loop.run_in_executor(None, self.store.open_item, recipient, filename)
             try:
-                content = data.decode('utf-8')
-                is_binary = False
-            except:
-                content = f"[Binary file: {filename}]\nSize: {len(data)} bytes\n\nDownload path: {filepath}"
-                is_binary = True
+                size = f.size
+                offset = min(max(int(data.get('offset') or 0), 0), size)
+                end = size
+                if data.get('length') is not None:
+                    end = min(size, offset + max(int(data['length']), 0))
+                
+                await websocket.send(json.dumps({
+                    'type': 'download_start',
+                    'id': download_id,
+                    'recipient': recipient,
+                    'filename': filename,
+                    'size': size,
+                    'offset': offset,
+                    'length': end - offset
+                }))
+                
+                prefix = struct.pack('!I', download_id)
+                pos = offset
+                while pos < end:
+                    chunk = await loop.run_in_executor(None, read_at, f, pos, min(DOWNLOAD_CHUNK, end - pos))
+                    if not chunk:
+                        break
+                    # send() waits while the connection's write buffer is full,
+                    # so a slow client slows the reads down instead of using memory
+                    await websocket.send(prefix + chunk)
+                    pos += len(chunk)
+            finally:
+                f.close()
             
             await websocket.send(json.dumps({
-                'type': 'email_content',
-                'recipient': recipient,
-                'filename': filename,
-                'content': content,
-                'is_binary': is_binary
+                'type': 'download_end',
+                'id': download_id,
+                'sent': pos - offset,
+                'complete': pos >= end
             }))
+        except (asyncio.CancelledError, websockets.exceptions.ConnectionClosed):
+            raise
         except Exception as e:
             await websocket.send(json.dumps({
-                'type': 'error',
-                'message': f'Error loading email content: {str(e)}'
+                'type': 'download_error',
+                'id': download_id,
+                'message': f'Error downloading file: {str(e)}'
             }))
     
     async def get_inbox(self, websocket):
         """Get full inbox overview"""
         await self.get_recipients(websocket)
     
-    async def broadcast_inbox_update(self):
-        """Notify all clients that inbox has been updated"""
-        if self.connected_clients:
+    async def on_mail_event(self, event):
+        """Push a delivery from server.py to clients instead of making them re-scan.
+        
+        Subscribers of the recipient get the new list items; every client gets
+        a one-line count update for the recipients panel.
+        """
+        if event.get('type') != 'new_message' or not event.get('recipient'):
+            return
+        recipient = event['recipient']
+        self.cache.invalidate(('recipients',))
+        self.cache.invalidate(('emails', recipient))
+        sends = []
+        subscribers = self.subscribers.get(recipient, set())
+        if subscribers:
             message = json.dumps({
-                'type': 'inbox_updated',
-                'message': 'New email received'
+                'type': 'new_message',
+                'recipient': recipient,
+                'sender': event.get('sender', ''),
+                'subject': event.get('subject', ''),
+                'data': self.email_items(event)
             })
-            await asyncio.gather(
-                *[client.send(message) for client in self.connected_clients],
-                return_exceptions=True
-            )
+            sends += [client.send(message) for client in subscribers]
+        if self.connected_clients:
+            count_update = json.dumps({
+                'type': 'recipient_count',
+                'name': recipient,
+                'delta': 1
+            })
+            sends += [client.send(count_update) for client in self.connected_clients]
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
 
-async def main():
-    handler = WebSMTPHandler()
+async def main(args):
+    outbound = SMTPSessionPool(SMTP_HOST, SMTP_PORT, concurrency=args.smtp_concurrency,
+                               idle_timeout=args.smtp_idle_timeout)
+    outbox = Outbox(outbound, workers=args.delivery_workers, per_destination=args.per_destination)
+    await outbox.start()
+    handler = WebSMTPHandler(outbound, outbox, slow_log=SlowLog(args.slow_log, args.slow_threshold),
+                             cache=ResponseCache(args.cache_bytes, args.cache_ttl))
+    # Uploads never outlive the connection they came in on
+    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
     
     print("🌐 WebSocket SMTP Server starting on ws://localhost:8787")
     print("📧 Connecting to SMTP server at localhost:2525")
     print("📂 Inbox directory: inbox/")
     
-    async with websockets.serve(handler.handle_client, "localhost", 8787):
-        await asyncio.Future()  # run forever
+    events = await serve_events(handler.on_mail_event)
+    print(f"🔔 Listening for delivery events on localhost:{EVENTS_PORT}")
+    if args.metrics_port:
+        await serve_metrics(handler.metrics, port=args.metrics_port)
+        print(f"📊 Metrics on http://localhost:{args.metrics_port}/metrics")
+    
+    try:
+        async with websockets.serve(handler.handle_client, "localhost", 8787):
+            await asyncio.Future()  # run forever
+    finally:
+        events.close()
+        await outbox.close()
+        await outbound.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="WebSocket gateway for the SMTP lab web client")
+    parser.add_argument("--smtp-concurrency", type=int, default=OUTBOUND_CONCURRENCY,
+                        help="outbound SMTP sessions used in parallel")
+    parser.add_argument("--smtp-idle-timeout", type=float, default=OUTBOUND_IDLE_TIMEOUT,
+                        help="seconds before an unused SMTP session is closed")
+    parser.add_argument("--delivery-workers", type=int, default=DELIVERY_WORKERS,
+                        help="outbox messages delivered at once")
+    parser.add_argument("--per-destination", type=int, default=PER_DESTINATION_LIMIT,
+                        help="in-flight deliveries per recipient domain")
+    parser.add_argument("--metrics-port", type=int, default=GATEWAY_METRICS_PORT,
+                        help="port for GET /metrics in Prometheus format (0 = off)")
+    parser.add_argument("--slow-log", default=SLOW_LOG,
+                        help="file that gets a JSON line per slow request ('' = off)")
+    parser.add_argument("--slow-threshold", type=float, default=SLOW_THRESHOLD,
+                        help="seconds before a request counts as slow")
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_BYTES,
+                        help="memory for cached recipient counts, list pages and previews (0 = off)")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL,
+                        help="seconds a cached response is trusted without a delivery event")
+    return parser.parse_args()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(main(parse_args()))
     except KeyboardInterrupt:
         print("\n🛑 Web server stopped")
 